@@ -0,0 +1,133 @@
+"""
+并发会话基准测试 - 同一进程里同时跑多个会话：同步逐个处理 vs 线程池 vs 单个事件循环上的异步 Agent
+
+每个会话是一个独立的 Agent，连续处理 --turns-per-session 轮（process_single_message / aprocess_message），
+LLM 由本地替身服务模拟（首包延迟 + 输出速率），因此吞吐主要取决于能同时等待多少个 LLM 调用。
+
+    sync     一个线程逐个会话处理（一个进程同一时间只能处理一轮对话）
+    threads  每个会话一个线程（--threads 限制线程数）
+    async    所有会话在同一个事件循环上并发，共用异步连接池
+
+用法：
+    python benchmarks/bench_async_agent.py --sessions 200 --turns-per-session 3 --latency 0.2 --tps 200
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.bench_e2e import StageRecorder, build_script, print_report, user_message
+from benchmarks.fake_openai_server import FakeOpenAIServer
+from llm import llm_client
+from llm.llm_client import AIChat, AIConfig, ClientManager, disable_response_cache
+
+
+def run_sync(sessions: int, turns: int, workers: int) -> Dict[str, Dict[str, float]]:
+    from core.agent import Agent
+
+    recorder = StageRecorder()
+
+    def conversation(session: int) -> None:
+        agent = Agent(max_context_length=10 ** 9)
+        for i in range(turns):
+            with recorder.time("agent.turn"):
+                agent.process_single_message(user_message(session * turns + i))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(conversation, range(sessions)))
+    return recorder.report(time.perf_counter() - start)
+
+
+def run_async(sessions: int, turns: int) -> Dict[str, Dict[str, float]]:
+    from core.agent import Agent
+
+    recorder = StageRecorder()
+
+    async def conversation(session: int) -> None:
+        agent = Agent(max_context_length=10 ** 9)
+        for i in range(turns):
+            start = time.perf_counter()
+            await agent.aprocess_message(user_message(session * turns + i))
+            recorder.add("agent.turn", time.perf_counter() - start)
+
+    async def main() -> float:
+        start = time.perf_counter()
+        await asyncio.gather(*(conversation(s) for s in range(sessions)))
+        return time.perf_counter() - start
+
+    wall = asyncio.run(main())
+    return recorder.report(wall)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="并发会话基准测试（本地替身服务）")
+    parser.add_argument("--sessions", type=int, default=100)
+    parser.add_argument("--turns-per-session", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=32, help="threads 模式的线程数")
+    parser.add_argument("--sync-sessions", type=int, default=None, help="sync 模式只跑前几个会话（默认同 --sessions）")
+    parser.add_argument("--modes", default="sync,threads,async")
+    parser.add_argument("--llm-concurrency", type=int, default=None,
+                        help="每个 provider 的 LLM 并发窗口（默认同 --sessions）")
+    parser.add_argument("--latency", type=float, default=0.2, help="替身服务首包延迟（秒）")
+    parser.add_argument("--tps", type=float, default=200.0, help="替身服务输出速率（tokens/s）")
+    parser.add_argument("--verbose", action="store_true", help="显示 Agent 的日志")
+    args = parser.parse_args()
+
+    storage_dir = tempfile.mkdtemp(prefix="bench_memory_")
+    server = FakeOpenAIServer(build_script(), latency=args.latency, tokens_per_second=args.tps).start()
+    ClientManager.set_backend(server.url)
+    disable_response_cache()
+    AIConfig.EMBEDDING_CACHE_ENABLED = False
+    # 连接数和 provider 并发窗口不应成为瓶颈（真实部署里它们保护的是上游，这里只比较 Agent 本身）
+    llm_concurrency = args.llm_concurrency or args.sessions
+    AIConfig.HTTP_MAX_CONNECTIONS = max(AIConfig.HTTP_MAX_CONNECTIONS, llm_concurrency)
+    AIConfig.HTTP_MAX_KEEPALIVE_CONNECTIONS = max(AIConfig.HTTP_MAX_KEEPALIVE_CONNECTIONS, llm_concurrency)
+    llm_client._ai_chat.rate_limits.initial_concurrency = llm_concurrency
+    llm_client._ai_chat.rate_limits.max_concurrency = llm_concurrency
+
+    import memory_system
+    from memory_system import MemoryConfig
+    memory_system.get_memory_system(MemoryConfig(STORAGE_DIR=storage_dir), llm_client=AIChat())
+
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+    results = {}
+    log = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    try:
+        with log:
+            for mode in modes:
+                if mode == "sync":
+                    report = run_sync(args.sync_sessions or args.sessions, args.turns_per_session, 1)
+                elif mode == "threads":
+                    report = run_sync(args.sessions, args.turns_per_session, args.threads)
+                elif mode == "async":
+                    report = run_async(args.sessions, args.turns_per_session)
+                else:
+                    raise ValueError(f"未知模式: {mode}")
+                results[mode] = report
+    finally:
+        server.stop()
+        ClientManager.clear_backend()
+        memory_system.shutdown_background_loop()
+        shutil.rmtree(storage_dir, ignore_errors=True)
+
+    print(f"\n{'mode':<10}{'turns':>8}{'turns/s':>10}{'p50':>10}{'p99':>10}")
+    for mode, report in results.items():
+        r = report["agent.turn"]
+        print(f"{mode:<10}{r['n']:>8}{r['throughput']:>10.1f}{r['p50_ms']:>8.0f}ms{r['p99_ms']:>8.0f}ms")
+    if args.verbose:
+        for mode, report in results.items():
+            print_report(mode, report)
+
+
+if __name__ == "__main__":
+    main()
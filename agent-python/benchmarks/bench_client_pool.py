@@ -0,0 +1,81 @@
+"""
+连接池基准测试 - 对比每次新建客户端与池化长连接客户端的单次调用延迟
+
+用法：
+    python benchmarks/bench_client_pool.py --model google/gemini-2.5-flash --n 20
+需要配置与模型对应的 API Key（见 llm/llm_client.py 中的 ClientManager）。
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from openai import OpenAI
+
+from llm.llm_client import ClientManager, close_clients
+
+
+def _one_call(client, model: str) -> float:
+    start = time.perf_counter()
+    client.chat.completions.create(
+        model=model,
+        messages=[{"role": "user", "content": "ping"}],
+        max_tokens=1,
+    )
+    return time.perf_counter() - start
+
+
+def bench_fresh(model: str, n: int) -> list:
+    """旧行为：每次调用都新建客户端（新的 TCP+TLS 握手），用完关闭"""
+    provider = ClientManager.resolve_provider(model)
+    api_key, base_url = ClientManager._get_provider_settings(provider)
+    latencies = []
+    for _ in range(n):
+        start = time.perf_counter()
+        client = OpenAI(api_key=api_key, base_url=base_url)
+        _one_call(client, model)
+        client.close()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def bench_pooled(model: str, n: int) -> list:
+    """新行为：从连接池获取客户端，复用 keep-alive 连接"""
+    latencies = []
+    for _ in range(n):
+        start = time.perf_counter()
+        client = ClientManager.get_client(model)
+        _one_call(client, model)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def _report(name: str, latencies: list) -> float:
+    p50 = statistics.median(latencies) * 1000
+    mean = statistics.mean(latencies) * 1000
+    print(f"{name:<8} n={len(latencies):<4} mean={mean:8.1f}ms  p50={p50:8.1f}ms  "
+          f"min={min(latencies) * 1000:8.1f}ms  max={max(latencies) * 1000:8.1f}ms")
+    return mean
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ClientPool 延迟基准测试")
+    parser.add_argument("--model", default="google/gemini-2.5-flash")
+    parser.add_argument("--n", type=int, default=20)
+    args = parser.parse_args()
+
+    # 预热：DNS 解析与模型冷启动不计入对比
+    _one_call(ClientManager.get_client(args.model), args.model)
+
+    fresh_mean = _report("fresh", bench_fresh(args.model, args.n))
+    pooled_mean = _report("pooled", bench_pooled(args.model, args.n))
+    print(f"每次调用平均节省: {fresh_mean - pooled_mean:.1f}ms")
+
+    close_clients()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""
+端到端基准测试 - 在本地替身服务上驱动 Agent 和记忆系统，按阶段统计吞吐与 p50/p99
+
+阶段：
+    agent.turn     Agent.process_single_message 整轮
+    context.build  ContextBuilder.create_context_from_state
+    llm.call       Agent 内的 llm_call
+    tool.exec      工具解析与执行
+    memory.write   MemorySystem.update_memory（摘要 + 向量 + 落盘）
+    memory.read    MemorySystem.get_relevant_memories
+
+用法：
+    python benchmarks/bench_e2e.py --turns 50 --concurrency 4 --latency 0.05 --tps 200
+不需要任何 API Key；记忆写入临时目录，不影响 memory_system/storage 下的数据。
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_openai_server import FakeOpenAIServer, FakeScript, function_call_block
+from llm import llm_client
+from llm.llm_client import AIChat, AIConfig, ClientManager, disable_response_cache
+
+
+class StageRecorder:
+    """按阶段记录耗时（线程安全）"""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+    @contextlib.contextmanager
+    def time(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def wrap(self, owner: Any, attr: str, stage: str) -> None:
+        """把 owner.attr 替换为计时包装"""
+        fn = getattr(owner, attr)
+
+        def timed(*args, **kwargs):
+            with self.time(stage):
+                return fn(*args, **kwargs)
+
+        setattr(owner, attr, timed)
+
+    def report(self, wall: float) -> Dict[str, Dict[str, float]]:
+        result = {}
+        for stage, samples in self.samples.items():
+            ordered = sorted(samples)
+            result[stage] = {
+                "n": len(ordered),
+                "throughput": len(ordered) / wall if wall > 0 else 0.0,
+                "mean_ms": statistics.mean(ordered) * 1000,
+                "p50_ms": ordered[len(ordered) // 2] * 1000,
+                "p99_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000,
+            }
+        return result
+
+
+def build_script() -> FakeScript:
+    """脚本：搜索请求返回 web_search 调用，回忆请求返回 get_relevant_memories 调用，工具结果之后给出最终回复"""
+    script = FakeScript(["嗯，这个问题我是这么看的：先把最关键的约束找出来，再决定下一步。"])
+    script.add_rule("工具执行结果", "根据刚才查到的信息，结论是：先做最小可行的验证，再扩大范围。")
+    script.add_rule("工具执行失败", "工具暂时不可用，我先根据已有信息回答。")
+    script.add_rule("请帮我搜索", lambda messages: function_call_block(
+        "web_search", "我查一下。\n", search_input="最新的相关资料"))
+    script.add_rule("还记得", lambda messages: function_call_block(
+        "get_relevant_memories", "我回忆一下。\n", user_input="之前聊过的话题"))
+    return script
+
+
+def user_message(i: int) -> str:
+    kind = i % 3
+    if kind == 0:
+        return f"请帮我搜索一下第{i}个问题的资料"
+    if kind == 1:
+        return f"你还记得我们之前聊的第{i}件事吗"
+    return f"随便聊聊，第{i}句话"
+
+
+def run_agent_turns(recorder: StageRecorder, turns: int, concurrency: int, turns_per_agent: int,
+                    layout: str = "legacy") -> None:
+    from core import agent as agent_module
+    from core.agent import Agent
+    from core.context import ContextBuilder
+
+    recorder.wrap(ContextBuilder, "create_context_from_state", "context.build")
+    recorder.wrap(agent_module, "llm_call", "llm.call")
+    recorder.wrap(Agent, "_execute_calls", "tool.exec")
+
+    def conversation(start: int) -> None:
+        agent = Agent(max_context_length=10 ** 9, context_layout=layout)
+        for i in range(start, min(start + turns_per_agent, turns)):
+            with recorder.time("agent.turn"):
+                agent.process_single_message(user_message(i))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(conversation, range(0, turns, turns_per_agent)))
+
+
+def run_memory(recorder: StageRecorder, memory_system, writes: int, reads: int, concurrency: int) -> None:
+    def write(i: int) -> None:
+        states = [
+            {"content": f"用户说：我最近在研究第{i}个主题，想把它做成一个小工具。"},
+            {"content": f"我回复：可以先从第{i}个主题里最小的一个场景开始。"},
+        ]
+        with recorder.time("memory.write"):
+            memory_system.update_memory(states, user_id="bench", force_process=True)
+
+    def read(i: int) -> None:
+        with recorder.time("memory.read"):
+            memory_system.get_relevant_memories(f"第{i % max(1, writes)}个主题", user_id="bench")
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(write, range(writes)))
+        list(pool.map(read, range(reads)))
+
+
+def print_report(title: str, report: Dict[str, Dict[str, float]]) -> None:
+    print(f"\n=== {title} ===")
+    print(f"{'stage':<15}{'n':>6}{'ops/s':>10}{'mean':>10}{'p50':>10}{'p99':>10}")
+    for stage, r in sorted(report.items()):
+        print(f"{stage:<15}{r['n']:>6}{r['throughput']:>10.1f}{r['mean_ms']:>9.1f}ms"
+              f"{r['p50_ms']:>8.1f}ms{r['p99_ms']:>8.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="端到端基准测试（本地替身服务）")
+    parser.add_argument("--turns", type=int, default=30, help="Agent 对话轮数")
+    parser.add_argument("--turns-per-agent", type=int, default=6, help="每个 Agent 实例连续处理的轮数")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--memory-writes", type=int, default=20)
+    parser.add_argument("--memory-reads", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.05, help="替身服务首包延迟（秒）")
+    parser.add_argument("--tps", type=float, default=200.0, help="替身服务输出速率（tokens/s）")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--layout", choices=["legacy", "stable"], default="legacy", help="上下文布局")
+    parser.add_argument("--json", help="把结果写入 JSON 文件")
+    parser.add_argument("--verbose", action="store_true", help="显示 Agent 和记忆系统的日志")
+    args = parser.parse_args()
+
+    storage_dir = tempfile.mkdtemp(prefix="bench_memory_")
+    server = FakeOpenAIServer(build_script(), latency=args.latency, tokens_per_second=args.tps,
+                              error_rate=args.error_rate).start()
+    ClientManager.set_backend(server.url)
+    disable_response_cache()
+    llm_client.enable_telemetry()
+    AIConfig.EMBEDDING_CACHE_ENABLED = False
+
+    import memory_system
+    from memory_system import MemoryConfig
+    # 在 Agent 导入工具之前初始化全局记忆系统，使其写入临时目录并使用注入的客户端
+    memory = memory_system.get_memory_system(MemoryConfig(STORAGE_DIR=storage_dir), llm_client=AIChat())
+
+    results = {}
+    log = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    try:
+        with log:
+            recorder = StageRecorder()
+            start = time.perf_counter()
+            run_agent_turns(recorder, args.turns, args.concurrency, args.turns_per_agent, args.layout)
+            results["agent"] = recorder.report(time.perf_counter() - start)
+
+            recorder = StageRecorder()
+            start = time.perf_counter()
+            run_memory(recorder, memory, args.memory_writes, args.memory_reads, args.concurrency)
+            results["memory"] = recorder.report(time.perf_counter() - start)
+    finally:
+        server.stop()
+        ClientManager.clear_backend()
+        memory_system.shutdown_background_loop()
+        shutil.rmtree(storage_dir, ignore_errors=True)
+
+    print_report("Agent", results["agent"])
+    print_report("Memory", results["memory"])
+    results["server"] = server.stats()
+    results["llm"] = llm_client.get_telemetry_stats()
+    print(f"\n替身服务: {json.dumps(results['server'], ensure_ascii=False)}")
+    total = results["llm"].get("total")
+    if total:
+        print(f"前缀缓存命中率（cached_tokens / prompt_tokens）: {total['cached_token_ratio']:.1%}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2, default=str)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+事件日志基准测试 - 对比复制列表的 reducer 与结构共享的 EventLog
+
+每追加一个事件读取一次状态（与 Agent 每轮迭代构建上下文的模式一致）：
+    list      旧实现：reducer 返回 events + [event]，get_state 返回 events.copy()，O(n) / 次
+    eventlog  EventLog：追加和快照都是 O(1)
+另外测量分叉后在分支上追加的开销。
+
+用法：
+    python benchmarks/bench_event_log.py --events 100000
+旧实现是 O(n²)，事件数较大时可用 --baseline-events 只跑前一部分。
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.state import Event, EventTypes, StateManager
+
+
+class ListStateManager:
+    """旧实现：每次追加复制整个列表，每次读取再复制一次"""
+
+    def __init__(self):
+        self.events: List[Event] = []
+
+    def reducer(self, new_event: Event) -> List[Event]:
+        return self.events + [new_event]
+
+    def add_event(self, event_type: str, data: Dict[str, Any]) -> None:
+        event = Event(type=event_type, timestamp=datetime.now(), data=data)
+        self.events = self.reducer(event)
+
+    def get_state(self) -> List[Event]:
+        return self.events.copy()
+
+
+def run(manager, n: int) -> Dict[str, float]:
+    tracemalloc.start()
+    start = time.perf_counter()
+    for i in range(n):
+        manager.add_event(EventTypes.USER_MESSAGE, {"content": f"第{i}条消息"})
+        manager.get_state()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"events": n, "seconds": elapsed, "us_per_event": elapsed / n * 1e6, "peak_mb": peak / 1024 / 1024}
+
+
+def run_fork(n: int, branches: int, per_branch: int) -> Dict[str, float]:
+    """在 n 个事件的会话上分出多个分支，各自追加 per_branch 个事件"""
+    base = StateManager()
+    for i in range(n):
+        base.add_event(EventTypes.USER_MESSAGE, {"content": f"第{i}条消息"})
+    start = time.perf_counter()
+    forks = [base.fork() for _ in range(branches)]
+    fork_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for b, branch in enumerate(forks):
+        for i in range(per_branch):
+            branch.add_event(EventTypes.AGENT_MESSAGE, {"content": f"分支{b}-{i}"})
+    append_seconds = time.perf_counter() - start
+    assert len(base.get_state()) == n and all(len(f.get_state()) == n + per_branch for f in forks)
+    return {"fork_us": fork_seconds / branches * 1e6,
+            "branch_append_us": append_seconds / (branches * per_branch) * 1e6}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="事件日志基准测试")
+    parser.add_argument("--events", type=int, default=100000)
+    parser.add_argument("--baseline-events", type=int, default=None, help="旧实现追加的事件数（默认同 --events）")
+    parser.add_argument("--branches", type=int, default=100)
+    parser.add_argument("--per-branch", type=int, default=100)
+    args = parser.parse_args()
+
+    baseline_n = args.baseline_events or args.events
+    print(f"{'impl':<10}{'events':>10}{'total':>10}{'per event':>12}{'peak mem':>12}")
+    for name, manager, n in (("list", ListStateManager(), baseline_n), ("eventlog", StateManager(), args.events)):
+        r = run(manager, n)
+        print(f"{name:<10}{r['events']:>10}{r['seconds']:>9.2f}s{r['us_per_event']:>10.2f}us{r['peak_mb']:>10.1f}MB")
+
+    r = run_fork(args.events, args.branches, args.per_branch)
+    print(f"\n分叉 {args.branches} 个分支: {r['fork_us']:.2f}us/次，"
+          f"分支上追加（含首次复制）: {r['branch_append_us']:.2f}us/事件")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+事件日志持久化基准测试 - 分组提交的写入吞吐、恢复耗时（快照 + 尾部 vs 从头回放）、空闲会话的常驻内存
+
+模拟一个长会话：每 --compact-every 个事件推进一次压缩水位（与 ContextBuilder 截断历史时一致），
+水位之前的事件换出内存，只留在日志文件里。
+
+用法：
+    python benchmarks/bench_journal.py --events 50000
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.journal import EventJournal
+from core.state import EventTypes, StateManager
+
+
+def write_session(directory: str, n: int, compact_every: int, live: int, snapshot_every: int, fsync: bool) -> dict:
+    journal = EventJournal(directory, "bench", fsync=fsync, snapshot_every=snapshot_every)
+    manager = StateManager.open(journal)
+    start = time.perf_counter()
+    for i in range(n):
+        event_type = EventTypes.USER_MESSAGE if i % 2 == 0 else EventTypes.AGENT_MESSAGE
+        manager.add_event(event_type, {"content": f"第{i}条消息：" + "这是一段对话内容。" * 20})
+        if i and i % compact_every == 0 and i > live:
+            manager.compact(i - live, key=f"k{i}")
+    journal.flush()
+    elapsed = time.perf_counter() - start
+    manager.snapshot()
+    journal.close()
+    stats = journal.stats
+    return {
+        "seconds": elapsed,
+        "events_per_sec": n / elapsed,
+        "commits": stats["commits"],
+        "events_per_commit": stats["events"] / max(1, stats["commits"]),
+        "fsync_seconds": stats["fsync_seconds"],
+        "mb": stats["bytes"] / 1024 / 1024,
+    }
+
+
+def resume(directory: str, use_snapshot: bool) -> dict:
+    journal = EventJournal(directory, "bench")
+    snapshot_backup = journal.snapshot_path + ".bak"
+    if not use_snapshot and os.path.exists(journal.snapshot_path):
+        os.replace(journal.snapshot_path, snapshot_backup)
+    try:
+        tracemalloc.start()
+        start = time.perf_counter()
+        manager = StateManager.open(journal)
+        elapsed = time.perf_counter() - start
+        resident, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result = {"seconds": elapsed, "replayed": journal.stats["resume_replayed"],
+                  "events": len(manager.events), "cold": manager.events.cold_count,
+                  "resident_mb": resident / 1024 / 1024}
+        journal.close()
+        return result
+    finally:
+        if os.path.exists(snapshot_backup):
+            os.replace(snapshot_backup, journal.snapshot_path)
+
+
+def resident_without_spill(directory: str) -> float:
+    """旧行为：所有事件常驻内存"""
+    journal = EventJournal(directory, "bench")
+    tracemalloc.start()
+    events = journal.load()
+    events = list(events)
+    resident, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    journal.close()
+    return resident / 1024 / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description="事件日志持久化基准测试")
+    parser.add_argument("--events", type=int, default=50000)
+    parser.add_argument("--compact-every", type=int, default=200)
+    parser.add_argument("--live", type=int, default=100, help="压缩后保留在上下文中的事件数")
+    parser.add_argument("--snapshot-every", type=int, default=1000)
+    parser.add_argument("--no-fsync", action="store_true")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="bench_journal_")
+    try:
+        w = write_session(directory, args.events, args.compact_every, args.live, args.snapshot_every,
+                          not args.no_fsync)
+        print(f"写入 {args.events} 个事件: {w['seconds']:.2f}s（{w['events_per_sec']:.0f} 个/s），"
+              f"{w['commits']} 次提交（平均 {w['events_per_commit']:.1f} 个/次），"
+              f"fsync 共 {w['fsync_seconds']:.2f}s，日志 {w['mb']:.1f}MB")
+
+        full = resume(directory, use_snapshot=False)
+        fast = resume(directory, use_snapshot=True)
+        print(f"\n{'resume':<18}{'time':>10}{'replayed':>10}{'cold':>10}{'resident':>12}")
+        for name, r in (("从头回放", full), ("快照 + 尾部", fast)):
+            print(f"{name:<14}{r['seconds'] * 1000:>12.1f}ms{r['replayed']:>10}{r['cold']:>10}{r['resident_mb']:>10.1f}MB")
+        print(f"\n全部常驻内存（不换出）: {resident_without_spill(directory):.1f}MB")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+记忆预取基准测试 - 比较 Agent 关闭和开启 prefetch_memories 时的轮次延迟
+
+回忆类消息（"你还记得……"）会让替身模型调用 get_relevant_memories，查询取自用户消息；其余消息直接回复，
+它们的预取就是浪费。记忆检索额外加上 --retrieval-latency 秒的延迟，模拟真实的向量库/远端检索。
+开启预取后，检索和第一次 LLM 调用重叠，工具阶段只需等待剩余部分。
+
+用法：
+    python benchmarks/bench_prefetch.py --turns 40 --recall-ratio 0.5 --latency 0.2 --retrieval-latency 0.15
+"""
+import argparse
+import contextlib
+import io
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.bench_e2e import StageRecorder
+from benchmarks.fake_openai_server import FakeOpenAIServer, FakeScript, function_call_block, last_line
+from llm.llm_client import AIChat, AIConfig, ClientManager, disable_response_cache
+
+
+def build_script() -> FakeScript:
+    """回忆类消息返回 get_relevant_memories 调用（查询是用户消息去掉"你还记得"），工具结果之后给出最终回复"""
+    script = FakeScript(["嗯，我明白你的意思了。"])
+    script.add_rule("工具执行结果", "想起来了，我们上次确实聊过这件事。")
+    script.add_rule("还记得", lambda messages: function_call_block(
+        "get_relevant_memories", "我回忆一下。\n", user_input=re.sub(r"^.*?还记得", "", last_line(messages))))
+    return script
+
+
+def user_message(i: int, recall_ratio: float) -> str:
+    if (i * recall_ratio) % 1 + recall_ratio >= 1:
+        return f"你还记得我们上次聊的第{i}个项目的进度吗"
+    return f"今天先随便聊聊第{i}件小事"
+
+
+def seed_memories(memory, sessions: int) -> None:
+    from datetime import datetime
+    from memory_system.Item import MemoryItem
+
+    for s in range(sessions):
+        for i in range(10):
+            memory.store.save_short_term_memory(MemoryItem(
+                id=f"m{s}-{i}", content=f"用户提到第{i}个项目的进度已经过半，下周评审。",
+                timestamp=datetime.now(), hp=3, embedding=[], user_id=f"user{s}"))
+
+
+def run(turns: int, sessions: int, recall_ratio: float, prefetch: bool) -> Dict[str, Dict[str, float]]:
+    from core.agent import Agent
+    from tools import get_tool_cache
+
+    get_tool_cache().clear()
+    recorder = StageRecorder()
+    execute_calls = Agent._execute_calls
+    recorder.wrap(Agent, "_execute_calls", "tool.exec")
+    per_session = (turns + sessions - 1) // sessions
+
+    def conversation(s: int) -> None:
+        agent = Agent(max_context_length=10 ** 9, user_id=f"user{s}", prefetch_memories=prefetch)
+        for i in range(s * per_session, min((s + 1) * per_session, turns)):
+            with recorder.time("agent.turn"):
+                agent.process_single_message(user_message(i, recall_ratio))
+        agent.close()
+
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=sessions) as pool:
+            list(pool.map(conversation, range(sessions)))
+    finally:
+        Agent._execute_calls = execute_calls
+    return recorder.report(time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="记忆预取基准测试（本地替身服务）")
+    parser.add_argument("--turns", type=int, default=40)
+    parser.add_argument("--sessions", type=int, default=4, help="并发会话数（每个会话一个线程）")
+    parser.add_argument("--recall-ratio", type=float, default=0.5, help="回忆类消息的比例")
+    parser.add_argument("--latency", type=float, default=0.2, help="替身服务首包延迟（秒）")
+    parser.add_argument("--tps", type=float, default=200.0, help="替身服务输出速率（tokens/s）")
+    parser.add_argument("--retrieval-latency", type=float, default=0.15, help="每次记忆检索额外的延迟（秒）")
+    parser.add_argument("--verbose", action="store_true", help="显示 Agent 的日志")
+    args = parser.parse_args()
+
+    storage_dir = tempfile.mkdtemp(prefix="bench_prefetch_")
+    server = FakeOpenAIServer(build_script(), latency=args.latency, tokens_per_second=args.tps).start()
+    ClientManager.set_backend(server.url)
+    disable_response_cache()
+    AIConfig.EMBEDDING_CACHE_ENABLED = False
+
+    import memory_system
+    from memory_system import MemoryConfig
+    from memory_system.interface import MemorySystem
+    memory = memory_system.get_memory_system(MemoryConfig(STORAGE_DIR=storage_dir), llm_client=AIChat())
+    seed_memories(memory, args.sessions)
+
+    retrieve = MemorySystem.get_relevant_memories
+
+    def slow_retrieve(self, user_input: str, user_id: str = "default") -> str:
+        time.sleep(args.retrieval_latency)
+        return retrieve(self, user_input, user_id)
+
+    MemorySystem.get_relevant_memories = slow_retrieve
+
+    from core.prefetch import get_prefetch_stats
+    results: Dict[str, Any] = {}
+    log = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    try:
+        with log:
+            # 预热：分词词典、TF-IDF 等首次加载不计入结果
+            memory.get_relevant_memories("预热", user_id="user0")
+            for mode, prefetch in (("off", False), ("on", True)):
+                results[mode] = run(args.turns, args.sessions, args.recall_ratio, prefetch)
+    finally:
+        MemorySystem.get_relevant_memories = retrieve
+        server.stop()
+        ClientManager.clear_backend()
+        memory_system.shutdown_background_loop()
+        shutil.rmtree(storage_dir, ignore_errors=True)
+
+    print(f"{args.turns} 轮，{args.sessions} 个会话，回忆类消息 {args.recall_ratio:.0%}，"
+          f"检索延迟 {args.retrieval_latency * 1000:.0f}ms")
+    print(f"\n{'prefetch':<10}{'turn p50':>10}{'turn p99':>10}{'tool p50':>10}{'tool p99':>10}")
+    for mode, report in results.items():
+        turn, tool = report["agent.turn"], report["tool.exec"]
+        print(f"{mode:<10}{turn['p50_ms']:>8.0f}ms{turn['p99_ms']:>8.0f}ms"
+              f"{tool['p50_ms']:>8.0f}ms{tool['p99_ms']:>8.0f}ms")
+    stats = get_prefetch_stats()
+    print(f"\n预取: 启动 {stats['started']}，命中 {stats['hits']}（已就绪 {stats['ready_hits']}），"
+          f"查询不相近 {stats['mismatches']}，过期 {stats['stale']}，浪费 {stats['wasted']}"
+          f"（{stats['waste_rate']:.0%}），跳过 {stats['skipped']}")
+
+
+if __name__ == "__main__":
+    main()
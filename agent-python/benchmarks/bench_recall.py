@@ -0,0 +1,134 @@
+"""
+自动回忆基准测试 - 比较只靠 get_relevant_memories 工具回忆 vs 开启 pre_retrieval（第一次 LLM 调用前自动检索）
+
+替身模型的行为：回忆类消息在上下文里没有自动回忆段时调用 get_relevant_memories，拿到工具结果后再回复；
+有自动回忆段时直接回复。一半回忆类消息问的是记忆里有的内容（项目进度），另一半问的内容记忆里没有，
+检索分数达不到阈值，不会注入，模型照常调用工具。统计每轮的 LLM 调用次数、轮次延迟和自动回忆的命中情况。
+
+用法：
+    python benchmarks/bench_recall.py --turns 40 --recall-ratio 0.5 --latency 0.2
+"""
+import argparse
+import contextlib
+import io
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.bench_e2e import StageRecorder
+from benchmarks.bench_prefetch import seed_memories
+from benchmarks.fake_openai_server import FakeOpenAIServer, FakeScript, function_call_block
+from llm.llm_client import AIChat, AIConfig, ClientManager, disable_response_cache
+
+
+def build_script() -> FakeScript:
+    from core.recall import RECALL_HEADER
+
+    def reply(messages: List[Dict[str, Any]]) -> str:
+        content = str(messages[-1].get("content") or "") if messages else ""
+        history, _, recalled = content.partition(RECALL_HEADER)
+        lines = [line for line in history.splitlines() if line.strip()]
+        line = lines[-1] if lines else ""
+        if "工具执行结果" in line:
+            return "想起来了，我们上次确实聊过这件事。"
+        if "还记得" not in line:
+            return "嗯，我明白你的意思了。"
+        if recalled.strip():
+            return "记得，上次你说进度已经过半，下周评审。"
+        return function_call_block("get_relevant_memories", "我回忆一下。\n",
+                                   user_input=re.sub(r"^.*?还记得", "", line))
+
+    return FakeScript([reply])
+
+
+def user_message(i: int, recall_ratio: float) -> str:
+    if (i * recall_ratio) % 1 + recall_ratio < 1:
+        return f"今天先随便聊聊第{i}件小事"
+    if i % 4 < 2:
+        return f"你还记得我们上次聊的第{i % 10}个项目的进度吗"
+    return "你还记得我养的猫叫什么名字吗"
+
+
+def run(server: FakeOpenAIServer, turns: int, sessions: int, recall_ratio: float,
+        pre_retrieval: bool) -> Dict[str, Any]:
+    from core.agent import Agent
+
+    recorder = StageRecorder()
+    per_session = (turns + sessions - 1) // sessions
+    chat_before = server.stats()["chat"]
+
+    def conversation(s: int) -> None:
+        agent = Agent(max_context_length=10 ** 9, user_id=f"user{s}", context_layout="stable",
+                      pre_retrieval=pre_retrieval)
+        for i in range(s * per_session, min((s + 1) * per_session, turns)):
+            with recorder.time("agent.turn"):
+                agent.process_single_message(user_message(i, recall_ratio))
+        agent.close()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=sessions) as pool:
+        list(pool.map(conversation, range(sessions)))
+    report = recorder.report(time.perf_counter() - start)
+    report["llm_calls"] = server.stats()["chat"] - chat_before
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="自动回忆基准测试（本地替身服务）")
+    parser.add_argument("--turns", type=int, default=40)
+    parser.add_argument("--sessions", type=int, default=4, help="并发会话数（每个会话一个线程）")
+    parser.add_argument("--recall-ratio", type=float, default=0.5, help="回忆类消息的比例")
+    parser.add_argument("--latency", type=float, default=0.2, help="替身服务首包延迟（秒）")
+    parser.add_argument("--tps", type=float, default=200.0, help="替身服务输出速率（tokens/s）")
+    parser.add_argument("--verbose", action="store_true", help="显示 Agent 的日志")
+    args = parser.parse_args()
+
+    storage_dir = tempfile.mkdtemp(prefix="bench_recall_")
+    server = FakeOpenAIServer(build_script(), latency=args.latency, tokens_per_second=args.tps).start()
+    ClientManager.set_backend(server.url)
+    disable_response_cache()
+    AIConfig.EMBEDDING_CACHE_ENABLED = False
+
+    import memory_system
+    from memory_system import MemoryConfig
+    memory = memory_system.get_memory_system(MemoryConfig(STORAGE_DIR=storage_dir), llm_client=AIChat())
+    seed_memories(memory, args.sessions)
+
+    from core.recall import get_recall_stats
+    results: Dict[str, Dict[str, Any]] = {}
+    log = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    try:
+        with log:
+            # 预热：分词词典等首次加载不计入结果
+            memory.search_memories("预热", user_id="user0")
+            for mode, pre_retrieval in (("tool", False), ("recall", True)):
+                results[mode] = run(server, args.turns, args.sessions, args.recall_ratio, pre_retrieval)
+    finally:
+        server.stop()
+        ClientManager.clear_backend()
+        memory_system.shutdown_background_loop()
+        shutil.rmtree(storage_dir, ignore_errors=True)
+
+    print(f"{args.turns} 轮，{args.sessions} 个会话，回忆类消息 {args.recall_ratio:.0%}")
+    print(f"\n{'mode':<8}{'LLM/turn':>10}{'turn p50':>10}{'turn p99':>10}{'mean':>10}")
+    for mode, report in results.items():
+        turn = report["agent.turn"]
+        print(f"{mode:<8}{report['llm_calls'] / turn['n']:>10.2f}{turn['p50_ms']:>8.0f}ms"
+              f"{turn['p99_ms']:>8.0f}ms{turn['mean_ms']:>8.0f}ms")
+    stats = get_recall_stats()
+    mean_search = f"{stats['mean_search_ms']:.1f}ms" if stats["mean_search_ms"] is not None else "-"
+    print(f"\n自动回忆: 检索 {stats['turns']} 次（平均 {mean_search}），注入 {stats['injected']}，"
+          f"低于阈值 {stats['below_threshold']}，超时 {stats['timeouts']}；"
+          f"注入后仍调用工具 {stats['tool_calls_after_recall']}，未注入而调用工具 {stats['tool_calls_without_recall']}，"
+          f"省掉来回 {stats['saved_round_trips']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+服务模式基准测试 - 通过 HTTP 驱动 server.py，测量多会话负载下的吞吐、p50/p99 轮次延迟和常驻会话数
+
+服务端（AgentServer + SessionManager）跑在独立线程的事件循环上，LLM 由本地替身服务模拟；
+客户端按 --concurrency 并发向 --sessions 个会话各发 --turns-per-session 条消息，
+收到 429 时按 Retry-After 退避重试。--max-resident 小于会话数时会触发 LRU 换出和恢复。
+
+用法：
+    python benchmarks/bench_server.py --sessions 500 --turns-per-session 3 --concurrency 100 --max-resident 200
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+
+from benchmarks.bench_e2e import build_script, user_message
+from benchmarks.fake_openai_server import FakeOpenAIServer
+from llm import llm_client
+from llm.llm_client import AIChat, AIConfig, ClientManager, disable_response_cache
+
+
+def rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class ServerThread:
+    """在独立线程的事件循环上运行 AgentServer"""
+
+    def __init__(self, config):
+        from core.session import SessionManager
+        from server import AgentServer
+
+        self.server = AgentServer(SessionManager(config), port=0)
+        self.loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="agent-server", daemon=True)
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.server.start())
+        self._ready.set()
+        self.loop.run_forever()
+
+    def start(self) -> "ServerThread":
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.port}"
+
+    def stats(self) -> Dict[str, Any]:
+        return self.server.manager.get_stats()
+
+    def stop(self) -> None:
+        asyncio.run_coroutine_threadsafe(self.server.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+
+async def drive(url: str, sessions: int, turns: int, concurrency: int) -> Dict[str, Any]:
+    latencies: List[float] = []
+    counters = {"busy": 0, "errors": 0}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    gate = asyncio.Semaphore(concurrency)
+
+    async def send(client: httpx.AsyncClient, session_id: str, message: str) -> None:
+        while True:
+            async with gate:
+                start = time.perf_counter()
+                response = await client.post(f"/v1/sessions/{session_id}/messages",
+                                             json={"message": message, "user_id": f"user-{session_id}"})
+            if response.status_code == 429:
+                counters["busy"] += 1
+                await asyncio.sleep(float(response.headers.get("retry-after", 1)) * random.uniform(0.1, 0.5))
+                continue
+            if response.status_code != 200:
+                counters["errors"] += 1
+            else:
+                latencies.append(time.perf_counter() - start)
+            return
+
+    async def conversation(client: httpx.AsyncClient, index: int) -> None:
+        for turn in range(turns):
+            await send(client, f"bench{index}", user_message(index * turns + turn))
+
+    start = time.perf_counter()
+    async with httpx.AsyncClient(base_url=url, timeout=300, limits=limits) as client:
+        await asyncio.gather(*(conversation(client, i) for i in range(sessions)))
+    wall = time.perf_counter() - start
+    ordered = sorted(latencies)
+    return {
+        "turns": len(ordered),
+        "wall": wall,
+        "turns_per_sec": len(ordered) / wall if wall else 0.0,
+        "p50_ms": ordered[len(ordered) // 2] * 1000 if ordered else None,
+        "p99_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000 if ordered else None,
+        **counters,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="服务模式基准测试（本地替身服务）")
+    parser.add_argument("--sessions", type=int, default=200)
+    parser.add_argument("--turns-per-session", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=64, help="客户端同时在途的请求数")
+    parser.add_argument("--max-resident", type=int, default=100, help="服务端常驻会话上限")
+    parser.add_argument("--max-active", type=int, default=64, help="服务端同时处理的轮次上限")
+    parser.add_argument("--max-waiting", type=int, default=64, help="服务端排队上限，超出返回 429")
+    parser.add_argument("--latency", type=float, default=0.2, help="替身服务首包延迟（秒）")
+    parser.add_argument("--tps", type=float, default=500.0, help="替身服务输出速率（tokens/s）")
+    parser.add_argument("--fsync", action="store_true", help="会话日志每次提交都 fsync")
+    parser.add_argument("--verbose", action="store_true", help="显示服务端日志")
+    args = parser.parse_args()
+
+    storage_dir = tempfile.mkdtemp(prefix="bench_server_")
+    fake = FakeOpenAIServer(build_script(), latency=args.latency, tokens_per_second=args.tps).start()
+    ClientManager.set_backend(fake.url)
+    disable_response_cache()
+    AIConfig.EMBEDDING_CACHE_ENABLED = False
+    # provider 并发窗口跟随服务端的轮次上限，只测服务本身
+    AIConfig.HTTP_MAX_CONNECTIONS = max(AIConfig.HTTP_MAX_CONNECTIONS, args.max_active)
+    llm_client._ai_chat.rate_limits.initial_concurrency = args.max_active
+    llm_client._ai_chat.rate_limits.max_concurrency = args.max_active
+
+    import memory_system
+    from memory_system import MemoryConfig
+    from core.session import SessionConfig
+    memory_system.get_memory_system(MemoryConfig(STORAGE_DIR=os.path.join(storage_dir, "memory")),
+                                    llm_client=AIChat())
+
+    config = SessionConfig(storage_dir=os.path.join(storage_dir, "sessions"),
+                           max_resident_sessions=args.max_resident,
+                           max_active_turns=args.max_active,
+                           max_waiting_turns=args.max_waiting,
+                           max_context_length=10 ** 6,
+                           fsync=args.fsync)
+    rss_before = rss_mb()
+    log = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    try:
+        with log:
+            server = ServerThread(config).start()
+            try:
+                result = asyncio.run(drive(server.url, args.sessions, args.turns_per_session, args.concurrency))
+                stats = server.stats()
+            finally:
+                server.stop()
+    finally:
+        fake.stop()
+        ClientManager.clear_backend()
+        memory_system.shutdown_background_loop()
+        shutil.rmtree(storage_dir, ignore_errors=True)
+
+    print(f"会话 {args.sessions} 个 × {args.turns_per_session} 轮，客户端并发 {args.concurrency}，"
+          f"常驻上限 {args.max_resident}")
+    print(f"吞吐: {result['turns_per_sec']:.1f} 轮/s（{result['turns']} 轮 / {result['wall']:.1f}s）")
+    print(f"客户端延迟: p50 {result['p50_ms']:.0f}ms, p99 {result['p99_ms']:.0f}ms；"
+          f"429 {result['busy']} 次，错误 {result['errors']} 次")
+    print(f"服务端: p50 {stats['p50_latency'] * 1000:.0f}ms, p99 {stats['p99_latency'] * 1000:.0f}ms，"
+          f"峰值常驻 {stats['peak_resident']}，新建 {stats['created']}，"
+          f"换出 {stats['evicted']}，恢复 {stats['rehydrated']}，拒绝 {stats['rejected']}")
+    print(f"进程峰值内存: {rss_mb():.0f}MB（启动服务前 {rss_before:.0f}MB）")
+
+
+if __name__ == "__main__":
+    main()
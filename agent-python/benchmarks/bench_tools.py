@@ -0,0 +1,135 @@
+"""
+工具执行基准测试 - 同一个 <function_calls> 块里的多个工具调用：逐个执行 vs ToolRegistry 并发执行
+
+工具用固定延迟模拟（同步工具 sleep，异步工具 asyncio.sleep），逐个执行的耗时是各调用延迟之和，
+并发执行的耗时应接近其中最慢的一个（parallel_safe=False 的调用仍单独成组、按顺序执行）。
+cached 模式把可并行的工具标记为可缓存，并在每轮的参数里只用 --distinct 个不同查询，模拟模型在多次迭代中重复查询。
+
+用法：
+    python benchmarks/bench_tools.py --calls 4 --latency 0.2 --rounds 5 --distinct 2
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import time
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.base import BaseTool, ParameterSchema
+from tools.cache import get_tool_cache, get_tool_cache_stats
+from tools.registry import ToolRegistry
+
+
+class SleepTool(BaseTool):
+    """同步工具：阻塞等待固定延迟（模拟网络请求、记忆检索）"""
+
+    def __init__(self, name: str, latency: float):
+        self.name = name
+        self.latency = latency
+
+    def get_name(self) -> str:
+        return self.name
+
+    def get_description(self) -> str:
+        return f"等待 {self.latency}s"
+
+    def get_parameters(self) -> List[ParameterSchema]:
+        return []
+
+    def execute(self, parameters: Dict[str, Any]) -> Dict[str, Any]:
+        time.sleep(self.latency)
+        return {"success": True}
+
+
+class AsyncSleepTool(SleepTool):
+    """异步工具：在事件循环上等待固定延迟"""
+
+    async def aexecute(self, parameters: Dict[str, Any]) -> Dict[str, Any]:
+        await asyncio.sleep(self.latency)
+        return {"success": True}
+
+
+class SerialSleepTool(SleepTool):
+    """不可并行的工具"""
+
+    parallel_safe = False
+
+
+class CachedSleepTool(SleepTool):
+    """可缓存的工具"""
+
+    cacheable = True
+
+
+def build_registry(latency: float) -> ToolRegistry:
+    registry = ToolRegistry()
+    with contextlib.redirect_stdout(io.StringIO()):
+        registry.register(SleepTool("sleep", latency))
+        registry.register(AsyncSleepTool("async_sleep", latency))
+        registry.register(SerialSleepTool("serial_sleep", latency))
+        registry.register(CachedSleepTool("cached_sleep", latency))
+    return registry
+
+
+def build_calls(calls: int, serial: int) -> List[Dict[str, Any]]:
+    names = ["sleep" if i % 2 == 0 else "async_sleep" for i in range(calls)]
+    names += ["serial_sleep"] * serial
+    return [{"tool_name": name, "parameters": {}} for name in names]
+
+
+def build_cached_calls(calls: int, distinct: int, round_index: int) -> List[Dict[str, Any]]:
+    return [{"tool_name": "cached_sleep", "parameters": {"query": f"q{(round_index * calls + i) % distinct}"}}
+            for i in range(calls)]
+
+
+def timed(fn, rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - start) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="工具并发执行基准测试")
+    parser.add_argument("--calls", type=int, default=4, help="每轮可并行的调用数")
+    parser.add_argument("--serial", type=int, default=0, help="每轮追加的不可并行调用数")
+    parser.add_argument("--latency", type=float, default=0.2, help="每个调用的延迟（秒）")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--distinct", type=int, default=2, help="cached 模式下不同查询的个数")
+    args = parser.parse_args()
+
+    registry = build_registry(args.latency)
+    calls = build_calls(args.calls, args.serial)
+
+    def sequential() -> None:
+        for call in calls:
+            registry.get_tool(call["tool_name"]).execute(call["parameters"])
+
+    rounds = iter(range(args.rounds))
+
+    def cached() -> None:
+        registry.execute_function_calls(build_cached_calls(args.calls, args.distinct, next(rounds)))
+
+    get_tool_cache().clear()
+    results = {
+        "sequential": timed(sequential, args.rounds),
+        "threads": timed(lambda: registry.execute_function_calls(calls), args.rounds),
+        "async": timed(lambda: asyncio.run(registry.aexecute_function_calls(calls)), args.rounds),
+        "cached": timed(cached, args.rounds),
+    }
+
+    print(f"{len(calls)} 个调用（不可并行 {args.serial} 个），每个 {args.latency * 1000:.0f}ms")
+    print(f"\n{'mode':<12}{'per block':>12}{'speedup':>10}")
+    for mode, elapsed in results.items():
+        print(f"{mode:<12}{elapsed * 1000:>10.0f}ms{results['sequential'] / elapsed:>9.1f}x")
+    stats = get_tool_cache_stats()["tools"].get("cached_sleep", {})
+    print(f"\ncached: 命中 {stats.get('hits', 0)} 次，未命中 {stats.get('misses', 0)} 次，"
+          f"命中率 {stats.get('hit_rate', 0.0):.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+"""
+本地 OpenAI 兼容替身服务 - 无需 API Key 即可驱动 Agent、ContextBuilder 和记忆系统
+
+支持：
+- POST /v1/chat/completions（普通与 SSE 流式，含 stream_options.include_usage）
+- POST /v1/embeddings（按文本哈希生成的确定性向量）
+- 脚本化回复：按规则匹配最后一条消息的最后一行，可返回 <function_calls> 块
+- 可配置首包延迟、输出速率（tokens/s）、错误注入和前缀缓存模拟
+
+用法：
+    with FakeOpenAIServer(latency=0.2, tokens_per_second=80) as server:
+        ClientManager.set_backend(server.url)
+        ...
+或独立运行：
+    python benchmarks/fake_openai_server.py --port 8900 --latency 0.2 --tps 80
+"""
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Union
+
+Matcher = Union[str, Callable[[List[Dict[str, Any]]], bool]]
+Reply = Union[str, Callable[[List[Dict[str, Any]]], str]]
+
+_TOKEN_PATTERN = re.compile(r'[一-鿿]|[^\s一-鿿]+\s*|\s+')
+PREFIX_BLOCK_CHARS = 256  # 前缀缓存模拟的块大小（约 64 token）
+
+
+def split_tokens(text: str) -> List[str]:
+    """粗略切分 token：中文按字，其余按空白分词（含尾随空白）"""
+    return _TOKEN_PATTERN.findall(text)
+
+
+def function_call_block(tool_name: str, text_before: str = "", **parameters: Any) -> str:
+    """生成一段与 ContextBuilder 输出格式一致的工具调用回复"""
+    params = "\n".join(f'<parameter name="{k}">{v}</parameter>' for k, v in parameters.items())
+    return f'{text_before}<function_calls>\n<invoke name="{tool_name}">\n{params}\n</invoke>\n</function_calls>'
+
+
+def last_line(messages: List[Dict[str, Any]]) -> str:
+    """最后一条消息的最后一个非空行（Agent 的上下文把最新事件放在末尾）"""
+    if not messages:
+        return ""
+    content = messages[-1].get("content") or ""
+    lines = [line for line in str(content).splitlines() if line.strip()]
+    return lines[-1] if lines else ""
+
+
+class FakeScript:
+    """脚本化回复：按顺序匹配规则，都不匹配时轮流返回默认回复"""
+
+    def __init__(self, default_replies: Optional[List[Reply]] = None):
+        self.rules: List[tuple] = []
+        self.default_replies: List[Reply] = list(default_replies or ["好的，我明白了。"])
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def add_rule(self, matcher: Matcher, reply: Reply) -> "FakeScript":
+        """matcher 为字符串时匹配最后一行是否包含该子串，也可以传入 fn(messages) -> bool"""
+        self.rules.append((matcher, reply))
+        return self
+
+    def reply(self, messages: List[Dict[str, Any]]) -> str:
+        line = last_line(messages)
+        for matcher, reply in self.rules:
+            matched = matcher in line if isinstance(matcher, str) else matcher(messages)
+            if matched:
+                return reply(messages) if callable(reply) else reply
+        with self._lock:
+            reply = self.default_replies[self._next % len(self.default_replies)]
+            self._next += 1
+        return reply(messages) if callable(reply) else reply
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "_Server"
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json(200, {"object": "list", "data": [{"id": "fake", "object": "model"}]})
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        fake = self.server.fake
+
+        error = fake._maybe_error()
+        if error is not None:
+            self._send_json(error, {"error": {"message": "injected error", "type": "fake_error"}})
+            return
+
+        if self.path.endswith("/embeddings"):
+            self._send_json(200, fake._embeddings(body))
+        elif self.path.endswith("/chat/completions"):
+            self._chat(body)
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+
+    def _send_json(self, status: int, payload: Dict[str, Any]) -> None:
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        if status in (429, 503):
+            self.send_header("Retry-After", "0")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _chat(self, body: Dict[str, Any]) -> None:
+        fake = self.server.fake
+        messages = body.get("messages", [])
+        model = body.get("model", "fake")
+        text = fake.script.reply(messages)
+        tokens = split_tokens(text)
+        usage = fake._usage(messages, len(tokens))
+        fake._sleep(fake._first_byte_delay())
+
+        if not body.get("stream"):
+            fake._sleep(fake._generation_time(len(tokens)))
+            self._send_json(200, {
+                "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        per_token = 1.0 / fake.tokens_per_second if fake.tokens_per_second else 0.0
+        try:
+            for i in range(0, len(tokens), fake.tokens_per_chunk):
+                piece = "".join(tokens[i:i + fake.tokens_per_chunk])
+                self._sse(self._chunk(model, {"content": piece}))
+                fake._sleep(per_token * fake.tokens_per_chunk)
+            self._sse(self._chunk(model, {}, finish_reason="stop"))
+            include_usage = (body.get("stream_options") or {}).get("include_usage")
+            if include_usage:
+                self._sse({"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()),
+                           "model": model, "choices": [], "usage": usage})
+            self._write_chunk(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端提前断开（如 Agent 看到 </function_calls> 后停止生成）
+            fake._count("streams_aborted")
+
+    @staticmethod
+    def _chunk(model: str, delta: Dict[str, Any], finish_reason: Optional[str] = None) -> Dict[str, Any]:
+        return {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()),
+                "model": model, "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+
+    def _sse(self, payload: Dict[str, Any]) -> None:
+        self._write_chunk(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+    def _write_chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # 默认的 5 在上百个并发连接时会溢出，客户端要等 SYN 重传
+    fake: "FakeOpenAIServer"
+
+
+class FakeOpenAIServer:
+    """OpenAI 兼容的本地替身服务"""
+
+    def __init__(self, script: Optional[FakeScript] = None, host: str = "127.0.0.1", port: int = 0,
+                 latency: float = 0.0, latency_jitter: float = 0.0, tokens_per_second: Optional[float] = None,
+                 tokens_per_chunk: int = 1, error_rate: float = 0.0, error_status: int = 503,
+                 embedding_dim: int = 64, prefix_cache: bool = True, seed: int = 0):
+        self.script = script or FakeScript()
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.tokens_per_second = tokens_per_second
+        self.tokens_per_chunk = max(1, tokens_per_chunk)
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.embedding_dim = embedding_dim
+        self.prefix_cache = prefix_cache
+        self._random = random.Random(seed)
+        self._fail_next = 0
+        self._prefixes: set = set()
+        self._lock = threading.Lock()
+        self._stats = {"chat": 0, "embeddings": 0, "embedding_inputs": 0, "errors": 0,
+                       "streams_aborted": 0, "prompt_tokens": 0, "cached_tokens": 0}
+        self._server: Optional[_Server] = None
+        self._thread: Optional[threading.Thread] = None
+
+    # ---- 生命周期 ----
+
+    def start(self) -> "FakeOpenAIServer":
+        self._server = _Server((self.host, self.port), _Handler)
+        self._server.fake = self
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True, name="fake-openai")
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self) -> "FakeOpenAIServer":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1"
+
+    # ---- 行为控制 ----
+
+    def fail_next(self, n: int = 1) -> None:
+        """接下来的 n 个请求返回 error_status"""
+        with self._lock:
+            self._fail_next += n
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats)
+
+    def _count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self._stats[name] += n
+
+    def _maybe_error(self) -> Optional[int]:
+        with self._lock:
+            if self._fail_next > 0:
+                self._fail_next -= 1
+                self._stats["errors"] += 1
+                return self.error_status
+            if self.error_rate and self._random.random() < self.error_rate:
+                self._stats["errors"] += 1
+                return self.error_status
+        return None
+
+    def _first_byte_delay(self) -> float:
+        if not self.latency_jitter:
+            return self.latency
+        with self._lock:
+            return self.latency + self._random.uniform(0, self.latency_jitter)
+
+    @staticmethod
+    def _sleep(seconds: float) -> None:
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def _generation_time(self, n_tokens: int) -> float:
+        return n_tokens / self.tokens_per_second if self.tokens_per_second else 0.0
+
+    # ---- 响应内容 ----
+
+    def _usage(self, messages: List[Dict[str, Any]], completion_tokens: int) -> Dict[str, Any]:
+        prompt = "".join(f"{m.get('role')}:{m.get('content') or ''}\n" for m in messages)
+        prompt_tokens = max(1, len(prompt) // 4)
+        cached_chars = self._cached_prefix_chars(prompt) if self.prefix_cache else 0
+        cached_tokens = cached_chars // 4
+        with self._lock:
+            self._stats["chat"] += 1
+            self._stats["prompt_tokens"] += prompt_tokens
+            self._stats["cached_tokens"] += cached_tokens
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+        }
+
+    def _cached_prefix_chars(self, prompt: str) -> int:
+        """模拟提供方的前缀缓存：按块计算哈希链，返回与之前请求共享的最长前缀长度"""
+        digest = hashlib.sha256()
+        hashes = []
+        for start in range(0, len(prompt) - PREFIX_BLOCK_CHARS + 1, PREFIX_BLOCK_CHARS):
+            digest.update(prompt[start:start + PREFIX_BLOCK_CHARS].encode("utf-8"))
+            hashes.append(digest.copy().hexdigest())
+        cached = 0
+        with self._lock:
+            for i, h in enumerate(hashes):
+                if h not in self._prefixes:
+                    break
+                cached = (i + 1) * PREFIX_BLOCK_CHARS
+            self._prefixes.update(hashes)
+        return cached
+
+    def _embedding(self, text: str) -> List[float]:
+        """确定性单位向量：相同文本得到相同向量"""
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+        rng = random.Random(seed)
+        vector = [rng.gauss(0.0, 1.0) for _ in range(self.embedding_dim)]
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    def _embeddings(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        inputs = body.get("input", [])
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        self._sleep(self._first_byte_delay())
+        self._count("embeddings")
+        self._count("embedding_inputs", len(inputs))
+        tokens = sum(len(split_tokens(t)) for t in inputs)
+        return {
+            "object": "list",
+            "data": [{"object": "embedding", "index": i, "embedding": self._embedding(t)}
+                     for i, t in enumerate(inputs)],
+            "model": body.get("model", "fake-embedding"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地 OpenAI 兼容替身服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=0.0, help="首包延迟（秒）")
+    parser.add_argument("--tps", type=float, default=None, help="输出速率（tokens/s）")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--reply", default="好的，我明白了。")
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(FakeScript([args.reply]), host=args.host, port=args.port,
+                              latency=args.latency, tokens_per_second=args.tps, error_rate=args.error_rate)
+    server.start()
+    print(f"Fake OpenAI server listening on {server.url}")
+    try:
+        server._thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
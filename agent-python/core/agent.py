@@ -1,18 +1,43 @@
-import re
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Callable, Sequence
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from .state import StateManager, EventTypes, Event
 from .context import ContextBuilder
-from tools import get_all_tools, get_functions_xml, parse_and_execute_function_calls
-from llm.llm_client import llm_call
+from .journal import EventJournal
+from .prefetch import MemoryPrefetcher
+from .recall import MemoryRecall
+from tools import get_all_tools, get_functions_xml, get_registry, StreamingFunctionCallParser
+from memory_system import user_scope
+from llm.llm_client import llm_call, llm_call_stream, llm_call_async, llm_call_stream_async
 
 class Agent:
     """Agent 核心 - 实现状态机循环"""
     
-    def __init__(self, max_iterations: int = 3, max_context_length: int = 8000):
-        self.state_manager = StateManager()
-        self.context_builder = ContextBuilder(max_context_length)
+    def __init__(self, max_iterations: int = 3, max_context_length: int = 8000,
+                 streaming: bool = False, context_layout: str = ContextBuilder.LAYOUT_LEGACY,
+                 journal: Optional[EventJournal] = None, user_id: str = "default",
+                 prefetch_memories: bool = False, pre_retrieval: bool = False,
+                 rolling_summary: bool = False):
+        # 提供持久化日志时从日志恢复会话（快照 + 尾部）
+        self.state_manager = StateManager.open(journal) if journal is not None else StateManager()
+        self.user_id = user_id
+        self.context_builder = ContextBuilder(max_context_length, layout=context_layout,
+                                              on_compact=self.state_manager.compact,
+                                              # 开启后截掉的历史在后台合并成摘要（每次截断多一次 LLM 调用）
+                                              rolling_summary=rolling_summary,
+                                              on_summary=self.state_manager.record_summary,
+                                              user_id=user_id,
+                                              # 开启后第一次 LLM 调用之前先检索记忆，相关的直接放进上下文
+                                              recall=MemoryRecall(user_id) if pre_retrieval else None)
         self.max_iterations = max_iterations
         self.tools_registry = get_all_tools()
+        self.streaming = streaming
+        self.last_turn_metrics: List[Dict[str, Any]] = []
+        self._tool_executor: Optional[ThreadPoolExecutor] = None
+        self._turn_lock: Optional[asyncio.Lock] = None
+        # 开启后用户消息一到就在后台检索相关记忆，与 LLM 调用重叠
+        self.prefetcher = MemoryPrefetcher(user_id) if prefetch_memories else None
     
     def run(self, initial_prompt: Optional[str] = None) -> None:
         """启动 Agent 对话循环"""
@@ -25,7 +50,10 @@ class Agent:
         if initial_prompt:
             print(f"用户: {initial_prompt}")
             self.add_user_message(initial_prompt)
-            self.process_user_input()
+            if self.streaming:
+                self.process_user_input_stream()
+            else:
+                self.process_user_input()
         
         # 进入对话循环
         while True:
@@ -42,7 +70,10 @@ class Agent:
                 self.add_user_message(user_input)
                 
                 # 处理用户输入
-                self.process_user_input()
+                if self.streaming:
+                    self.process_user_input_stream()
+                else:
+                    self.process_user_input()
                 
             except KeyboardInterrupt:
                 print("\n再见！")
@@ -51,6 +82,8 @@ class Agent:
     def add_user_message(self, content: str) -> None:
         """添加用户消息到状态"""
         self.state_manager.add_event(EventTypes.USER_MESSAGE, {"content": content})
+        if self.prefetcher is not None:
+            self.prefetcher.start(content)
     
     def add_agent_message(self, content: str) -> None:
         """添加智能体回复到状态"""
@@ -82,7 +115,7 @@ class Agent:
                 break
 
             # 3. 解析并执行工具调用
-            calls = parse_and_execute_function_calls(llm_response)
+            calls = self._execute_calls(get_registry().parse_function_calls(llm_response))
 
             if not calls:
                 # 没有工具调用，直接回复用户
@@ -91,29 +124,152 @@ class Agent:
                 break
 
             # 4. 处理工具调用结果
-            results = []
-            for call in calls:
-                if call.get("success"):
-                    results.append(call)
-                    print(f"工具 {call['tool_name']} 执行成功")
-                else:
-                    results.append(call)
-                    print(f"工具 {call['tool_name']} 执行失败: {call['error']}")
+            self._print_tool_results(calls)
 
             # 5. 更新状态：添加工具执行结果
-            if results:
-                self.add_tool_result(results)
+            self.add_tool_result(calls)
 
         if iteration >= self.max_iterations:
             print("达到最大迭代次数")
     
-    def get_current_state(self) -> List[Event]:
+    def process_user_input_stream(self, on_token: Optional[Callable[[str], None]] = None) -> None:
+        """流式处理用户输入
+        
+        - 回复文本逐 token 输出给用户
+        - 每个 <invoke> 的结束标签到达时立即提交执行，模型继续生成
+        - 不可并行的工具（parallel_safe=False）及其后的调用留到生成结束、前面的调用完成后再执行
+        - 看到 </function_calls> 后停止生成
+        每轮迭代的首 token 延迟和首个工具启动延迟记录在 last_turn_metrics 中。
+        """
+        if on_token is None:
+            on_token = lambda text: print(text, end="", flush=True)
+        if self._tool_executor is None:
+            self._tool_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="agent-tool")
+        registry = get_registry()
+        self.last_turn_metrics = []
+        iteration = 0
+
+        while iteration < self.max_iterations:
+            iteration += 1
+            print(f"\n--- 处理中 {iteration} ---")
+            
+            # 1. 上下文工程：用当前状态生成 prompt
+            current_state = self.state_manager.get_state()
+            context = self.context_builder.create_context_from_state(current_state)
+            
+            # 2. LLM 决策：边生成边解析，工具调用一到就执行
+            parser = StreamingFunctionCallParser()
+            futures = []
+            deferred = []
+            metrics = {"iteration": iteration, "ttft": None, "first_tool_start": None}
+            start = time.perf_counter()
+            print("Agent: ", end="", flush=True)
+            stream = llm_call_stream(context)
+            try:
+                for chunk in stream:
+                    if metrics["ttft"] is None:
+                        metrics["ttft"] = time.perf_counter() - start
+                    text, calls = parser.feed(chunk)
+                    if text:
+                        on_token(text)
+                    for call in calls:
+                        if metrics["first_tool_start"] is None:
+                            metrics["first_tool_start"] = time.perf_counter() - start
+                        if deferred or not registry.is_parallel_safe(call):
+                            deferred.append(call)
+                        else:
+                            futures.append(self._tool_executor.submit(self._execute_calls, [call]))
+                    if parser.closed:
+                        # 工具调用块已完整，后面的内容不再需要
+                        break
+            except Exception as e:
+                print(f"\nLLM 调用失败: {e}")
+                # 还没开始的工具调用取消，已在执行的等它结束，不让工具在本轮结束后继续运行
+                for future in futures:
+                    future.cancel()
+                wait(futures)
+                break
+            finally:
+                stream.close()
+            
+            tail = parser.flush()
+            if tail:
+                on_token(tail)
+            print()
+            metrics["generation"] = time.perf_counter() - start
+            self.last_turn_metrics.append(metrics)
+            self._print_stream_metrics(metrics)
+            
+            if not futures and not deferred:
+                # 没有工具调用，直接回复用户
+                self.add_agent_message(parser.buffer)
+                break
+            
+            # 3. 等待工具执行完成，结果按调用顺序排列
+            results = [future.result()[0] for future in futures]
+            if deferred:
+                results.extend(self._execute_calls(deferred))
+            self._print_tool_results(results)
+            
+            # 4. 更新状态：添加工具执行结果
+            self.add_tool_result(results)
+
+        if iteration >= self.max_iterations:
+            print("达到最大迭代次数")
+    
+    def _execute_calls(self, calls: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """执行已解析的工具调用（工具按当前会话的用户读取记忆）"""
+        if not calls:
+            return []
+        self._observe_calls(calls)
+        with user_scope(self.user_id):
+            registry = get_registry()
+            if self.prefetcher is not None:
+                return self.prefetcher.execute(calls, registry.execute_function_calls)
+            return registry.execute_function_calls(calls)
+    
+    def _observe_calls(self, calls: List[Dict[str, Any]]) -> None:
+        """记录本轮的工具调用（自动回忆据此统计模型是否仍然调用了记忆工具）"""
+        if self.context_builder.recall is not None:
+            self.context_builder.recall.observe(calls)
+    
+    @staticmethod
+    def _print_tool_results(results: List[Dict[str, Any]]) -> None:
+        for result in results:
+            if result.get("success"):
+                print(f"工具 {result['tool_name']} 执行成功")
+            else:
+                print(f"工具 {result['tool_name']} 执行失败: {result['error']}")
+    
+    @staticmethod
+    def _print_stream_metrics(metrics: Dict[str, Any]) -> None:
+        """打印一轮流式生成的延迟指标"""
+        def fmt(value):
+            return f"{value * 1000:.0f}ms" if value is not None else "-"
+        print(f"[指标] 首token: {fmt(metrics['ttft'])}, "
+              f"首个工具启动: {fmt(metrics['first_tool_start'])}, "
+              f"生成耗时: {fmt(metrics['generation'])}")
+    
+    def get_current_state(self) -> Sequence[Event]:
         """获取当前状态"""
         return self.state_manager.get_state()
     
     def clear_state(self) -> None:
         """清空状态"""
-        self.state_manager.events = []
+        self.state_manager.clear()
+    
+    def close(self) -> None:
+        """释放会话资源：写回未发布的摘要，写快照并关闭持久化日志（之后可用同一日志恢复）"""
+        self.context_builder.close()
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+        if self._tool_executor is not None:
+            self._tool_executor.shutdown(wait=True)
+            self._tool_executor = None
+        journal = self.state_manager.journal
+        if journal is not None:
+            self.state_manager.snapshot()
+            journal.close()
     
     def process_single_message(self, message: str) -> str:
         """处理单条消息并返回回复（用于API调用等场景）"""
@@ -129,7 +285,7 @@ class Agent:
             llm_response = llm_call(context)
             
             # 检查是否有工具调用
-            calls = parse_and_execute_function_calls(llm_response)
+            calls = self._execute_calls(get_registry().parse_function_calls(llm_response))
             
             if calls:
                 # 处理工具调用
@@ -154,4 +310,219 @@ class Agent:
             error_msg = f"处理消息时出错: {e}"
             self.add_agent_message(error_msg)
             return error_msg
-    
\ No newline at end of file
+        
+    # ---------- 异步版本：同一个事件循环上并发处理多个会话 ----------
+    #
+    # 事件和状态的语义与同步版本一致。LLM 调用走异步客户端，等待期间事件循环去处理其他会话；
+    # 同步工具在所有会话共用的工具线程池中执行（ToolRegistry.aexecute_function_calls）；上下文构建是增量渲染，
+    # 每轮只有亚毫秒级的计算，直接在事件循环上执行，省掉一次线程切换和排队。
+    # 同一个 Agent 上的多次调用按到达顺序串行，保证事件不交错。
+    
+    def _get_turn_lock(self) -> asyncio.Lock:
+        if self._turn_lock is None:
+            self._turn_lock = asyncio.Lock()
+        return self._turn_lock
+    
+    async def abuild_context(self) -> List[dict]:
+        """用当前状态生成上下文（异步版本）"""
+        current_state = self.state_manager.get_state()
+        if self.context_builder.recall is not None:
+            # 自动回忆的检索在线程池中执行，这里等待它而不阻塞事件循环
+            await self.context_builder.recall.aprepare(current_state)
+        return self.context_builder.create_context_from_state(current_state)
+    
+    async def _run_tools(self, calls: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        self._observe_calls(calls)
+        with user_scope(self.user_id):
+            registry = get_registry()
+            if self.prefetcher is not None:
+                return await self.prefetcher.aexecute(calls, registry.aexecute_function_calls)
+            return await registry.aexecute_function_calls(calls)
+    
+    async def aexecute_tools(self, llm_response: str) -> List[Dict[str, Any]]:
+        """解析回复中的工具调用并执行，没有工具调用时返回空列表"""
+        calls = get_registry().parse_function_calls(llm_response)
+        if not calls:
+            return []
+        return await self._run_tools(calls)
+    
+    async def arun(self, initial_prompt: Optional[str] = None) -> None:
+        """异步版本的对话循环（读取输入不阻塞事件循环）"""
+        print("=== 工具定义 (Functions XML) ===")
+        print(get_functions_xml())
+        print("\n=== 开始 Agent 对话 ===")
+        print("输入 'quit' 或 'exit' 退出对话")
+        
+        if initial_prompt:
+            print(f"用户: {initial_prompt}")
+            await self.asubmit_user_input(initial_prompt)
+        
+        while True:
+            try:
+                user_input = (await asyncio.to_thread(input, "\n用户: ")).strip()
+            except (KeyboardInterrupt, EOFError):
+                print("\n再见！")
+                break
+            if user_input.lower() in ['quit', 'exit', '退出']:
+                print("再见！")
+                break
+            if not user_input:
+                continue
+            await self.asubmit_user_input(user_input)
+    
+    async def asubmit_user_input(self, content: str,
+                                 on_token: Optional[Callable[[str], None]] = None) -> Optional[str]:
+        """添加用户消息并处理，返回本轮的最终回复（没有回复时返回 None）
+        
+        streaming 开启或提供了 on_token 时流式处理，回复文本逐 token 交给 on_token。
+        """
+        async with self._get_turn_lock():
+            self.add_user_message(content)
+            start = len(self.state_manager.events)
+            if self.streaming or on_token is not None:
+                await self._aprocess_user_input_stream(on_token)
+            else:
+                await self._aprocess_user_input()
+            events = self.state_manager.events
+            if len(events) > start and events[-1].type == EventTypes.AGENT_MESSAGE:
+                return events[-1].data.get("content")
+            return None
+    
+    async def aprocess_user_input(self) -> None:
+        """异步版本的 process_user_input"""
+        async with self._get_turn_lock():
+            await self._aprocess_user_input()
+    
+    async def _aprocess_user_input(self) -> None:
+        iteration = 0
+
+        while iteration < self.max_iterations:
+            iteration += 1
+            print(f"\n--- 处理中 {iteration} ---")
+            
+            # 1. 上下文工程
+            context = await self.abuild_context()
+
+            # 2. LLM 决策
+            try:
+                llm_response = await llm_call_async(context)
+                print(f"Agent_test: {llm_response[:300]}...")
+            except Exception as e:
+                print(f"LLM 调用失败: {e}")
+                break
+
+            # 3. 解析并执行工具调用
+            calls = await self.aexecute_tools(llm_response)
+
+            if not calls:
+                print(f"Agent: {llm_response}")
+                self.add_agent_message(llm_response)
+                break
+
+            # 4. 更新状态：添加工具执行结果
+            self._print_tool_results(calls)
+            self.add_tool_result(calls)
+
+        if iteration >= self.max_iterations:
+            print("达到最大迭代次数")
+    
+    async def aprocess_user_input_stream(self, on_token: Optional[Callable[[str], None]] = None) -> None:
+        """异步版本的 process_user_input_stream"""
+        async with self._get_turn_lock():
+            await self._aprocess_user_input_stream(on_token)
+    
+    async def _aprocess_user_input_stream(self, on_token: Optional[Callable[[str], None]] = None) -> None:
+        if on_token is None:
+            on_token = lambda text: print(text, end="", flush=True)
+        registry = get_registry()
+        self.last_turn_metrics = []
+        iteration = 0
+
+        while iteration < self.max_iterations:
+            iteration += 1
+            print(f"\n--- 处理中 {iteration} ---")
+            
+            # 1. 上下文工程
+            context = await self.abuild_context()
+            
+            # 2. LLM 决策：边生成边解析，可并行的工具调用一到就开始执行
+            parser = StreamingFunctionCallParser()
+            tasks = []
+            deferred = []
+            metrics = {"iteration": iteration, "ttft": None, "first_tool_start": None}
+            start = time.perf_counter()
+            print("Agent: ", end="", flush=True)
+            stream = llm_call_stream_async(context)
+            try:
+                async for chunk in stream:
+                    if metrics["ttft"] is None:
+                        metrics["ttft"] = time.perf_counter() - start
+                    text, calls = parser.feed(chunk)
+                    if text:
+                        on_token(text)
+                    for call in calls:
+                        if metrics["first_tool_start"] is None:
+                            metrics["first_tool_start"] = time.perf_counter() - start
+                        if deferred or not registry.is_parallel_safe(call):
+                            deferred.append(call)
+                        else:
+                            tasks.append(asyncio.ensure_future(self._run_tools([call])))
+                    if parser.closed:
+                        break
+            except Exception as e:
+                print(f"\nLLM 调用失败: {e}")
+                for task in tasks:
+                    task.cancel()
+                # 等取消真正完成，工具不在本轮结束之后还在后台运行
+                await asyncio.gather(*tasks, return_exceptions=True)
+                break
+            finally:
+                await stream.aclose()
+            
+            tail = parser.flush()
+            if tail:
+                on_token(tail)
+            print()
+            metrics["generation"] = time.perf_counter() - start
+            self.last_turn_metrics.append(metrics)
+            self._print_stream_metrics(metrics)
+            
+            if not tasks and not deferred:
+                self.add_agent_message(parser.buffer)
+                break
+            
+            # 3. 等待工具执行完成，结果按调用顺序排列
+            results = [batch[0] for batch in await asyncio.gather(*tasks)]
+            if deferred:
+                results.extend(await self._run_tools(deferred))
+            self._print_tool_results(results)
+            
+            # 4. 更新状态：添加工具执行结果
+            self.add_tool_result(results)
+
+        if iteration >= self.max_iterations:
+            print("达到最大迭代次数")
+    
+    async def aprocess_message(self, message: str) -> str:
+        """异步版本的 process_single_message：处理单条消息并返回回复"""
+        async with self._get_turn_lock():
+            self.add_user_message(message)
+            try:
+                context = await self.abuild_context()
+                llm_response = await llm_call_async(context)
+                
+                results = await self.aexecute_tools(llm_response)
+                if not results:
+                    self.add_agent_message(llm_response)
+                    return llm_response
+                
+                # 有工具调用：记录结果后再调用一次获取最终回复
+                self.add_tool_result(results)
+                context = await self.abuild_context()
+                final_response = await llm_call_async(context)
+                self.add_agent_message(final_response)
+                return final_response
+            except Exception as e:
+                error_msg = f"处理消息时出错: {e}"
+                self.add_agent_message(error_msg)
+                return error_msg
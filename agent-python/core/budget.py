@@ -0,0 +1,115 @@
+"""
+上下文 token 预算 - 按真实 token 数给各段分配预算，在历史的 token 前缀和上二分查找截断点
+"""
+import bisect
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+from llm.llm_client import count_tokens, truncate_text
+
+# 每条 chat 消息的格式开销（role、分隔符等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+class ContextOverflowError(ValueError):
+    """不可截断的部分（指令、工具定义）本身就超出了窗口"""
+
+
+@dataclass
+class SectionBudget:
+    """一段上下文的预算
+
+    priority 越大越先分配；max_tokens 为该段上限（None 表示不设上限，拿剩余的全部）；
+    truncatable=False 的段放不下时直接报错，不做截断。
+    """
+    name: str
+    priority: int
+    max_tokens: Optional[int] = None
+    truncatable: bool = True
+
+
+def default_sections() -> List[SectionBudget]:
+    """默认分段：指令和工具定义必须完整保留，基础记忆、滚动摘要和自动回忆有上限，历史拿剩余预算。
+    tool_results 的 max_tokens 是单条工具结果的上限，在渲染事件时截断。"""
+    return [
+        SectionBudget("system", priority=100, truncatable=False),
+        SectionBudget("tools", priority=90, truncatable=False),
+        SectionBudget("summary", priority=60, max_tokens=800),
+        SectionBudget("base_memory", priority=50, max_tokens=2000),
+        SectionBudget("recall", priority=40, max_tokens=600),
+        SectionBudget("history", priority=10),
+        SectionBudget("tool_results", priority=10, max_tokens=1500),
+    ]
+
+
+@dataclass
+class TokenBudget:
+    """上下文 token 预算
+
+    window_tokens: 模型上下文窗口（输入 + 输出）
+    reserve_output_tokens: 为输出预留的 token 数，可用于输入的是两者之差
+    low_watermark: 历史超出预算时截到预算的这个比例，之后几轮只追加不再截断
+    verify_ratio: 估算值超过可用预算的这个比例时，对最终消息做一次精确计数
+    """
+    window_tokens: int = 8000
+    reserve_output_tokens: int = 1024
+    sections: List[SectionBudget] = field(default_factory=default_sections)
+    low_watermark: float = 0.7
+    verify_ratio: float = 0.9
+    count_tokens: Callable[[str], int] = count_tokens
+    truncate_text: Callable[[str, int], str] = truncate_text
+
+    def __post_init__(self):
+        self._by_name: Dict[str, SectionBudget] = {s.name: s for s in self.sections}
+
+    @property
+    def available(self) -> int:
+        """可用于输入的 token 数"""
+        return max(0, self.window_tokens - self.reserve_output_tokens)
+
+    def section(self, name: str) -> Optional[SectionBudget]:
+        return self._by_name.get(name)
+
+    def section_limit(self, name: str) -> Optional[int]:
+        section = self._by_name.get(name)
+        return section.max_tokens if section is not None else None
+
+    def allocate(self, needs: Dict[str, int]) -> Dict[str, int]:
+        """按优先级分配预算，返回每段可用的 token 数
+
+        分到的预算不小于需求的段可以原样放入；小于需求的段需要截断到分到的大小。
+        """
+        remaining = self.available
+        allocation: Dict[str, int] = {}
+        for section in sorted(self.sections, key=lambda s: -s.priority):
+            if section.name not in needs:
+                continue
+            need = needs[section.name]
+            if not section.truncatable:
+                if need > remaining:
+                    raise ContextOverflowError(
+                        f"{section.name} 需要 {need} tokens，剩余预算只有 {remaining}"
+                        f"（窗口 {self.window_tokens}，输出预留 {self.reserve_output_tokens}）")
+                allocation[section.name] = need
+            else:
+                limit = remaining if section.max_tokens is None else min(section.max_tokens, remaining)
+                allocation[section.name] = limit
+            remaining -= min(need, allocation[section.name])
+        return allocation
+
+    def fit_text(self, text: str, max_tokens: Optional[int]) -> str:
+        """把文本截断到 max_tokens 以内"""
+        if max_tokens is None:
+            return text
+        return self.truncate_text(text, max_tokens)
+
+    @staticmethod
+    def cut_index(prefix_sums: List[int], budget: int) -> int:
+        """在前缀和上二分查找：保留 [i, n) 且 token 数不超过 budget 的最小 i
+
+        prefix_sums[i] 是前 i 个块的 token 数，长度为 n + 1。
+        """
+        total = prefix_sums[-1]
+        if total <= budget:
+            return 0
+        return bisect.bisect_left(prefix_sums, total - max(0, budget))
@@ -1,56 +1,302 @@
-from typing import List
-from .state import Event, EventTypes
+from typing import Callable, List, Optional, Dict, Any, Sequence
+from .state import Event, EventType, EventTypes, hash_events, last_event_of_type, latest_summary
+from .summary import RollingSummary
+from .renderer import EventRenderer, EMPTY_HISTORY
+from .recall import MemoryRecall
+from .budget import TokenBudget, ContextOverflowError, MESSAGE_OVERHEAD_TOKENS
 from tools import get_functions_xml
-from memory_system import get_base_memory, update_memory, schedule_memory_update
+from memory_system import get_base_memory, schedule_memory_update
 from datetime import date
-import threading
+import hashlib
 
 class ContextBuilder:
-    """上下文构建器"""
+    """上下文构建器
     
-    def __init__(self, max_context_length: int = 8000):
+    layout:
+    - "legacy": 日期、记忆、工具定义、格式要求和历史合并成一条 assistant 消息
+    - "stable": 按稳定程度排列，system(指令+工具定义+格式要求) -> 基础记忆 -> 日期 -> 历史，
+      前缀在多轮之间逐字节不变，便于命中提供方的前缀缓存
+    
+    长度按 token 计算：max_context_length 是模型上下文窗口（token 数），
+    各段按 TokenBudget 的优先级分配预算，历史从最老的事件开始截断，截掉的事件交给记忆系统。
+    
+    截断点作为压缩水位（COMPACTION 事件）记录在事件流中：水位之前的事件不再进入上下文，
+    也不会再次交给记忆系统。on_compact(upto, key) 负责把水位写回状态（如 StateManager.compact）；
+    不提供时水位只保存在本实例中。
+    
+    rolling_summary 开启时（默认关闭，每次截断会多一次后台 LLM 调用），截掉的事件同时在后台合并进一段滚动摘要，作为有独立预算的一段
+    放在历史之前；新摘要在下一次构建时通过 on_summary(content, upto) 写回状态（SUMMARY 事件）。
+    
+    user_id 决定读取哪个用户的基础记忆、截掉的事件写入哪个用户的记忆。
+    
+    recall（MemoryRecall）不为 None 时，每条新的用户消息先在延迟预算内检索一次记忆，
+    相关度达到阈值的几条作为有独立预算的一段放在上下文末尾（不影响前面的稳定前缀）。
+    """
+    
+    LAYOUT_LEGACY = "legacy"
+    LAYOUT_STABLE = "stable"
+    
+    def __init__(self, max_context_length: int = 8000, layout: str = LAYOUT_LEGACY,
+                 budget: Optional[TokenBudget] = None,
+                 on_compact: Optional[Callable[[int, str], None]] = None,
+                 rolling_summary: bool = False,
+                 on_summary: Optional[Callable[[str, int], None]] = None,
+                 user_id: str = "default",
+                 recall: Optional[MemoryRecall] = None):
+        if layout not in (self.LAYOUT_LEGACY, self.LAYOUT_STABLE):
+            raise ValueError(f"未知的上下文布局: {layout}")
         self.max_context_length = max_context_length
+        self.layout = layout
+        self.user_id = user_id
+        self.budget = budget or TokenBudget(window_tokens=max_context_length,
+                                            reserve_output_tokens=min(1024, max_context_length // 4))
+        self._static_prefix: Optional[str] = None
+        self._tools_xml: Optional[str] = None
+        self.renderer = EventRenderer(count_tokens=self.budget.count_tokens,
+                                      fit_tool_result=self._fit_tool_result)
+        self.on_compact = on_compact
+        self.summary: Optional[RollingSummary] = RollingSummary() if rolling_summary else None
+        self.on_summary = on_summary
+        self.recall = recall
+        # 历史从第几个事件开始保留（之前的已交给记忆系统）
+        self._history_start = 0
+        self._history_anchor: Optional[Event] = None
+        self._compaction: Optional[Event] = None
+        self._last_prefix_hash: Optional[str] = None
+        self.prefix_stats = {"builds": 0, "prefix_changes": 0}
+        self.budget_stats: Dict[str, Any] = {"evictions": 0, "verifications": 0, "last": {}}
 
-    def create_context_from_state(self, events: List[Event]) -> List[dict]:
-        """将事件流转换为结构化上下文"""
-
-        messages = []
-
-        messages.append({
-            "role": "system",
-            "content": self._get_system_prompt()
-        })
+    def create_context_from_state(self, events: Sequence[Event]) -> List[dict]:
+        """将事件流转换为结构化上下文，保证总 token 数不超过可用预算
         
-        context_parts = []
+        只渲染水位之后的事件（live），水位之前的事件已交给记忆系统，可以不在内存中。
+        """
+        base = self._sync_history_start(events)
+        live = events[base:]
+        self.renderer.render(live)
+        base_memory = "# 这是记忆里的内容：\n" + get_base_memory(user_id=self.user_id)
+        summary = self._summary_section(events)
+        recall = self.recall.section(events) if self.recall is not None else ""
         
-        # 1. base_prompt
-        context_parts.append(self._get_base_prompt())
+        needs = {
+            "system": self._fixed_tokens(),
+            "tools": self.budget.count_tokens(self._get_tools_xml()),
+            "summary": self.budget.count_tokens(summary) if summary else 0,
+            "base_memory": self.budget.count_tokens(base_memory),
+            "recall": self.budget.count_tokens(recall) if recall else 0,
+            "history": self.renderer.total_tokens if live else 0,
+        }
+        allocation = self.budget.allocate(needs)
+        if needs["summary"] > allocation["summary"]:
+            summary = self.budget.fit_text(summary, allocation["summary"])
+        if needs["base_memory"] > allocation["base_memory"]:
+            base_memory = self.budget.fit_text(base_memory, allocation["base_memory"])
+        if needs["recall"] > allocation["recall"]:
+            recall = self.budget.fit_text(recall, allocation["recall"])
+        history_budget = allocation["history"]
         
-        # 2. 基础记忆
-        context_parts.append("# 这是记忆里的内容：\n"+get_base_memory(user_id="default"))
+        for _ in range(3):
+            start = self._fit_history(live, base, history_budget)
+            messages = self._assemble(base_memory, summary,
+                                      self._format_history(self._history_text(live, start, history_budget)),
+                                      recall)
+            estimate = (needs["system"] + needs["tools"] + min(needs["summary"], allocation["summary"])
+                        + min(needs["base_memory"], allocation["base_memory"])
+                        + min(needs["recall"], allocation["recall"])
+                        + (min(self.renderer.suffix_tokens(start), history_budget) if live else 0))
+            if estimate <= self.budget.available * self.budget.verify_ratio:
+                break
+            # 估算接近上限时精确计数一次，超出部分从历史中再截掉
+            self.budget_stats["verifications"] += 1
+            actual = sum(self.budget.count_tokens(m["content"]) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+            overflow = actual - self.budget.available
+            if overflow <= 0:
+                break
+            if start >= len(live):
+                raise ContextOverflowError(f"上下文 {actual} tokens 超出可用预算 {self.budget.available}")
+            history_budget = max(0, min(self.renderer.suffix_tokens(start), history_budget) - overflow)
+        else:
+            raise ContextOverflowError(f"上下文无法压缩到可用预算 {self.budget.available} 以内")
         
-        # 2. 工具定义
-        context_parts.append("# 这是工具定义：\n"+get_functions_xml())
+        self.budget_stats["last"] = {"needs": needs, "allocation": allocation, "history_start": base + start}
+        if self.layout == self.LAYOUT_STABLE:
+            self._track_prefix(messages[0]["content"] + base_memory)
+        return messages
+    
+    def _assemble(self, base_memory: str, summary: str, history: str, recall: str = "") -> List[dict]:
+        if summary:
+            history = summary + "\n\n" + history
+        if recall:
+            # 自动回忆每轮都不同，放在最后，前面的内容仍可命中前缀缓存
+            history = history + "\n\n" + recall
+        if self.layout == self.LAYOUT_STABLE:
+            # 稳定前缀布局：越稳定的内容越靠前，历史只在末尾追加；
+            # 日期每天变化，放在静态部分之后；摘要只在截断时变化，放在历史之前
+            return [
+                {"role": "system", "content": self._get_static_prefix()},
+                {"role": "assistant", "content": base_memory + "\n\n" + self._get_base_prompt().strip() + "\n\n" + history},
+            ]
         
-        # 3. 工具使用格式要求
-        context_parts.append("# 这是工具使用格式要求：\n"+self._get_output_format())
-
-        # 4. 历史事件
-        context_parts.append("# 历史状态记录（注意对话历史用户是可见的，工具调用部分用户不可见）：\n"+self._format_events(events))
-
-
-        full_context = "\n\n".join(context_parts)
+        context_parts = [
+            # 1. base_prompt
+            self._get_base_prompt(),
+            # 2. 基础记忆
+            base_memory,
+            # 3. 工具定义
+            "# 这是工具定义：\n" + self._get_tools_xml(),
+            # 4. 工具使用格式要求
+            "# 这是工具使用格式要求：\n" + self._get_output_format(),
+            # 5. 滚动摘要 + 历史事件
+            history,
+        ]
+        return [
+            {"role": "system", "content": self._get_system_prompt()},
+            {"role": "assistant", "content": "\n\n".join(context_parts)},
+        ]
+    
+    def _fixed_tokens(self) -> int:
+        """不可截断部分（工具定义除外）的 token 数：指令、格式要求、日期、标题和消息开销"""
+        count = self.budget.count_tokens
+        return (count(self._get_system_prompt()) + count(self._get_output_format())
+                + count(self._get_base_prompt()) + count(self._format_history(""))
+                + 2 * MESSAGE_OVERHEAD_TOKENS + 16)  # 16: 段落之间的 "\n\n" 等零散开销
+    
+    def _sync_history_start(self, events: Sequence[Event]) -> int:
+        """历史保留的起点（绝对下标）：本实例的游标与事件流中的压缩水位取较大者"""
+        compaction = last_event_of_type(events, EventType.COMPACTION)
+        if compaction is not None and compaction is self._compaction:
+            # 水位没有变化（常见情况），不访问水位之前可能已换出内存的事件
+            return self._history_start
+        if self._history_start > len(events):
+            # 事件列表被替换（如重新开始对话）
+            self._history_start, self._history_anchor = 0, None
+        elif self._history_start:
+            anchor = events[self._history_start - 1]
+            if anchor is not self._history_anchor and anchor != self._history_anchor:
+                self._history_start, self._history_anchor = 0, None
+        if compaction is not None:
+            watermark = min(compaction.data.get("upto", 0), len(events))
+            if watermark > self._history_start:
+                self._history_start, self._history_anchor = watermark, events[watermark - 1]
+            self._compaction = compaction
+        return self._history_start
+    
+    def _fit_history(self, live: Sequence[Event], base: int, budget: int) -> int:
+        """返回 live 中历史保留的起始下标（live 是从第 base 个事件开始的部分）
         
-        # 如果超长，进行智能截断
-        if len(full_context) > self.max_context_length:
-            full_context = self._truncate_context(full_context, events)
-            
-        messages.append({
-            "role": "assistant",
-            "content": full_context
-        })
-
-        return messages
+        上一次的水位仍放得下就沿用（历史只追加，前缀保持不变）；放不下时在 token 前缀和上
+        二分查找新的水位，截到预算的 low_watermark，被截掉的事件只交给记忆系统一次。
+        水位不会越过当前轮的用户消息：它单独就超出预算时由 _history_text 截断，而不是被截掉。
+        """
+        start = self._history_start - base
+        if not live or self.renderer.suffix_tokens(start) <= budget:
+            return start
+        
+        target = int(budget * self.budget.low_watermark)
+        cut = max(TokenBudget.cut_index(self.renderer.token_prefix, target), start)
+        if self.renderer.suffix_tokens(cut) > budget:
+            cut = TokenBudget.cut_index(self.renderer.token_prefix, budget)
+        cut = min(cut, self._turn_start(live, start))
+        if cut > start:
+            self._evict_events(live[start:cut], base + cut)
+            self._history_start = base + cut
+            self._history_anchor = live[cut - 1]
+        return cut
+    
+    @staticmethod
+    def _turn_start(live: Sequence[Event], start: int) -> int:
+        """当前轮的起点：start 之后最后一条用户消息的下标，没有时为 len(live)"""
+        for i in range(len(live) - 1, start - 1, -1):
+            if live[i].type == EventTypes.USER_MESSAGE:
+                return i
+        return len(live)
+    
+    def _history_text(self, live: Sequence[Event], start: int, budget: int) -> str:
+        """从第 start 个事件开始的历史文本，保证不超过 budget
+        
+        只有水位停在当前轮的用户消息上时才会超出预算：截断这条消息，为本轮之后的事件留出位置；
+        本轮之后的事件也放不下时整体截断（保留开头的用户消息）。
+        """
+        text = self._render_history(live, start)
+        if not live or start >= len(live):
+            return text
+        overflow = self.renderer.suffix_tokens(start) - budget
+        if overflow <= 0:
+            return text
+        first, rest = self.renderer.chunks[start], self.renderer.suffix(start + 1)
+        keep = self.renderer.token_counts[start] - overflow
+        if not first or keep <= 0:
+            return self.budget.fit_text(text, budget)
+        first = self.budget.fit_text(first, keep)
+        return first + "\n" + rest if rest else first
+    
+    def _summary_section(self, events: Sequence[Event]) -> str:
+        """滚动摘要段：先把后台完成的新摘要写回状态，没有摘要时返回空串"""
+        if self.summary is None:
+            return ""
+        if not self.summary.covered_upto:
+            # 新建的构建器从状态中恢复摘要
+            event = latest_summary(events)
+            if event is not None:
+                self.summary.restore(event.data.get("content", ""), event.data.get("upto", 0))
+        published = self.summary.take_unpublished()
+        if published is not None and self.on_summary is not None:
+            self.on_summary(*published)
+        if not self.summary.text:
+            return ""
+        return "# 之前的对话摘要（更早的对话历史已截掉）：\n" + self.summary.text
+    
+    def close(self, timeout: Optional[float] = None) -> None:
+        """等待进行中的摘要更新，把尚未写回的摘要交给 on_summary，然后释放后台线程"""
+        if self.recall is not None:
+            self.recall.close()
+        if self.summary is None:
+            return
+        try:
+            self.summary.wait(timeout)
+        except Exception as e:
+            print(f"等待滚动摘要超时或失败: {e}")
+        published = self.summary.take_unpublished()
+        if published is not None and self.on_summary is not None:
+            self.on_summary(*published)
+        self.summary.close()
+    
+    def _fit_tool_result(self, text: str) -> str:
+        return self.budget.fit_text(text, self.budget.section_limit("tool_results"))
+    
+    def _get_static_prefix(self) -> str:
+        """system 指令 + 工具定义 + 格式要求，进程内只渲染一次"""
+        if self._static_prefix is None:
+            self._static_prefix = "\n\n".join([
+                self._get_system_prompt().strip(),
+                "# 这是工具定义：\n" + self._get_tools_xml(),
+                "# 这是工具使用格式要求：\n" + self._get_output_format(),
+            ])
+        return self._static_prefix
+    
+    def _get_tools_xml(self) -> str:
+        """工具定义在进程内不变，只渲染一次"""
+        if self._tools_xml is None:
+            self._tools_xml = get_functions_xml()
+        return self._tools_xml
+    
+    def _render_history(self, events: Sequence[Event], start_index: int = 0) -> str:
+        """增量渲染历史：只格式化上次调用之后新增的事件；events 中 start_index 之前的事件被截掉"""
+        if not events or start_index >= len(events):
+            return EMPTY_HISTORY
+        self.renderer.render(events)
+        return self.renderer.suffix(start_index)
+    
+    def _format_history(self, history: str) -> str:
+        return "# 历史状态记录（注意对话历史用户是可见的，工具调用部分用户不可见）：\n" + history
+    
+    def _track_prefix(self, prefix: str) -> None:
+        """记录前缀是否与上一轮一致，用于观察缓存友好程度"""
+        prefix_hash = hashlib.blake2b(prefix.encode("utf-8"), digest_size=16).hexdigest()
+        self.prefix_stats["builds"] += 1
+        if self._last_prefix_hash is not None and prefix_hash != self._last_prefix_hash:
+            self.prefix_stats["prefix_changes"] += 1
+        self._last_prefix_hash = prefix_hash
     
     def _get_system_prompt(self) -> str:
         """系统指令"""
@@ -69,36 +315,6 @@ function调用原则：
 
 """
     
-    def _format_events(self, events: List[Event]) -> str:
-        """格式化事件历史"""
-        if not events:
-            return "暂无对话历史"
-            
-        formatted_events = []
-        for event in events:
-            if event.type == EventTypes.USER_MESSAGE:
-                content = event.data.get('content', '')
-                formatted_events.append(f"用户说: {content}")
-            elif event.type == EventTypes.TOOL_RESULT:
-                # 适配 tools 系统的结果格式
-                results = event.data.get('results', [])
-                for result in results:
-                    tool_name = result.get('tool_name', '')
-                    success = result.get('success', False)
-                    if success:
-                        result_data = result.get('result', {})
-                        # 统一使用工具返回的message字段
-                        message = result_data.get('message', f"{tool_name}执行成功")
-                        formatted_events.append(f"工具执行结果: {message}")
-                    else:
-                        error_msg = result.get('error', '')
-                        formatted_events.append(f"工具执行失败: {tool_name} - {error_msg}")
-            elif event.type == EventTypes.AGENT_MESSAGE:
-                content = event.data.get('content', '')
-                formatted_events.append(f"我回复: {content}")
-                
-        return "\n".join(formatted_events)
-    
     def _get_base_prompt(self) -> str:
         """基础提示词"""
         return f"""
@@ -127,44 +343,22 @@ function调用原则：
 - 必需的参数不能省略
 </output_instructions>"""
     
-    def _truncate_context(self, context: str, events: List[Event]) -> str:
-        """智能截断上下文"""
-        from memory_system import schedule_memory_update
+    def _evict_events(self, evicted: List[Event], upto: int) -> None:
+        """把截掉的事件交给记忆系统和滚动摘要，并推进压缩水位（事件按追加顺序即时间顺序排列）"""
+        self.budget_stats["evictions"] += 1
+        key = hash_events(evicted)
         
-        # 如果事件数量少于3个，直接保留最近的事件
-        if len(events) <= 3:
-            recent_events = events
-        else:
-            # 计算需要移除的事件数量（最老的三分之一）
-            remove_count = len(events) // 3
-            if remove_count == 0:
-                remove_count = 1  # 至少移除1个
-            
-            # 获取最老的事件（按时间正序排列）
-            sorted_events = sorted(events, key=lambda x: x.timestamp)
-            oldest_events = sorted_events[:remove_count]
-            
-            # 将最老的事件转换为记忆系统的states格式
-            states_for_memory = []
-            for event in oldest_events:
-                states_for_memory.append(event.data)
-            
-            # 异步调度记忆更新
-            schedule_memory_update(states_for_memory, user_id="default", force_process=True)
-            print(f"已调度 {len(oldest_events)} 个事件的记忆存储")
-            
-            # 保留剩余的事件
-            remaining_events = sorted_events[remove_count:]
-            # 按原始顺序重新排列
-            recent_events = sorted(remaining_events, key=lambda x: x.timestamp)
-        
-        # 重新构建上下文
-        context_parts = [
-            self._get_base_prompt(),
-            "# 这是记忆里的内容：\n" + get_base_memory(user_id="default"),
-            "# 这是工具定义：\n" + get_functions_xml(),
-            "# 这是工具使用格式要求：\n" + self._get_output_format(),
-            "# 历史状态记录（注意对话历史用户是可见的，工具部分用户不可见，你需要结合工具调用结果和对话历史回答用户）：\n" + self._format_events(recent_events)
-        ]
+        # 压缩水位和摘要事件本身不交给记忆系统，也不进摘要
+        content_events = [e for e in evicted if e.type not in (EventTypes.COMPACTION, EventTypes.SUMMARY)]
         
-        return "\n\n".join(context_parts) 
\ No newline at end of file
+        # 先记录水位再调度：同一批事件即使重跑本轮也不会再次提交；记忆系统按 key 去重
+        if self.on_compact is not None:
+            self.on_compact(upto, key)
+        if not content_events:
+            return
+        if self.summary is not None:
+            self.summary.submit(content_events, upto)
+        # 将事件转换为记忆系统的states格式
+        states_for_memory = [event.data for event in content_events]
+        schedule_memory_update(states_for_memory, user_id=self.user_id, force_process=True, source_key=key)
+        print(f"已调度 {len(states_for_memory)} 个事件的记忆存储")
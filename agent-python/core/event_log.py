@@ -0,0 +1,215 @@
+"""
+事件日志 - 结构共享的只追加日志，O(1) 追加、O(1) 快照、O(1) 分叉，带类型索引和轮次索引
+"""
+import bisect
+import threading
+from array import array
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Optional, Sequence, Union, overload
+
+if TYPE_CHECKING:
+    from .state import Event
+
+
+class _Store:
+    """多个日志版本共享的底层数组，只追加不修改
+
+    索引同样只追加，各版本按自己的长度截取（位置有序，可二分）：
+    - by_type[type]: 该类型事件的位置
+    - turn_starts[n]: 第 n 轮第一个事件的位置（第 0 轮是第一条用户消息之前的事件）
+
+    前 cold_upto 个事件可以被换出内存（items 中为 None），访问时由 loader(i) 从持久化日志读回。
+    """
+    __slots__ = ("items", "lock", "by_type", "turn_starts", "cold_upto", "loader")
+
+    def __init__(self, items: Optional[List["Event"]] = None):
+        self.items: List[Optional["Event"]] = []
+        self.by_type: Dict[Any, array] = {}
+        self.turn_starts = array("q", [0])
+        self.lock = threading.Lock()
+        self.cold_upto = 0
+        self.loader: Optional[Callable[[int], "Event"]] = None
+        for event in items or ():
+            self.push(event)
+
+    def prefix(self, length: int) -> "_Store":
+        """前 length 个事件组成的新数组（连同索引一起按位置截取，不重新计算）"""
+        store = _Store()
+        store.items = self.items[:length]
+        store.by_type = {t: p[:bisect.bisect_left(p, length)] for t, p in self.by_type.items()}
+        store.turn_starts = self.turn_starts[:bisect.bisect_left(self.turn_starts, length, 1)]
+        store.cold_upto = min(self.cold_upto, length)
+        store.loader = self.loader
+        return store
+
+    def get(self, index: int) -> "Event":
+        event = self.items[index]
+        return event if event is not None else self.loader(index)
+
+    def slice(self, start: int, stop: int) -> List["Event"]:
+        events = self.items[start:stop]
+        if start < self.cold_upto:
+            for i in range(min(stop, self.cold_upto) - start):
+                events[i] = self.loader(start + i)
+        return events
+
+    def spill(self, upto: int, loader: Callable[[int], "Event"]) -> int:
+        """把前 upto 个事件换出内存，返回本次换出的数量"""
+        with self.lock:
+            upto = min(upto, len(self.items))
+            if upto <= self.cold_upto:
+                return 0
+            self.loader = loader
+            for i in range(self.cold_upto, upto):
+                self.items[i] = None
+            spilled, self.cold_upto = upto - self.cold_upto, upto
+            return spilled
+
+    def push(self, event: "Event") -> None:
+        position = len(self.items)
+        if event.starts_turn:
+            self.turn_starts.append(position)
+        event.turn = len(self.turn_starts) - 1
+        positions = self.by_type.get(event.type)
+        if positions is None:
+            positions = self.by_type[event.type] = array("q")
+        positions.append(position)
+        self.items.append(event)
+
+
+class EventLog(Sequence["Event"]):
+    """不可变的事件日志
+
+    每个 EventLog 是底层共享数组上 [0, length) 的一个视图，本身从不修改：
+    - append 返回新日志。当前版本是数组的最新版本时直接追加到共享数组，O(1)
+    - 从旧版本（分叉点）追加时复制前 length 个元素的引用到新数组，之后在新数组上继续 O(1) 追加
+    - 快照和分叉只是共享同一个视图，O(1)
+    - of_type / last_of_type / since_turn 走索引，O(log n + k)
+    - spill 把冷数据（如压缩水位之前的事件）换出内存，访问时从持久化日志读回，内容不变
+
+    因此 reducer 仍是纯函数：旧状态永远看不到之后追加的事件。
+    """
+    __slots__ = ("_store", "_length")
+
+    def __init__(self, events: Optional[Sequence["Event"]] = None):
+        self._store = _Store(events)
+        self._length = len(self._store.items)
+
+    @classmethod
+    def _view(cls, store: _Store, length: int) -> "EventLog":
+        log = cls.__new__(cls)
+        log._store = store
+        log._length = length
+        return log
+
+    def append(self, event: "Event") -> "EventLog":
+        """返回追加了 event 的新日志，自身不变"""
+        store = self._store
+        with store.lock:
+            if len(store.items) == self._length:
+                store.push(event)
+                return self._view(store, self._length + 1)
+            # 共享数组已被其他分支追加过：复制到新数组（每个分支只发生一次）
+            new_store = store.prefix(self._length)
+        new_store.push(event)
+        return self._view(new_store, self._length + 1)
+
+    def extend(self, events: Sequence["Event"]) -> "EventLog":
+        log = self
+        for event in events:
+            log = log.append(event)
+        return log
+
+    def snapshot(self) -> "EventLog":
+        """不可变快照，O(1)"""
+        return self
+
+    def fork(self) -> "EventLog":
+        """分叉出一个分支（如假设推演），与当前日志共享已有事件，O(1)"""
+        return self._view(self._store, self._length)
+
+    def spill(self, upto: int, loader: Callable[[int], "Event"]) -> int:
+        """把前 upto 个事件换出内存（所有共享底层数组的版本一起生效），返回换出数量"""
+        return self._store.spill(min(upto, self._length), loader)
+
+    @property
+    def cold_count(self) -> int:
+        """已换出内存的事件数"""
+        return min(self._store.cold_upto, self._length)
+
+    def _positions(self, event_type) -> Sequence[int]:
+        positions = self._store.by_type.get(event_type)
+        if not positions:
+            return ()
+        return positions[:bisect.bisect_left(positions, self._length)]
+
+    def of_type(self, event_type) -> List["Event"]:
+        """指定类型的全部事件，按追加顺序"""
+        get = self._store.get
+        return [get(i) for i in self._positions(event_type)]
+
+    def last_of_type(self, event_type) -> Optional["Event"]:
+        """最近一个指定类型的事件，O(log n)"""
+        positions = self._store.by_type.get(event_type)
+        if not positions:
+            return None
+        hi = bisect.bisect_left(positions, self._length)
+        return self._store.get(positions[hi - 1]) if hi else None
+
+    @property
+    def turn_count(self) -> int:
+        """已开始的轮数（用户消息数）"""
+        return bisect.bisect_left(self._store.turn_starts, self._length, 1) - 1
+
+    def since_turn(self, turn: int) -> List["Event"]:
+        """第 turn 轮（含）之后的全部事件"""
+        if turn > self.turn_count:
+            return []
+        return self._store.slice(self._store.turn_starts[max(turn, 0)], self._length)
+
+    def __len__(self) -> int:
+        return self._length
+
+    @overload
+    def __getitem__(self, index: int) -> "Event": ...
+
+    @overload
+    def __getitem__(self, index: slice) -> List["Event"]: ...
+
+    def __getitem__(self, index: Union[int, slice]):
+        if isinstance(index, slice):
+            # 按自身长度裁剪，不会读到其他版本追加的事件
+            start, stop, step = index.indices(self._length)
+            if step == 1:
+                return self._store.slice(start, stop)
+            get = self._store.get
+            return [get(i) for i in range(start, stop, step)]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("事件下标越界")
+        return self._store.get(index)
+
+    def __iter__(self) -> Iterator["Event"]:
+        get = self._store.get
+        for i in range(self._length):
+            yield get(i)
+
+    def __reversed__(self) -> Iterator["Event"]:
+        get = self._store.get
+        for i in range(self._length - 1, -1, -1):
+            yield get(i)
+
+    def __bool__(self) -> bool:
+        return self._length > 0
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, EventLog):
+            return self._length == other._length and all(a is b or a == b for a, b in zip(self, other))
+        if isinstance(other, list):
+            return list(self) == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f"EventLog(len={self._length})"
@@ -0,0 +1,356 @@
+"""
+事件持久化日志 - 只追加的 JSONL 日志，分组提交 fsync、定期快照、mmap 随机读取
+
+文件（每个会话一组）：
+    <directory>/<session_id>.jsonl          每行一个事件 {"t": 类型, "ts": 纳秒时间戳, "turn": 轮次, "d": 内容}
+    <directory>/<session_id>.snapshot.json  最近一次快照
+
+恢复时加载快照，再回放快照之后的尾部，不需要从头回放；快照只保存热数据（压缩水位之后的事件）
+和索引，水位之前的冷事件留在日志文件里，需要时按偏移用 mmap 读回。
+"""
+import base64
+import bisect
+import json
+import mmap
+import os
+import threading
+import time
+from array import array
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from .event_log import EventLog, _Store
+from .state import Event, EventType
+
+SNAPSHOT_VERSION = 1
+
+
+def encode_event(event: Event) -> bytes:
+    record = {"t": event.type.label, "ts": event.timestamp, "turn": event.turn, "d": event.data}
+    return (json.dumps(record, ensure_ascii=False, separators=(",", ":"), default=str) + "\n").encode("utf-8")
+
+
+def decode_event(line: bytes) -> Event:
+    record = json.loads(line)
+    return Event(type=record["t"], timestamp=record["ts"], data=record["d"], turn=record.get("turn", 0))
+
+
+def _pack(values: array) -> str:
+    return base64.b64encode(values.tobytes()).decode("ascii")
+
+
+def _unpack(text: str) -> array:
+    values = array("q")
+    values.frombytes(base64.b64decode(text))
+    return values
+
+
+class EventJournal:
+    """单个会话的事件日志
+
+    - append(event): 编码后放入队列立即返回；后台写线程把队列里积攒的事件一次写入并 fsync（分组提交）
+    - flush(): 等待已追加的事件全部落盘
+    - snapshot(log, hot_from): 在写线程里序列化快照（EventLog 快照不可变，不阻塞调用方）
+    - load(): 快照 + 尾部恢复出 EventLog，冷事件不读入内存
+    - reset(): 清空日志和快照，由写线程按队列顺序执行，不与进行中的提交和快照竞争
+    写线程空闲 writer_idle_timeout 秒后退出，有新的追加时再启动
+    - read(index): 按偏移从 mmap 读取单个事件
+    """
+
+    def __init__(self, directory: str, session_id: str, fsync: bool = True,
+                 commit_interval: float = 0.0, max_batch: int = 1024, snapshot_every: int = 1000,
+                 writer_idle_timeout: float = 5.0):
+        os.makedirs(directory, exist_ok=True)
+        self.session_id = session_id
+        self.path = os.path.join(directory, f"{session_id}.jsonl")
+        self.snapshot_path = os.path.join(directory, f"{session_id}.snapshot.json")
+        self.fsync = fsync
+        self.commit_interval = commit_interval
+        self.max_batch = max_batch
+        self.snapshot_every = snapshot_every
+        self.writer_idle_timeout = writer_idle_timeout
+
+        self._offsets = array("q")  # 第 i 个事件在文件中的起始偏移
+        self._size = 0              # 已写入文件的有效字节数
+        self._file = None
+        self._mmap: Optional[mmap.mmap] = None
+        self._read_file = None
+        self._read_lock = threading.Lock()
+
+        self._queue: Deque[Tuple[str, Any]] = deque()
+        self._cond = threading.Condition()
+        self._appended = 0  # 已追加（含未落盘）的事件数，只增不减
+        self._durable = 0   # 已落盘的事件数，只增不减
+        self._base = 0      # 被 reset 清掉的事件数（len 不计入）
+        self._closed = False
+        self._writer: Optional[threading.Thread] = None
+        self._error: Optional[BaseException] = None
+        self.stats = {"commits": 0, "events": 0, "snapshots": 0, "bytes": 0, "fsync_seconds": 0.0,
+                      "cold_reads": 0, "resume_replayed": 0}
+
+    # ---------- 恢复 ----------
+
+    def load(self) -> EventLog:
+        """恢复事件日志：有快照时加载快照再回放尾部，否则从头回放"""
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        snapshot = self._read_snapshot(size)
+        if snapshot is not None:
+            store = self._restore_store(snapshot)
+            self._offsets = _unpack(snapshot["offsets"])
+            start = snapshot["size"]
+        else:
+            store = _Store()
+            self._offsets = array("q")
+            start = 0
+
+        valid = start
+        replayed = 0
+        if size > start:
+            with open(self.path, "rb") as f:
+                f.seek(start)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # 崩溃时写了一半的最后一行
+                    self._offsets.append(valid)
+                    store.push(decode_event(line))
+                    valid += len(line)
+                    replayed += 1
+            if valid < size:
+                os.truncate(self.path, valid)
+        self._size = valid
+        self._appended = self._durable = len(store.items)
+        self._base = 0
+        self.stats["resume_replayed"] = replayed
+        if store.cold_upto:
+            store.loader = self.read
+        return EventLog._view(store, len(store.items))
+
+    def _read_snapshot(self, journal_size: int) -> Optional[Dict[str, Any]]:
+        if not os.path.exists(self.snapshot_path):
+            return None
+        try:
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"读取快照失败，从头回放: {e}")
+            return None
+        if snapshot.get("version") != SNAPSHOT_VERSION or snapshot.get("size", 0) > journal_size:
+            return None
+        return snapshot
+
+    def _restore_store(self, snapshot: Dict[str, Any]) -> _Store:
+        hot_from = snapshot["hot_from"]
+        store = _Store()
+        store.items = [None] * hot_from
+        store.items.extend(Event(type=r["t"], timestamp=r["ts"], data=r["d"], turn=r.get("turn", 0))
+                           for r in snapshot["events"])
+        store.by_type = {EventType.coerce(label): _unpack(packed) for label, packed in snapshot["by_type"].items()}
+        store.turn_starts = _unpack(snapshot["turn_starts"])
+        store.cold_upto = hot_from
+        return store
+
+    # ---------- 写入 ----------
+
+    def append(self, event: Event) -> None:
+        """追加一个事件（不等待落盘）"""
+        data = encode_event(event)
+        with self._cond:
+            self._raise_if_failed()
+            self._queue.append(("event", data))
+            self._appended += 1
+            self._cond.notify_all()
+        self._ensure_writer()
+
+    def snapshot(self, log: EventLog, hot_from: int = 0) -> None:
+        """异步写快照：log 的前 hot_from 个事件只保存偏移，之后的事件完整保存"""
+        with self._cond:
+            self._queue.append(("snapshot", (log, min(hot_from, len(log)))))
+            self._cond.notify_all()
+        self._ensure_writer()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """等待已追加的事件全部落盘，超时返回 False"""
+        with self._cond:
+            target = self._appended
+            ok = self._cond.wait_for(lambda: self._durable >= target or self._error is not None, timeout)
+            self._raise_if_failed()
+            return ok
+
+    def durable_count(self) -> int:
+        """已落盘、可以用 read() 读取的事件数（不等待写线程）"""
+        with self._cond:
+            return self._durable - self._base
+
+    def reset(self) -> None:
+        """清空日志和快照（会话被清空时）
+
+        交给写线程在队列里排队执行：之前追加的事件和快照先写完，再关闭文件、删除日志，
+        不会在写线程提交时关掉它正在写的文件。
+        """
+        done = threading.Event()
+        with self._cond:
+            self._raise_if_failed()
+            if self._closed:
+                # 写线程已经退出，直接在当前线程清空
+                self._reset_files(done)
+                return
+            self._queue.append(("reset", done))
+            self._cond.notify_all()
+        self._ensure_writer()
+        with self._cond:
+            self._cond.wait_for(lambda: done.is_set() or self._error is not None)
+            self._raise_if_failed()
+
+    def close(self) -> None:
+        self.flush()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            writer = self._writer
+        if writer is not None:
+            writer.join()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._close_reader()
+
+    def _raise_if_failed(self) -> None:
+        if self._error is not None:
+            raise RuntimeError(f"事件日志写入失败: {self._error}") from self._error
+
+    def _ensure_writer(self) -> None:
+        if self._writer is None:
+            with self._cond:
+                if self._writer is None and not self._closed:
+                    self._writer = threading.Thread(target=self._run, name=f"journal-{self.session_id}", daemon=True)
+                    self._writer.start()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                if not self._cond.wait_for(lambda: self._queue or self._closed, self.writer_idle_timeout):
+                    # 空闲会话不占线程（服务模式下可能有上千个会话），下次追加时重新启动
+                    self._writer = None
+                    return
+                if not self._queue and self._closed:
+                    return
+            if self.commit_interval:
+                time.sleep(self.commit_interval)  # 多等一会儿，让更多事件进入同一次提交
+            with self._cond:
+                batch = [self._queue.popleft() for _ in range(min(len(self._queue), self.max_batch))]
+            try:
+                self._commit(batch)
+            except BaseException as e:  # 写失败后拒绝后续追加，避免日志出现空洞
+                with self._cond:
+                    self._error = e
+                    self._cond.notify_all()
+                return
+
+    def _commit(self, batch: List[Tuple[str, Any]]) -> None:
+        """按队列顺序提交：连续的事件一次写入，快照和重置在它们之前的事件写完后执行"""
+        events = []
+        for kind, payload in batch:
+            if kind == "event":
+                events.append(payload)
+                continue
+            self._write_events(events)
+            events = []
+            if kind == "snapshot":
+                self._write_snapshot(*payload)
+            else:
+                self._reset_files(payload)
+        self._write_events(events)
+
+    def _write_events(self, events: List[bytes]) -> None:
+        if not events:
+            return
+        if self._file is None:
+            self._file = open(self.path, "ab")
+        offset = self._size
+        for data in events:
+            self._offsets.append(offset)
+            offset += len(data)
+        self._file.write(b"".join(events))
+        self._file.flush()
+        if self.fsync:
+            start = time.perf_counter()
+            os.fsync(self._file.fileno())
+            self.stats["fsync_seconds"] += time.perf_counter() - start
+        self._size = offset
+        self.stats["commits"] += 1
+        self.stats["events"] += len(events)
+        self.stats["bytes"] += sum(map(len, events))
+        with self._cond:
+            self._durable += len(events)
+            self._cond.notify_all()
+
+    def _reset_files(self, done: threading.Event) -> None:
+        """关闭并删除日志和快照（在写线程里执行，或写线程退出之后）"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        with self._read_lock:
+            self._close_reader()
+        for path in (self.path, self.snapshot_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self._offsets = array("q")
+        self._size = 0
+        with self._cond:
+            # 队列里排在重置之前的事件都已落盘并被清掉，之后追加的还在队列里
+            self._base = self._durable
+            done.set()
+            self._cond.notify_all()
+
+    def _write_snapshot(self, log: EventLog, hot_from: int) -> None:
+        n = len(log)
+        if n > len(self._offsets):
+            return  # 快照里有尚未写入日志的事件（不应发生），跳过
+        store = log._store
+        size = self._offsets[n] if n < len(self._offsets) else self._size
+        snapshot = {
+            "version": SNAPSHOT_VERSION,
+            "count": n,
+            "size": size,
+            "hot_from": hot_from,
+            "offsets": _pack(self._offsets[:n]),
+            "by_type": {event_type.label: _pack(positions[:bisect.bisect_left(positions, n)])
+                        for event_type, positions in store.by_type.items()},
+            "turn_starts": _pack(store.turn_starts[:bisect.bisect_left(store.turn_starts, n, 1)]),
+            "events": [{"t": e.type.label, "ts": e.timestamp, "turn": e.turn, "d": e.data}
+                       for e in log[hot_from:]],
+        }
+        tmp = self.snapshot_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, ensure_ascii=False, separators=(",", ":"), default=str)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path)
+        self.stats["snapshots"] += 1
+
+    # ---------- 随机读取 ----------
+
+    def read(self, index: int) -> Event:
+        """读取第 index 个已落盘的事件"""
+        start = self._offsets[index]
+        end = self._offsets[index + 1] if index + 1 < len(self._offsets) else self._size
+        with self._read_lock:
+            if self._mmap is None or len(self._mmap) < end:
+                self._close_reader()
+                self._read_file = open(self.path, "rb")
+                self._mmap = mmap.mmap(self._read_file.fileno(), 0, access=mmap.ACCESS_READ)
+            line = self._mmap[start:end]
+            self.stats["cold_reads"] += 1
+        return decode_event(line)
+
+    def _close_reader(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._read_file is not None:
+            self._read_file.close()
+            self._read_file = None
+
+    def __len__(self) -> int:
+        return self._appended - self._base
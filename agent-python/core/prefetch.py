@@ -0,0 +1,242 @@
+"""
+记忆预取 - 用户消息一到就在后台检索相关记忆，与 LLM 调用重叠；
+模型随后用相近的查询请求 get_relevant_memories 时直接使用预取的结果，省掉这次检索的等待
+"""
+import asyncio
+import re
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from memory_system import get_memory_version, user_scope
+from tools import get_registry
+from tools.registry import get_tool_executor
+
+MEMORY_TOOL = "get_relevant_memories"
+
+# 全进程同时在途的预取上限，超出时本轮不预取（模型真的需要时照常执行工具）
+MAX_IN_FLIGHT = 16
+
+
+def query_terms(text: str) -> Set[str]:
+    """查询的检索特征：英文单词、数字和中文相邻两字（单独的汉字保留原字）"""
+    text = text.lower()
+    terms = set(re.findall(r'[a-z0-9]+', text))
+    for run in re.findall(r'[\u4e00-\u9fff]+', text):
+        if len(run) == 1:
+            terms.add(run)
+        terms.update(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+def query_similarity(query: str, prefetched_query: str) -> float:
+    """模型查询的特征有多大比例出现在预取的查询里
+
+    模型通常从用户消息里摘取关键词作为查询，所以按模型查询一侧归一化，而不是对称的相似度。
+    """
+    terms = query_terms(query)
+    if not terms:
+        return 0.0
+    return len(terms & query_terms(prefetched_query)) / len(terms)
+
+
+class _PrefetchStats:
+    """全进程的预取统计和在途计数（线程安全）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {"started": 0, "skipped": 0, "hits": 0, "ready_hits": 0, "misses": 0,
+                       "mismatches": 0, "stale": 0, "failed": 0, "wasted": 0}
+        self.in_flight = 0
+
+    def count(self, name: str) -> None:
+        with self._lock:
+            self._stats[name] += 1
+
+    def try_enter(self) -> bool:
+        with self._lock:
+            if self.in_flight >= MAX_IN_FLIGHT:
+                self._stats["skipped"] += 1
+                return False
+            self.in_flight += 1
+            self._stats["started"] += 1
+            return True
+
+    def leave(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            stats: Dict[str, Any] = dict(self._stats)
+            stats["in_flight"] = self.in_flight
+        started = stats["started"]
+        stats["hit_rate"] = stats["hits"] / started if started else 0.0
+        stats["waste_rate"] = stats["wasted"] / started if started else 0.0
+        return stats
+
+
+_stats = _PrefetchStats()
+
+
+def get_prefetch_stats() -> Dict[str, Any]:
+    """预取统计：started/skipped 为启动和因在途上限跳过的次数；hits 为被模型的工具调用用上的次数，
+    ready_hits 为其中用上时已经检索完毕的次数；misses 为模型请求记忆时没有可用预取，mismatches 为查询不够相近，
+    stale 为预取之后记忆有写入；wasted 为直到下一条用户消息都没被用上的预取"""
+    return _stats.snapshot()
+
+
+class _Prefetch:
+    """一次预取：查询、后台任务和检索时的记忆版本"""
+
+    def __init__(self, query: str):
+        self.query = query
+        self.version: Optional[int] = None
+        self.future: Optional[Future] = None
+        self.claims = 0
+
+
+class MemoryPrefetcher:
+    """单个会话的记忆预取
+
+    - start(user_input): 用户消息加入状态时调用，在共享工具线程池里以整条消息为查询检索记忆，
+      同时写入工具结果缓存；同一会话只保留最近一次预取，上一次没被用上的计为浪费
+    - execute(calls, execute) / aexecute(calls, aexecute): 执行一批工具调用，查询足够相近的
+      get_relevant_memories 调用直接取预取结果，其余调用交给 execute 照常执行
+    - 预取失败、超时或之后记忆有写入时，对应调用照常执行，不影响结果的正确性
+    """
+
+    def __init__(self, user_id: str = "default", similarity_threshold: float = 0.6, min_query_chars: int = 4):
+        self.user_id = user_id
+        self.similarity_threshold = similarity_threshold
+        self.min_query_chars = min_query_chars
+        self._current: Optional[_Prefetch] = None
+        self._lock = threading.Lock()
+
+    def start(self, user_input: str) -> bool:
+        """为新的用户消息启动预取，返回是否启动"""
+        self._retire()
+        query = " ".join(user_input.split())
+        if len(query) < self.min_query_chars or MEMORY_TOOL not in get_registry().tools:
+            return False
+        if not _stats.try_enter():
+            return False
+        prefetch = _Prefetch(query)
+        prefetch.future = get_tool_executor().submit(self._retrieve, prefetch)
+        prefetch.future.add_done_callback(lambda _: _stats.leave())
+        with self._lock:
+            self._current = prefetch
+        return True
+
+    def close(self) -> None:
+        self._retire()
+
+    def execute(self, calls: List[Dict[str, Any]],
+                execute: Callable[[List[Dict[str, Any]]], List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        """执行工具调用列表，结果按调用顺序返回（预取检索与其余调用同时进行）"""
+        matched = self._match_calls(calls)
+        if not matched:
+            return execute(calls)
+        rest = [call for i, call in enumerate(calls) if i not in matched]
+        rest_results = iter(execute(rest) if rest else [])
+        results = []
+        for i, call in enumerate(calls):
+            if i in matched:
+                results.append(self._resolve(matched[i]) or execute([call])[0])
+            else:
+                results.append(next(rest_results))
+        return results
+
+    async def aexecute(self, calls: List[Dict[str, Any]],
+                       aexecute: Callable[[List[Dict[str, Any]]], Awaitable[List[Dict[str, Any]]]]
+                       ) -> List[Dict[str, Any]]:
+        """异步版本的 execute"""
+        matched = self._match_calls(calls)
+        if not matched:
+            return await aexecute(calls)
+        rest = [call for i, call in enumerate(calls) if i not in matched]
+        indices = list(matched)
+        pending = [self._aresolve(matched[i]) for i in indices]
+        if rest:
+            pending.append(aexecute(rest))
+        outcomes = await asyncio.gather(*pending)
+        served = dict(zip(indices, outcomes))
+        rest_results = iter(outcomes[len(indices)] if rest else [])
+        results = []
+        for i, call in enumerate(calls):
+            if i in matched:
+                results.append(served[i] or (await aexecute([call]))[0])
+            else:
+                results.append(next(rest_results))
+        return results
+
+    def _retrieve(self, prefetch: _Prefetch) -> Dict[str, Any]:
+        with user_scope(self.user_id):
+            # 先取版本号再检索：检索期间有写入时版本号已经变化，结果会被当作过期
+            prefetch.version = get_memory_version(self.user_id)
+            return get_registry().execute_call({"tool_name": MEMORY_TOOL, "parameters": {"user_input": prefetch.query}})
+
+    def _retire(self) -> None:
+        """丢弃当前预取：没被用上的计为浪费，还没开始执行的直接取消"""
+        with self._lock:
+            prefetch, self._current = self._current, None
+        if prefetch is None:
+            return
+        if prefetch.claims == 0:
+            _stats.count("wasted")
+        prefetch.future.cancel()
+
+    def _match_calls(self, calls: List[Dict[str, Any]]) -> Dict[int, _Prefetch]:
+        """找出可以用预取结果的调用（调用下标 -> 预取）"""
+        matched = {}
+        for i, call in enumerate(calls):
+            if call["tool_name"] != MEMORY_TOOL:
+                continue
+            with self._lock:
+                prefetch = self._current
+            if prefetch is None:
+                _stats.count("misses")
+                continue
+            query = str(call["parameters"].get("user_input", ""))
+            if query_similarity(query, prefetch.query) < self.similarity_threshold:
+                _stats.count("mismatches")
+                continue
+            matched[i] = prefetch
+        return matched
+
+    def _accept(self, prefetch: _Prefetch, result: Optional[Dict[str, Any]], ready: bool) -> Optional[Dict[str, Any]]:
+        """检查预取结果是否可用，可用时计入命中"""
+        if result is None or not result.get("success"):
+            _stats.count("failed")
+            return None
+        if prefetch.version != get_memory_version(self.user_id):
+            _stats.count("stale")
+            return None
+        with self._lock:
+            prefetch.claims += 1
+        _stats.count("hits")
+        if ready:
+            _stats.count("ready_hits")
+        return result
+
+    def _timeout(self) -> Optional[float]:
+        return get_registry().get_tool(MEMORY_TOOL).timeout
+
+    def _resolve(self, prefetch: _Prefetch) -> Optional[Dict[str, Any]]:
+        """等待预取完成并返回结果，不可用时返回 None"""
+        ready = prefetch.future.done()
+        try:
+            result = prefetch.future.result(timeout=self._timeout())
+        except Exception:  # 超时、被取消或检索出错
+            result = None
+        return self._accept(prefetch, result, ready)
+
+    async def _aresolve(self, prefetch: _Prefetch) -> Optional[Dict[str, Any]]:
+        ready = prefetch.future.done()
+        if prefetch.future.cancelled():
+            return self._accept(prefetch, None, ready)
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(prefetch.future), self._timeout())
+        except Exception:
+            result = None
+        return self._accept(prefetch, result, ready)
@@ -0,0 +1,164 @@
+"""
+自动回忆 - 第一次 LLM 调用之前用用户的最新消息检索记忆，相关度足够高的几条直接放进上下文，
+省掉"调用 get_relevant_memories -> 执行工具 -> 再调用一次 LLM"的来回
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Any, Dict, List, Optional, Sequence
+
+from memory_system import search_memories
+from tools.registry import get_tool_executor
+from .prefetch import MEMORY_TOOL
+from .state import Event, EventType, last_event_of_type
+
+RECALL_HEADER = "# 与用户最新消息相关的记忆（已自动检索，不必再用 get_relevant_memories 查询同样的内容）："
+
+
+class _RecallStats:
+    """全进程的自动回忆统计（线程安全）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {"turns": 0, "injected": 0, "memories_injected": 0, "below_threshold": 0,
+                       "timeouts": 0, "errors": 0, "busy": 0, "search_seconds": 0.0,
+                       "tool_calls_after_recall": 0, "tool_calls_without_recall": 0, "saved_round_trips": 0}
+
+    def add(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self._stats[name] += value
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            stats: Dict[str, Any] = dict(self._stats)
+        searched = stats["injected"] + stats["below_threshold"]
+        search_seconds = stats.pop("search_seconds")
+        stats["mean_search_ms"] = search_seconds / searched * 1000 if searched else None
+        stats["inject_rate"] = stats["injected"] / stats["turns"] if stats["turns"] else 0.0
+        return stats
+
+
+_stats = _RecallStats()
+
+
+def get_recall_stats() -> Dict[str, Any]:
+    """自动回忆统计：turns 为检索过的用户消息数；injected 为注入了记忆的轮数，below_threshold 为没有记忆
+    达到阈值，timeouts 为超出延迟预算（本轮不注入），busy 为上一次超时的检索还没结束而跳过；
+    tool_calls_after_recall 为注入之后模型仍然调用了 get_relevant_memories 的轮数（注入没有省掉来回），
+    tool_calls_without_recall 为没有注入而模型调用了该工具的轮数，saved_round_trips 为注入之后模型没有再调用的轮数"""
+    return _stats.snapshot()
+
+
+class MemoryRecall:
+    """单个会话的自动回忆，作为 ContextBuilder 的一段
+
+    - prepare(events) / aprepare(events): 每条新的用户消息检索一次（在共享工具线程池中执行），
+      最多等待 latency_budget 秒，超出预算时本轮不注入，不拖慢第一次 LLM 调用
+    - section(events): 本轮要注入的内容；只有相关度不低于 min_score 的前 top_k 条记忆才注入
+    - observe(calls): 记录本轮模型是否仍然调用了 get_relevant_memories，用来评估注入是否真的省掉了来回
+    """
+
+    def __init__(self, user_id: str = "default", top_k: int = 3, min_score: float = 0.1,
+                 latency_budget: float = 0.1):
+        self.user_id = user_id
+        self.top_k = top_k
+        self.min_score = min_score
+        self.latency_budget = latency_budget
+        self._lock = threading.Lock()
+        self._event: Optional[Event] = None
+        self._section = ""
+        self._injected = False
+        self._tool_called = False
+        self._pending: Optional[Future] = None
+
+    def prepare(self, events: Sequence[Event]) -> None:
+        """为最新的用户消息检索记忆（已经检索过时直接返回）"""
+        future = self._start(events)
+        if future is None:
+            return
+        start = time.perf_counter()
+        try:
+            memories = future.result(timeout=self.latency_budget)
+        except FutureTimeoutError:
+            _stats.add("timeouts")
+            return
+        except Exception as e:
+            _stats.add("errors")
+            print(f"自动回忆检索失败: {e}")
+            return
+        self._finish(memories, time.perf_counter() - start)
+
+    async def aprepare(self, events: Sequence[Event]) -> None:
+        """异步版本的 prepare：等待检索时不阻塞事件循环"""
+        future = self._start(events)
+        if future is None:
+            return
+        start = time.perf_counter()
+        try:
+            memories = await asyncio.wait_for(asyncio.wrap_future(future), self.latency_budget)
+        except asyncio.TimeoutError:
+            _stats.add("timeouts")
+            return
+        except Exception as e:
+            _stats.add("errors")
+            print(f"自动回忆检索失败: {e}")
+            return
+        self._finish(memories, time.perf_counter() - start)
+
+    def section(self, events: Sequence[Event]) -> str:
+        """本轮注入的记忆段，没有可注入的记忆时返回空串"""
+        self.prepare(events)
+        return self._section
+
+    def observe(self, calls: List[Dict[str, Any]]) -> None:
+        """记录本轮执行的工具调用（每轮只统计第一次记忆工具调用）"""
+        if not any(call["tool_name"] == MEMORY_TOOL for call in calls):
+            return
+        with self._lock:
+            if self._event is None or self._tool_called:
+                return
+            self._tool_called = True
+            injected = self._injected
+        _stats.add("tool_calls_after_recall" if injected else "tool_calls_without_recall")
+
+    def close(self) -> None:
+        with self._lock:
+            self._end_turn()
+            self._event = None
+
+    def _start(self, events: Sequence[Event]) -> Optional[Future]:
+        """新的用户消息开始一轮：结算上一轮，提交检索；不需要检索时返回 None"""
+        event = last_event_of_type(events, EventType.USER_MESSAGE)
+        with self._lock:
+            if event is None or event is self._event:
+                return None
+            self._end_turn()
+            self._event = event
+            self._section, self._injected, self._tool_called = "", False, False
+        query = str(event.data.get("content", ""))
+        if not query.strip():
+            return None
+        _stats.add("turns")
+        if self._pending is not None and not self._pending.done():
+            # 上一次超时的检索还在执行，不再叠加新的检索
+            _stats.add("busy")
+            return None
+        self._pending = get_tool_executor().submit(search_memories, query, self.user_id, self.top_k, self.min_score)
+        return self._pending
+
+    def _finish(self, memories: List[Dict[str, Any]], elapsed: float) -> None:
+        _stats.add("search_seconds", elapsed)
+        if not memories:
+            _stats.add("below_threshold")
+            return
+        with self._lock:
+            self._section = RECALL_HEADER + "\n" + "\n".join(f"- {memory['content']}" for memory in memories)
+            self._injected = True
+        _stats.add("injected")
+        _stats.add("memories_injected", len(memories))
+
+    def _end_turn(self) -> None:
+        """结算上一轮：注入了记忆且模型没有再调用记忆工具，视为省掉了一次来回（调用方持有锁）"""
+        if self._event is not None and self._injected and not self._tool_called:
+            _stats.add("saved_round_trips")
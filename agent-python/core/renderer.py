@@ -0,0 +1,180 @@
+"""
+增量事件渲染器 - 缓存每个事件渲染出的文本，只渲染新追加的事件
+"""
+from typing import Callable, List, Optional, Sequence
+
+from .state import Event, EventTypes
+
+EMPTY_HISTORY = "暂无对话历史"
+
+
+def render_event(event: Event, fit_tool_result: Optional[Callable[[str], str]] = None) -> str:
+    """把单个事件渲染成文本（可能多行，不产生内容的事件返回空串）
+
+    fit_tool_result: 可选，对单条工具结果文本做截断
+    """
+    lines = []
+    if event.type == EventTypes.USER_MESSAGE:
+        content = event.data.get('content', '')
+        lines.append(f"用户说: {content}")
+    elif event.type == EventTypes.TOOL_RESULT:
+        # 适配 tools 系统的结果格式
+        results = event.data.get('results', [])
+        for result in results:
+            tool_name = result.get('tool_name', '')
+            success = result.get('success', False)
+            if success:
+                result_data = result.get('result', {})
+                # 统一使用工具返回的message字段
+                message = result_data.get('message', f"{tool_name}执行成功")
+                if fit_tool_result is not None:
+                    message = fit_tool_result(str(message))
+                lines.append(f"工具执行结果: {message}")
+            else:
+                error_msg = result.get('error', '')
+                lines.append(f"工具执行失败: {tool_name} - {error_msg}")
+    elif event.type == EventTypes.AGENT_MESSAGE:
+        content = event.data.get('content', '')
+        lines.append(f"我回复: {content}")
+    return "\n".join(lines)
+
+
+class EventRenderer:
+    """增量渲染事件历史
+
+    事件列表只追加（StateManager 的 reducer 保证），因此只要首尾事件对象没变，
+    就只需渲染新增部分。前面的事件被移除（截断）时复用已渲染的文本，只重新拼接。
+    其他情况（清空、替换）退化为全量渲染。
+
+    维护：
+    - chunks[i]: 第 i 个事件的渲染文本
+    - offsets[i]: 第 i 个事件在 text 中的起始位置（不产生内容的事件与下一个事件相同）
+    - text: 拼接好的历史文本
+    - total_chars / total_tokens: 运行中的字符数和 token 数
+    - token_prefix[i]: 前 i 个事件的 token 数（含换行分隔符），用于二分查找截断点
+    """
+
+    def __init__(self, count_tokens: Optional[Callable[[str], int]] = None,
+                 fit_tool_result: Optional[Callable[[str], str]] = None):
+        self.count_tokens = count_tokens
+        self.fit_tool_result = fit_tool_result
+        self.stats = {"rendered": 0, "full_renders": 0, "rebases": 0}
+        self.reset()
+
+    def reset(self) -> None:
+        self._events: List[Event] = []
+        self.chunks: List[str] = []
+        self.offsets: List[int] = []
+        self.token_counts: List[int] = []
+        self.text = ""
+        self._token_prefix: List[int] = [0]
+
+    @property
+    def total_chars(self) -> int:
+        return len(self.text)
+
+    @property
+    def token_prefix(self) -> List[int]:
+        """token 前缀和，按需为新事件计数；长度为事件数 + 1"""
+        if self.count_tokens is None:
+            raise ValueError("EventRenderer 未配置 count_tokens")
+        prefix = self._token_prefix
+        for chunk in self.chunks[len(self.token_counts):]:
+            n = self.count_tokens(chunk) if chunk else 0
+            self.token_counts.append(n)
+            prefix.append(prefix[-1] + (n + 1 if chunk else 0))
+        return prefix
+
+    @property
+    def total_tokens(self) -> int:
+        """已渲染历史的 token 数（每个块多算一个换行分隔符，偏保守）"""
+        return self.token_prefix[-1]
+
+    def suffix_tokens(self, start_index: int) -> int:
+        """从第 start_index 个事件开始的历史 token 数"""
+        prefix = self.token_prefix
+        return prefix[-1] - prefix[min(max(start_index, 0), len(prefix) - 1)]
+
+    def render(self, events: Sequence[Event]) -> str:
+        """返回事件列表对应的历史文本，与逐个格式化再用换行拼接的结果一致"""
+        if not events:
+            if self._events:
+                self.reset()
+            return EMPTY_HISTORY
+
+        n = len(self._events)
+        if n and len(events) >= n and events[0] is self._events[0] and events[n - 1] is self._events[-1]:
+            self._append(events[n:])
+        elif not (n and self._rebase(events)):
+            self._full_render(events)
+
+        return self.text
+
+    def _append(self, new_events: List[Event]) -> None:
+        parts = []
+        length = len(self.text)
+        for event in new_events:
+            chunk = render_event(event, self.fit_tool_result)
+            self.stats["rendered"] += 1
+            self._events.append(event)
+            self.chunks.append(chunk)
+            if chunk:
+                if length:
+                    length += 1  # 换行分隔符
+                self.offsets.append(length)
+                length += len(chunk)
+                parts.append(chunk)
+            else:
+                self.offsets.append(length)
+        if parts:
+            joined = "\n".join(parts)
+            self.text = f"{self.text}\n{joined}" if self.text else joined
+
+    def _rebase(self, events: Sequence[Event]) -> bool:
+        """前面的事件被移除：复用已渲染的文本。成功返回 True"""
+        first = events[0]
+        start = next((i for i, e in enumerate(self._events) if e is first), None)
+        if start is None:
+            return False
+        kept = len(self._events) - start
+        if len(events) < kept or events[kept - 1] is not self._events[-1]:
+            return False
+
+        self.stats["rebases"] += 1
+        old_events, old_chunks = self._events[start:], self.chunks[start:]
+        old_tokens = self.token_counts[start:]
+        self._events, self.chunks, self.offsets, self.token_counts = [], [], [], []
+        self.text = ""
+        # 复用已渲染的块，只重新计算偏移
+        length = 0
+        for event, chunk in zip(old_events, old_chunks):
+            self._events.append(event)
+            self.chunks.append(chunk)
+            if chunk:
+                if length:
+                    length += 1
+                self.offsets.append(length)
+                length += len(chunk)
+            else:
+                self.offsets.append(length)
+        self.text = "\n".join(chunk for chunk in old_chunks if chunk)
+        self.token_counts = old_tokens
+        self._token_prefix = [0]
+        for chunk, n in zip(old_chunks, old_tokens):
+            self._token_prefix.append(self._token_prefix[-1] + (n + 1 if chunk else 0))
+        self._append(events[kept:])
+        return True
+
+    def _full_render(self, events: Sequence[Event]) -> None:
+        self.reset()
+        self.stats["full_renders"] += 1
+        self._append(events)
+
+    def suffix(self, start_index: int) -> str:
+        """从第 start_index 个事件开始的历史文本（不重新渲染）"""
+        if start_index <= 0:
+            return self.text
+        if start_index >= len(self._events):
+            return ""
+        suffix = self.text[self.offsets[start_index]:]
+        return suffix[1:] if suffix.startswith("\n") else suffix
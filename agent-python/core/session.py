@@ -0,0 +1,388 @@
+"""
+会话管理 - 服务模式下一个进程同时承载多个会话
+
+每个会话有自己的 Agent（StateManager + 持久化日志）和 user_id：
+- 准入控制：同时处理的轮次不超过 max_active_turns，排队的请求超过 max_waiting_turns 时直接拒绝（背压），
+  同一会话排队的消息超过 max_pending_per_session 时也拒绝
+- 常驻会话超过 max_resident_sessions 时按 LRU 换出空闲会话；空闲超过 idle_timeout 的会话由后台任务换出
+- 换出只是写快照并关闭日志（事件本来就已逐条落盘），下一条消息到达时从快照 + 尾部恢复
+
+所有方法都在同一个事件循环上调用；恢复和换出的文件操作放到线程池执行。
+"""
+import asyncio
+import json
+import os
+import re
+import time
+import uuid
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, List, Optional, Set
+
+from .agent import Agent
+from .context import ContextBuilder
+from .journal import EventJournal
+from .prefetch import get_prefetch_stats
+from .recall import get_recall_stats
+from tools import get_tool_cache_stats
+
+_SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+class ServerBusyError(RuntimeError):
+    """超出准入上限，调用方应稍后重试"""
+
+    def __init__(self, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class SessionNotFoundError(KeyError):
+    """会话不存在（内存和磁盘上都没有）"""
+
+
+class SessionExistsError(ValueError):
+    """新建会话时指定的 ID 已被占用"""
+
+
+@dataclass
+class SessionConfig:
+    """会话管理配置"""
+    storage_dir: str = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sessions")
+    max_resident_sessions: int = 1000    # 常驻内存的会话数上限（LRU 换出）
+    idle_timeout: float = 600.0          # 空闲多少秒后换出到磁盘
+    sweep_interval: float = 30.0         # 空闲检查间隔
+    max_active_turns: int = 64           # 同时处理的轮次上限
+    max_waiting_turns: int = 256         # 排队等待的轮次上限，超出时拒绝
+    max_pending_per_session: int = 4     # 单个会话排队的消息上限
+    retry_after: float = 1.0             # 拒绝时建议的重试间隔（秒）
+    max_context_length: int = 8000
+    context_layout: str = ContextBuilder.LAYOUT_STABLE
+    max_iterations: int = 3
+    fsync: bool = True
+    prefetch_memories: bool = False      # 用户消息一到就预取相关记忆（见 core/prefetch.py）
+    pre_retrieval: bool = False          # 第一次 LLM 调用之前自动检索记忆放进上下文（见 core/recall.py）
+    rolling_summary: bool = False        # 截掉的历史在后台合并成滚动摘要（见 core/summary.py）
+    latency_window: int = 2000           # 统计 p50/p99 的最近轮次数
+
+
+class Session:
+    """一个常驻内存的会话"""
+
+    def __init__(self, session_id: str, user_id: str, agent: Agent):
+        self.session_id = session_id
+        self.user_id = user_id
+        self.agent = agent
+        self.pending = 0  # 排队中和处理中的消息数
+        self.last_active = time.monotonic()
+
+    @property
+    def busy(self) -> bool:
+        return self.pending > 0
+
+    def info(self) -> Dict[str, Any]:
+        events = self.agent.state_manager.events
+        return {
+            "session_id": self.session_id,
+            "user_id": self.user_id,
+            "resident": True,
+            "events": len(events),
+            "turns": events.turn_count,
+            "pending": self.pending,
+            "idle_seconds": round(time.monotonic() - self.last_active, 3),
+        }
+
+
+class SessionManager:
+    """会话管理器：创建、查找、换出和恢复会话，并对每轮处理做准入控制"""
+
+    def __init__(self, config: Optional[SessionConfig] = None,
+                 agent_factory: Optional[Callable[[str, str, EventJournal], Agent]] = None):
+        self.config = config or SessionConfig()
+        os.makedirs(self.config.storage_dir, exist_ok=True)
+        self.agent_factory = agent_factory or self._create_agent
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()  # 按最近使用排序
+        self._loading: Dict[str, asyncio.Future] = {}
+        self._closing: Dict[str, asyncio.Future] = {}  # 正在换出的会话，换出完成前不能重新打开日志
+        self._fresh: Set[str] = set()  # 刚加载、还没交给调用方的会话，容量检查时不换出
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._active = 0
+        self._waiting = 0
+        self._latencies: Deque[float] = deque(maxlen=self.config.latency_window)
+        self._sweeper: Optional[asyncio.Task] = None
+        self.stats = {"created": 0, "rehydrated": 0, "evicted": 0, "turns": 0,
+                      "rejected": 0, "failed": 0, "peak_resident": 0}
+
+    # ---------- 生命周期 ----------
+
+    async def start(self) -> None:
+        """启动空闲会话换出任务"""
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def close(self) -> None:
+        """换出全部会话（写快照并关闭日志）"""
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+            self._sweeper = None
+        for session_id in list(self._sessions):
+            await self._evict(session_id)
+
+    def _create_agent(self, session_id: str, user_id: str, journal: EventJournal) -> Agent:
+        return Agent(max_iterations=self.config.max_iterations,
+                     max_context_length=self.config.max_context_length,
+                     context_layout=self.config.context_layout,
+                     journal=journal, user_id=user_id,
+                     prefetch_memories=self.config.prefetch_memories,
+                     pre_retrieval=self.config.pre_retrieval,
+                     rolling_summary=self.config.rolling_summary)
+
+    # ---------- 查找与恢复 ----------
+
+    def _meta_path(self, session_id: str) -> str:
+        return os.path.join(self.config.storage_dir, f"{session_id}.meta.json")
+
+    @staticmethod
+    def validate_session_id(session_id: str) -> str:
+        if not isinstance(session_id, str) or not _SESSION_ID_PATTERN.match(session_id):
+            raise ValueError(f"非法的会话 ID: {session_id!r}")
+        return session_id
+
+    def exists(self, session_id: str) -> bool:
+        return (session_id in self._sessions or session_id in self._loading
+                or os.path.exists(self._meta_path(session_id)))
+
+    async def create(self, user_id: str = "default", session_id: Optional[str] = None) -> Session:
+        """新建会话，session_id 为空时自动生成"""
+        session_id = self.validate_session_id(session_id or uuid.uuid4().hex)
+        if self.exists(session_id):
+            raise SessionExistsError(f"会话已存在: {session_id}")
+        meta = {"session_id": session_id, "user_id": user_id, "created_at": time.time()}
+        session = await self._load(session_id, meta)
+        self._fresh.discard(session_id)
+        self.stats["created"] += 1
+        return session
+
+    async def get(self, session_id: str, user_id: Optional[str] = None, create: bool = False) -> Session:
+        """获取会话：常驻内存的直接返回，已换出的从磁盘恢复
+
+        create=True 时不存在的会话会被新建；user_id 与会话所属用户不一致时抛出 PermissionError，
+        不提供 user_id 视为 "default"（只能访问默认用户的会话）。
+        """
+        self.validate_session_id(session_id)
+        user_id = user_id or "default"
+        while True:
+            closing = self._closing.get(session_id)
+            if closing is not None:
+                await asyncio.shield(closing)
+            session = self._sessions.get(session_id)
+            if session is None:
+                loading = self._loading.get(session_id)
+                if loading is not None:
+                    session = await asyncio.shield(loading)
+                elif os.path.exists(self._meta_path(session_id)):
+                    session = await self._load(session_id, None)
+                    self.stats["rehydrated"] += 1
+                elif create:
+                    session = await self.create(user_id, session_id)
+                else:
+                    raise SessionNotFoundError(session_id)
+            if self._sessions.get(session_id) is session:
+                break
+            # 刚加载完就被并发加载的容量检查换出了，重新获取
+        self._fresh.discard(session_id)
+        if user_id != session.user_id:
+            raise PermissionError(f"会话 {session_id} 不属于用户 {user_id}")
+        self._sessions.move_to_end(session_id)
+        return session
+
+    async def _load(self, session_id: str, meta: Optional[Dict[str, Any]]) -> Session:
+        """在线程池中打开（或新建）会话的日志并恢复 Agent；同一会话的并发请求共享一次加载"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._loading[session_id] = future
+        try:
+            session = await asyncio.to_thread(self._open_session, session_id, meta)
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # 已由调用方处理，避免 "exception was never retrieved"
+            raise
+        finally:
+            del self._loading[session_id]
+        self._sessions[session_id] = session
+        self._fresh.add(session_id)
+        future.set_result(session)
+        self.stats["peak_resident"] = max(self.stats["peak_resident"], len(self._sessions))
+        await self._enforce_capacity()
+        return session
+
+    def _open_session(self, session_id: str, meta: Optional[Dict[str, Any]]) -> Session:
+        """meta 为 None 时从磁盘恢复会话，否则新建；新建时 meta.json 最后写入，
+        创建 Agent 失败时关闭日志并清理已写出的文件，不留下半建好的会话"""
+        path = self._meta_path(session_id)
+        fresh = meta is not None
+        if not fresh:
+            with open(path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        journal = EventJournal(self.config.storage_dir, session_id, fsync=self.config.fsync)
+        try:
+            agent = self.agent_factory(session_id, meta["user_id"], journal)
+        except BaseException:
+            journal.close()
+            if fresh:
+                self._remove_files(session_id)
+            raise
+        if fresh:
+            tmp = path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False)
+            os.replace(tmp, path)
+        return Session(session_id, meta["user_id"], agent)
+
+    def _remove_files(self, session_id: str) -> None:
+        """删除会话在磁盘上的日志、快照和元数据"""
+        for suffix in (".jsonl", ".snapshot.json", ".meta.json"):
+            path = os.path.join(self.config.storage_dir, session_id + suffix)
+            if os.path.exists(path):
+                os.remove(path)
+
+    # ---------- 换出 ----------
+
+    async def _enforce_capacity(self) -> None:
+        """常驻会话超出上限时按最近最少使用换出空闲会话（处理中的和刚加载的会话不换出）"""
+        excess = len(self._sessions) - self.config.max_resident_sessions
+        if excess <= 0:
+            return
+        victims = [sid for sid, s in self._sessions.items() if not s.busy and sid not in self._fresh][:excess]
+        for session_id in victims:
+            await self._evict(session_id)
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.config.sweep_interval)
+            await self.evict_idle()
+
+    async def evict_idle(self, idle_timeout: Optional[float] = None) -> int:
+        """换出空闲超过 idle_timeout 秒的会话，返回换出数量"""
+        timeout = self.config.idle_timeout if idle_timeout is None else idle_timeout
+        now = time.monotonic()
+        victims = [sid for sid, s in self._sessions.items() if not s.busy and now - s.last_active >= timeout]
+        for session_id in victims:
+            await self._evict(session_id)
+        return len(victims)
+
+    async def _evict(self, session_id: str) -> None:
+        session = self._sessions.pop(session_id, None)
+        if session is None:
+            return
+        closing = asyncio.get_running_loop().create_future()
+        self._closing[session_id] = closing
+        try:
+            await asyncio.to_thread(session.agent.close)
+        finally:
+            del self._closing[session_id]
+            closing.set_result(None)
+        self.stats["evicted"] += 1
+
+    async def delete(self, session_id: str) -> None:
+        """删除会话及其磁盘上的日志、快照"""
+        self.validate_session_id(session_id)
+        session = self._sessions.get(session_id)
+        if session is not None and session.busy:
+            raise ServerBusyError(f"会话 {session_id} 正在处理消息", self.config.retry_after)
+        await self._evict(session_id)
+        self._remove_files(session_id)
+
+    # ---------- 处理消息 ----------
+
+    def _admit(self, session: Optional[Session] = None) -> None:
+        """准入检查：超出上限时直接拒绝，不让请求在内存里无限堆积"""
+        if self._active >= self.config.max_active_turns and self._waiting >= self.config.max_waiting_turns:
+            self.stats["rejected"] += 1
+            raise ServerBusyError("服务繁忙", self.config.retry_after)
+        if session is not None and session.pending >= self.config.max_pending_per_session:
+            self.stats["rejected"] += 1
+            raise ServerBusyError(f"会话 {session.session_id} 排队的消息过多", self.config.retry_after)
+
+    async def send(self, session_id: str, message: str, user_id: Optional[str] = None,
+                   on_token: Optional[Callable[[str], None]] = None, create: bool = True) -> Dict[str, Any]:
+        """处理一条用户消息，返回 {"session_id", "reply", "latency"}
+
+        提供 on_token 时流式处理，回复文本逐 token 交给 on_token。
+        """
+        self._admit()  # 先做全局检查，繁忙时不必恢复会话
+        session = await self.get(session_id, user_id, create=create)
+        self._admit(session)
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.config.max_active_turns)
+        session.pending += 1
+        self._waiting += 1
+        admitted = False
+        start = time.perf_counter()
+        try:
+            async with self._slots:
+                self._waiting -= 1
+                admitted = True
+                self._active += 1
+                try:
+                    if on_token is None:
+                        reply = await session.agent.aprocess_message(message)
+                    else:
+                        reply = await session.agent.asubmit_user_input(message, on_token=on_token)
+                finally:
+                    self._active -= 1
+        except BaseException:
+            self.stats["failed"] += 1
+            raise
+        finally:
+            if not admitted:
+                self._waiting -= 1
+            session.pending -= 1
+            session.last_active = time.monotonic()
+        latency = time.perf_counter() - start
+        # 全部会话都在处理中时常驻数会暂时超出上限，处理完后补做一次换出
+        await self._enforce_capacity()
+        self._latencies.append(latency)
+        self.stats["turns"] += 1
+        return {"session_id": session.session_id, "reply": reply, "latency": latency}
+
+    # ---------- 查询 ----------
+
+    async def info(self, session_id: str) -> Dict[str, Any]:
+        self.validate_session_id(session_id)
+        session = self._sessions.get(session_id)
+        if session is not None:
+            return session.info()
+        path = self._meta_path(session_id)
+        if not os.path.exists(path):
+            raise SessionNotFoundError(session_id)
+        with open(path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        return {"session_id": session_id, "user_id": meta["user_id"], "resident": False}
+
+    def resident_sessions(self) -> List[str]:
+        return list(self._sessions)
+
+    def get_stats(self) -> Dict[str, Any]:
+        latencies = sorted(self._latencies)
+
+        def percentile(p: float) -> Optional[float]:
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+        return {
+            **self.stats,
+            "resident": len(self._sessions),
+            "active_turns": self._active,
+            "waiting_turns": self._waiting,
+            "p50_latency": percentile(0.5),
+            "p99_latency": percentile(0.99),
+            "tool_cache": get_tool_cache_stats(),
+            "memory_prefetch": get_prefetch_stats(),
+            "memory_recall": get_recall_stats(),
+        }
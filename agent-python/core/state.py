@@ -1,46 +1,238 @@
-from typing import List, Dict, Any
-from dataclasses import dataclass
+from typing import TYPE_CHECKING, List, Dict, Any, Optional, Sequence, Union
 from datetime import datetime
+from enum import IntEnum
+import hashlib
+import json
+import threading
+import time
+
+from .event_log import EventLog
+
+if TYPE_CHECKING:
+    from .journal import EventJournal
+
+
+class EventType(IntEnum):
+    """事件类型（小整数）
+    
+    与旧的字符串常量兼容：EventType.coerce("user_message") 得到对应成员，
+    与字符串比较时按名称比较（EventType.USER_MESSAGE == "user_message"）。
+    哈希与 int 一致，按类型建的字典/集合可以用成员或整数查找；字符串名称要先经过 coerce。
+    """
+    USER_MESSAGE = 1
+    AGENT_MESSAGE = 2
+    TOOL_CALL = 3
+    TOOL_RESULT = 4
+    ERROR = 5
+    SYSTEM = 6
+    COMPACTION = 7  # 压缩水位：upto 之前的事件已交给记忆系统，不再进入上下文
+    SUMMARY = 8     # 滚动摘要：content 覆盖前 upto 个事件
+    
+    @property
+    def label(self) -> str:
+        """旧的字符串名称，如 user_message"""
+        return self.name.lower()
+    
+    @classmethod
+    def coerce(cls, value: Union["EventType", str, int]) -> "EventType":
+        if isinstance(value, cls):
+            return value
+        if isinstance(value, str):
+            try:
+                return cls[value.upper()]
+            except KeyError:
+                raise ValueError(f"未知的事件类型: {value}") from None
+        return cls(value)
+    
+    def __eq__(self, other):
+        if isinstance(other, str):
+            return self.label == other
+        return int.__eq__(self, other)
+    
+    # 重载 __eq__ 会把 __hash__ 置为 None，这里显式沿用 int 的哈希，与 int 的相等保持一致
+    __hash__ = int.__hash__
+    
+    def __str__(self) -> str:
+        return self.label
+
+
+# 保留旧名称：EventTypes.USER_MESSAGE 等
+EventTypes = EventType
+
+
+_clock_lock = threading.Lock()
+_last_ns = 0
+
+
+def monotonic_ns() -> int:
+    """纳秒级墙钟时间戳，同一进程内严格递增（事件顺序与时间戳顺序一致）"""
+    global _last_ns
+    now = time.time_ns()
+    with _clock_lock:
+        _last_ns = now if now > _last_ns else _last_ns + 1
+        return _last_ns
+
+
+def _to_ns(timestamp: Union[int, datetime, None]) -> int:
+    if timestamp is None:
+        return monotonic_ns()
+    if isinstance(timestamp, datetime):
+        return int(timestamp.timestamp() * 1_000_000_000)
+    return int(timestamp)
+
 
-@dataclass
 class Event:
-    """事件基类"""
-    type: str
-    timestamp: datetime
-    data: Dict[str, Any]
-    
-    def __post_init__(self):
-        if self.timestamp is None:
-            self.timestamp = datetime.now()
-
-class EventTypes:
-    """事件类型常量"""
-    USER_MESSAGE = "user_message"
-    AGENT_MESSAGE = "agent_message" 
-    TOOL_CALL = "tool_call"
-    TOOL_RESULT = "tool_result"
-    ERROR = "error"
-    SYSTEM = "system"
+    """事件
+    
+    - type: EventType（可传字符串名称）
+    - timestamp: 纳秒时间戳（int），None 时取当前时间；也接受 datetime
+    - data: 事件内容
+    - turn: 所在轮次，由 EventLog 在追加时填写（第 N 条用户消息开始第 N 轮）
+    
+    使用 __slots__，每个事件不再带 __dict__；会话常驻内存时单个事件的开销更小。
+    """
+    __slots__ = ("type", "timestamp", "data", "turn")
+    
+    def __init__(self, type: Union[EventType, str, int], timestamp: Union[int, datetime, None] = None,
+                 data: Optional[Dict[str, Any]] = None, turn: int = 0):
+        self.type = EventType.coerce(type)
+        self.timestamp = _to_ns(timestamp)
+        self.data = data if data is not None else {}
+        self.turn = turn
+    
+    @property
+    def created_at(self) -> datetime:
+        return datetime.fromtimestamp(self.timestamp / 1_000_000_000)
+    
+    @property
+    def starts_turn(self) -> bool:
+        """用户消息开始新的一轮"""
+        return self.type == EventType.USER_MESSAGE
+    
+    def __eq__(self, other):
+        if not isinstance(other, Event):
+            return NotImplemented
+        return self.type == other.type and self.timestamp == other.timestamp and self.data == other.data
+    
+    __hash__ = None
+    
+    def __repr__(self) -> str:
+        return f"Event(type={self.type.label}, timestamp={self.timestamp}, turn={self.turn}, data={self.data!r})"
+
+
+def last_event_of_type(events: Sequence[Event], event_type: Union[EventType, str, int]) -> Optional[Event]:
+    """最近一个指定类型的事件；EventLog 走类型索引，O(log n)"""
+    event_type = EventType.coerce(event_type)
+    if isinstance(events, EventLog):
+        return events.last_of_type(event_type)
+    for event in reversed(events):
+        if event.type == event_type:
+            return event
+    return None
+
+
+def compaction_watermark(events: Sequence[Event]) -> int:
+    """最近一次压缩的水位（之前的事件已交给记忆系统），没有压缩过返回 0"""
+    event = last_event_of_type(events, EventType.COMPACTION)
+    return event.data.get("upto", 0) if event is not None else 0
+
+
+def latest_summary(events: Sequence[Event]) -> Optional[Event]:
+    """最近一次的滚动摘要事件"""
+    return last_event_of_type(events, EventType.SUMMARY)
+
+
+def hash_events(events: Sequence[Event]) -> str:
+    """事件区间的幂等键：类型、时间和内容都相同才视为同一批事件"""
+    payload = json.dumps([[e.type.label, e.timestamp, e.data] for e in events],
+                         sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.md5(payload.encode()).hexdigest()
 
 class StateManager:
-    """状态管理器 - 实现 Reducer 模式"""
+    """状态管理器 - 实现 Reducer 模式
+    
+    状态是不可变的 EventLog：reducer 返回新日志而不修改旧日志，
+    追加和读取快照都是 O(1)，不再每次复制整个事件列表。
+    
+    提供 journal 时每个事件同时追加到持久化日志（分组提交，不等待落盘），每 snapshot_every 个事件
+    写一次快照；压缩之后水位之前的事件换出内存。用 StateManager.open(journal) 恢复会话。
+    """
     
-    def __init__(self):
-        self.events: List[Event] = []
+    def __init__(self, events: Optional[EventLog] = None, journal: Optional["EventJournal"] = None):
+        self.events: EventLog = events if events is not None else EventLog()
+        self.journal = journal
+        self._since_snapshot = 0
     
-    def reducer(self, new_event: Event) -> List[Event]:
+    @classmethod
+    def open(cls, journal: "EventJournal") -> "StateManager":
+        """从持久化日志恢复会话：快照 + 尾部，冷事件留在磁盘上"""
+        manager = cls(journal.load(), journal)
+        manager.spill()
+        return manager
+    
+    def reducer(self, new_event: Event) -> EventLog:
         """Reducer 函数 - 纯函数，返回新状态"""
-        return self.events + [new_event]
+        return self.events.append(new_event)
     
-    def add_event(self, event_type: str, data: Dict[str, Any]) -> None:
+    def add_event(self, event_type: Union[EventType, str], data: Dict[str, Any]) -> None:
         """添加新事件到状态"""
-        event = Event(type=event_type, timestamp=datetime.now(), data=data)
+        event = Event(type=event_type, data=data)
         self.events = self.reducer(event)
+        if self.journal is not None:
+            self.journal.append(event)
+            self._since_snapshot += 1
+            if self._since_snapshot >= self.journal.snapshot_every:
+                self.snapshot()
+    
+    def get_state(self) -> EventLog:
+        """获取当前状态（不可变快照）"""
+        return self.events.snapshot()
+    
+    def fork(self) -> "StateManager":
+        """分叉出一个共享已有事件的状态管理器，用于假设推演，互不影响（分支不写持久化日志）"""
+        return StateManager(self.events.fork())
+    
+    def clear(self) -> None:
+        """清空状态"""
+        self.events = EventLog()
+        if self.journal is not None:
+            self.journal.reset()
+            self._since_snapshot = 0
+    
+    def snapshot(self) -> None:
+        """写一次快照（在日志的写线程里序列化），压缩水位之前的事件只保存偏移"""
+        if self.journal is None:
+            return
+        self.journal.snapshot(self.events.snapshot(), compaction_watermark(self.events))
+        self._since_snapshot = 0
+    
+    def spill(self) -> int:
+        """把压缩水位之前、已经落盘的事件换出内存（需要持久化日志），返回换出数量
+        
+        不等待写线程落盘（异步模式下在事件循环上调用）：还在队列里的事件留在内存中，下次换出时再处理。
+        """
+        if self.journal is None:
+            return 0
+        upto = min(compaction_watermark(self.events), self.journal.durable_count())
+        if upto <= self.events.cold_count:
+            return 0
+        return self.events.spill(upto, self.journal.read)
+    
+    def compact(self, upto: int, key: str) -> None:
+        """记录压缩水位：前 upto 个事件已交给记忆系统（key 为这批事件的幂等键）"""
+        if upto <= compaction_watermark(self.events):
+            return
+        self.add_event(EventTypes.COMPACTION, {"upto": upto, "key": key})
+        self.spill()
+    
+    def record_summary(self, content: str, upto: int) -> None:
+        """记录覆盖前 upto 个事件的滚动摘要"""
+        self.add_event(EventTypes.SUMMARY, {"content": content, "upto": upto})
     
-    def get_state(self) -> List[Event]:
-        """获取当前状态"""
-        return self.events.copy()
+    def get_events_by_type(self, event_type: Union[EventType, str]) -> List[Event]:
+        """按类型筛选事件（类型索引，O(k)）"""
+        return self.events.of_type(EventType.coerce(event_type))
     
-    def get_events_by_type(self, event_type: str) -> List[Event]:
-        """按类型筛选事件"""
-        return [e for e in self.events if e.type == event_type] 
\ No newline at end of file
+    def get_events_since_turn(self, turn: int) -> List[Event]:
+        """第 turn 轮（含）之后的事件（轮次索引，O(k)）"""
+        return self.events.since_turn(turn)
@@ -0,0 +1,124 @@
+"""
+滚动摘要 - 用一段固定大小的"之前的对话"摘要替代被截掉的历史，在后台线程增量更新
+"""
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+from llm.llm_client import llm_call
+from .renderer import render_event
+from .state import Event
+
+SUMMARY_MODEL = "google/gemini-2.5-flash"
+SUMMARY_MAX_CHARS = 600
+
+
+def build_summary_prompt(previous: str, events: List[Event], max_chars: int = SUMMARY_MAX_CHARS) -> str:
+    """把已有摘要和新截掉的事件合成新摘要的提示词"""
+    new_text = "\n".join(chunk for chunk in map(render_event, events) if chunk)
+    return f"""
+你在维护一段"之前的对话"摘要，它会代替被截掉的对话历史放进上下文。
+
+要求：
+1. 把新截掉的对话合并进已有摘要，输出一段完整的新摘要，而不是只总结新内容。
+2. 保留主线：用户关心的问题、已经得出的结论、做出的决定、还没解决的事项。
+3. 保留关键的具体细节（名字、数字、用户的偏好和原话里的关键表述），省略寒暄和重复。
+4. 注意区分用户和你自己，用"用户"和"我"来指代。
+5. 不超过{max_chars}字，不要使用列表或标题。
+
+已有摘要：
+<summary>
+{previous or "（无）"}
+</summary>
+
+新截掉的对话：
+<history>
+{new_text}
+</history>
+
+请直接输出新的摘要：
+"""
+
+
+def summarize_events(previous: str, events: List[Event], model: str = SUMMARY_MODEL) -> str:
+    """调用 LLM 把新事件合并进已有摘要"""
+    return llm_call(build_summary_prompt(previous, events), model=model).strip()
+
+
+class RollingSummary:
+    """覆盖压缩水位之前全部对话的滚动摘要
+
+    - submit(events, upto): 把新截掉的事件交给后台线程合并进摘要，不阻塞上下文构建
+    - 更新在单个后台线程里按提交顺序执行，每次都基于上一次的结果
+    - 合并失败时这批事件留到下一次更新一起合并，covered_upto 只在合并成功后前进
+    - 新摘要先放在 take_unpublished() 里，由调用方在自己的线程里写回状态
+    """
+
+    def __init__(self, summarize: Callable[[str, List[Event]], str] = summarize_events):
+        self.summarize = summarize
+        self.text = ""
+        self.covered_upto = 0
+        self.stats = {"submitted": 0, "updates": 0, "failures": 0}
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending: List[Future] = []
+        self._unpublished: Optional[Tuple[str, int]] = None
+        self._carried: List[Event] = []  # 合并失败、等待下一次更新的事件（只在后台线程里读写）
+
+    def restore(self, text: str, upto: int) -> None:
+        """从状态中恢复已有摘要（如新建的 ContextBuilder）"""
+        with self._lock:
+            if upto > self.covered_upto:
+                self.text, self.covered_upto = text, upto
+
+    def submit(self, events: List[Event], upto: int) -> Future:
+        """后台把 events 合并进摘要，完成后摘要覆盖到第 upto 个事件"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rolling-summary")
+            self.stats["submitted"] += 1
+            future = self._executor.submit(self._update, list(events), upto)
+            self._pending = [f for f in self._pending if not f.done()] + [future]
+        return future
+
+    def _update(self, events: List[Event], upto: int) -> None:
+        with self._lock:
+            previous, covered = self.text, self.covered_upto
+        if upto <= covered:
+            return
+        events = self._carried + events
+        try:
+            text = self.summarize(previous, events)
+        except Exception as e:
+            text = ""
+            print(f"滚动摘要更新失败: {e}")
+        if not text:
+            # 失败的事件不丢弃，下一次更新时一起合并
+            self.stats["failures"] += 1
+            self._carried = events
+            return
+        self._carried = []
+        with self._lock:
+            if upto > self.covered_upto:
+                self.text, self.covered_upto = text, upto
+                self._unpublished = (text, upto)
+                self.stats["updates"] += 1
+
+    def take_unpublished(self) -> Optional[Tuple[str, int]]:
+        """取出尚未写回状态的新摘要 (text, upto)"""
+        with self._lock:
+            result, self._unpublished = self._unpublished, None
+            return result
+
+    def wait(self, timeout: Optional[float] = None) -> None:
+        """等待已提交的更新完成"""
+        with self._lock:
+            pending = list(self._pending)
+        for future in pending:
+            future.result(timeout=timeout)
+
+    def close(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
@@ -0,0 +1,210 @@
+"""
+响应缓存 - 内容寻址的 LLM 响应缓存，进程内 LRU + 磁盘持久化两级
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+
+def make_cache_key(payload: Dict[str, Any]) -> str:
+    """对请求参数做稳定哈希（字典键排序，非 ASCII 原样保留）"""
+    canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False,
+                           separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class MemoryLRU:
+    """进程内 LRU 缓存，可选 TTL"""
+
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            created, value = entry
+            if self.ttl is not None and time.time() - created > self.ttl:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: Any, created: Optional[float] = None) -> None:
+        with self._lock:
+            self._data[key] = (created if created is not None else time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class DiskCache:
+    """磁盘缓存：每个键一个 JSON 文件，按 TTL 过期，总大小超限时淘汰最久未访问的文件"""
+
+    def __init__(self, directory: str, ttl: Optional[float] = 7 * 24 * 3600,
+                 max_bytes: int = 256 * 1024 * 1024):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        self._total_bytes = sum(size for _, _, size in self._scan())
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _scan(self):
+        """遍历缓存文件，返回 (path, mtime, size)"""
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_mtime, stat.st_size
+
+    def get(self, key: str) -> Optional[Tuple[float, Any]]:
+        """返回 (created, value)，未命中或已过期返回 None"""
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        created = entry.get("created", 0)
+        if self.ttl is not None and time.time() - created > self.ttl:
+            self._remove(path)
+            return None
+
+        # 更新访问时间，淘汰时按 mtime 近似 LRU
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return created, entry.get("value")
+
+    def put(self, key: str, value: Any) -> None:
+        path = self._path(key)
+        data = json.dumps({"created": time.time(), "value": value}, ensure_ascii=False)
+        encoded = data.encode('utf-8')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # 先写临时文件再原子替换，避免并发读到半截内容
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(encoded)
+        old_size = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._total_bytes += len(encoded) - old_size
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _remove(self, path: str) -> None:
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        with self._lock:
+            self._total_bytes -= size
+
+    def _evict(self) -> None:
+        """淘汰到容量上限的 90%，先删过期的，再按 mtime 从旧到新删"""
+        target = int(self.max_bytes * 0.9)
+        now = time.time()
+        entries = sorted(self._scan(), key=lambda e: e[1])
+        for path, mtime, size in entries:
+            if self._total_bytes <= target and (self.ttl is None or now - mtime <= self.ttl):
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._total_bytes -= size
+
+    def clear(self) -> None:
+        for path, _, _ in list(self._scan()):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        with self._lock:
+            self._total_bytes = 0
+
+
+class ResponseCache:
+    """两级响应缓存：先查内存 LRU，再查磁盘，磁盘命中后回填内存"""
+
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = 7 * 24 * 3600,
+                 directory: Optional[str] = None, max_disk_bytes: int = 256 * 1024 * 1024):
+        self.memory = MemoryLRU(max_entries=max_entries, ttl=ttl)
+        self.disk = DiskCache(directory, ttl=ttl, max_bytes=max_disk_bytes) if directory else None
+        self._lock = threading.Lock()
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0}
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._stats[name] += 1
+
+    def get(self, key: str) -> Optional[Any]:
+        value = self.memory.get(key)
+        if value is not None:
+            self._count("memory_hits")
+            return value
+
+        if self.disk is not None:
+            entry = self.disk.get(key)
+            if entry is not None and entry[1] is not None:
+                created, value = entry
+                self.memory.put(key, value, created=created)
+                self._count("disk_hits")
+                return value
+
+        self._count("misses")
+        return None
+
+    def put(self, key: str, value: Any) -> None:
+        if value is None:
+            return
+        self.memory.put(key, value)
+        if self.disk is not None:
+            try:
+                self.disk.put(key, value)
+            except OSError as e:
+                print(f"写入磁盘缓存失败: {e}")
+        self._count("stores")
+
+    def clear(self) -> None:
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """命中统计"""
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        stats["memory_entries"] = len(self.memory)
+        return stats
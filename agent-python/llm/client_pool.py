@@ -0,0 +1,149 @@
+"""
+客户端连接池 - 按 provider 和同步/异步模式复用长连接的 OpenAI 客户端
+"""
+import asyncio
+import itertools
+import math
+import threading
+import weakref
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+import httpx
+from openai import OpenAI, AsyncOpenAI
+
+
+def _http2_available() -> bool:
+    """HTTP/2 需要安装 h2 包"""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+class ClientPool:
+    """OpenAI 客户端池
+
+    - 同步客户端：全进程共享一个 httpx.Client 连接池，每个 provider 一个 OpenAI 客户端
+    - 异步客户端：httpx.AsyncClient 的连接绑定在事件循环上，所以按事件循环各建一份，
+      循环关闭或被回收后自动失效
+    - 异步连接池按 async_shard_connections 拆成多个分片轮流使用：httpcore 每次分配连接都要
+      扫描整个池（开销随连接数平方增长），一个事件循环上有上百个并发请求时单个大池会成为瓶颈
+    """
+
+    def __init__(self, max_connections: int = 100, max_keepalive_connections: int = 20,
+                 keepalive_expiry: float = 30.0, timeout: float = 200.0,
+                 connect_timeout: float = 10.0, http2: bool = False, max_retries: int = 2,
+                 async_shard_connections: int = 16):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.async_shards = max(1, math.ceil(max_connections / max(1, async_shard_connections)))
+        self.async_limits = httpx.Limits(
+            max_connections=math.ceil(max_connections / self.async_shards),
+            max_keepalive_connections=math.ceil(max_keepalive_connections / self.async_shards),
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.max_retries = max_retries
+        self.http2 = http2 and _http2_available()
+        if http2 and not self.http2:
+            print("未安装 h2，HTTP/2 已禁用，使用 HTTP/1.1")
+
+        self._lock = threading.Lock()
+        self._sync_http: Optional[httpx.Client] = None
+        self._sync_clients: Dict[str, OpenAI] = {}
+        # 每个事件循环：分片列表 [(httpx.AsyncClient, {provider: AsyncOpenAI})]，以及轮转计数器
+        self._async_shards: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, List[Tuple[httpx.AsyncClient, Dict[str, AsyncOpenAI]]]]" = weakref.WeakKeyDictionary()
+        self._async_next: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Iterator[int]]" = weakref.WeakKeyDictionary()
+
+    def get(self, provider: str, settings: Tuple[str, str],
+            is_async: bool = False) -> Union[OpenAI, AsyncOpenAI]:
+        """获取 provider 对应的客户端，settings 为 (api_key, base_url)"""
+        if is_async:
+            return self._get_async(provider, settings)
+        return self._get_sync(provider, settings)
+
+    def _get_sync(self, provider: str, settings: Tuple[str, str]) -> OpenAI:
+        client = self._sync_clients.get(provider)
+        if client is not None:
+            return client
+
+        with self._lock:
+            client = self._sync_clients.get(provider)
+            if client is None:
+                if self._sync_http is None:
+                    self._sync_http = httpx.Client(
+                        limits=self.limits, timeout=self.timeout, http2=self.http2
+                    )
+                api_key, base_url = settings
+                client = OpenAI(api_key=api_key, base_url=base_url,
+                                max_retries=self.max_retries, http_client=self._sync_http)
+                self._sync_clients[provider] = client
+            return client
+
+    def _get_async(self, provider: str, settings: Tuple[str, str]) -> AsyncOpenAI:
+        api_key, base_url = settings
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # 不在事件循环中，无法确定连接归属，退化为独立客户端
+            return AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=self.max_retries)
+
+        with self._lock:
+            shards = self._async_shards.get(loop)
+            if shards is None:
+                shards = [(httpx.AsyncClient(limits=self.async_limits, timeout=self.timeout, http2=self.http2), {})
+                          for _ in range(self.async_shards)]
+                self._async_shards[loop] = shards
+                self._async_next[loop] = itertools.cycle(range(len(shards)))
+            http_client, clients = shards[next(self._async_next[loop])]
+            client = clients.get(provider)
+            if client is None:
+                client = AsyncOpenAI(api_key=api_key, base_url=base_url,
+                                     max_retries=self.max_retries, http_client=http_client)
+                clients[provider] = client
+            return client
+
+    def close(self) -> None:
+        """关闭同步连接池，并尽量关闭各事件循环上的异步连接池"""
+        with self._lock:
+            if self._sync_http is not None:
+                self._sync_http.close()
+            self._sync_http = None
+            self._sync_clients.clear()
+
+            async_pools = [(loop, http_client) for loop, shards in self._async_shards.items()
+                           for http_client, _ in shards]
+            self._async_shards.clear()
+            self._async_next.clear()
+
+        for loop, http_client in async_pools:
+            if loop.is_closed():
+                continue
+            if loop.is_running():
+                asyncio.run_coroutine_threadsafe(http_client.aclose(), loop)
+            else:
+                loop.run_until_complete(http_client.aclose())
+
+    async def aclose(self) -> None:
+        """关闭当前事件循环上的异步连接池"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            shards = self._async_shards.pop(loop, None) or []
+            self._async_next.pop(loop, None)
+        for http_client, _ in shards:
+            await http_client.aclose()
+
+    def stats(self) -> Dict[str, int]:
+        """连接池状态"""
+        with self._lock:
+            return {
+                "sync_clients": len(self._sync_clients),
+                "async_event_loops": len(self._async_shards),
+                "async_shards": sum(len(shards) for shards in self._async_shards.values()),
+                "async_clients": sum(len(c) for shards in self._async_shards.values() for _, c in shards),
+                "http2": int(self.http2),
+            }
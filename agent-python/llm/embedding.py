@@ -0,0 +1,186 @@
+"""
+向量服务 - 微批合并、内容哈希缓存、批量回填与并发控制
+"""
+import array
+import asyncio
+import base64
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .cache import ResponseCache, make_cache_key
+
+
+def _encode_vector(vector: List[float]) -> str:
+    """float32 + base64，比 JSON 浮点列表小约 3 倍"""
+    return base64.b64encode(array.array('f', vector).tobytes()).decode('ascii')
+
+
+def _decode_vector(data: str) -> List[float]:
+    vector = array.array('f')
+    vector.frombytes(base64.b64decode(data))
+    return vector.tolist()
+
+
+def _to_float32(vector: List[float]) -> List[float]:
+    """按 float32 精度取整，新请求的结果与缓存命中的结果完全一致"""
+    return array.array('f', vector).tolist()
+
+
+class EmbeddingService:
+    """向量服务
+
+    - embed: 单条请求进入队列，max_wait_ms 内到达的请求合并成一次多输入调用
+    - embed_many: 批量接口（用于回填），按 max_batch_size 切块并发请求
+    - 所有结果按 (模型, 文本) 的内容哈希缓存，可落盘
+    """
+
+    def __init__(self, client_factory: Callable[[], Any], model: str = "text-embedding-3-small",
+                 max_batch_size: int = 64, max_wait_ms: float = 5.0, concurrency: int = 4,
+                 cache: Optional[ResponseCache] = None):
+        self.client_factory = client_factory
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.cache = cache
+        self._queue: "queue.Queue[Optional[Tuple[str, Future]]]" = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="embedding")
+        self._batcher: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "cache_hits": 0, "api_calls": 0, "api_inputs": 0}
+
+    def _count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self._stats[name] += n
+
+    def _cache_key(self, text: str) -> str:
+        return make_cache_key({"model": self.model, "input": text})
+
+    def _cache_get(self, text: str) -> Optional[List[float]]:
+        if self.cache is None:
+            return None
+        data = self.cache.get(self._cache_key(text))
+        if data is None:
+            return None
+        self._count("cache_hits")
+        return _decode_vector(data)
+
+    def _cache_put(self, text: str, vector: List[float]) -> None:
+        if self.cache is not None and vector:
+            self.cache.put(self._cache_key(text), _encode_vector(vector))
+
+    def _request(self, texts: List[str]) -> List[List[float]]:
+        """一次多输入 API 调用"""
+        self._count("api_calls")
+        self._count("api_inputs", len(texts))
+        response = self.client_factory().embeddings.create(model=self.model, input=texts)
+        vectors = [_to_float32(item.embedding) for item in sorted(response.data, key=lambda d: d.index)]
+        for text, vector in zip(texts, vectors):
+            self._cache_put(text, vector)
+        return vectors
+
+    # ---- 单条请求：微批合并 ----
+
+    def submit(self, text: str) -> Future:
+        """提交单条文本，返回 Future"""
+        self._count("requests")
+        future: Future = Future()
+        cached = self._cache_get(text)
+        if cached is not None:
+            future.set_result(cached)
+            return future
+        self._ensure_batcher()
+        self._queue.put((text, future))
+        return future
+
+    def embed(self, text: str) -> List[float]:
+        return self.submit(text).result()
+
+    async def embed_async(self, text: str) -> List[float]:
+        return await asyncio.wrap_future(self.submit(text))
+
+    def _ensure_batcher(self) -> None:
+        if self._batcher is not None and self._batcher.is_alive():
+            return
+        with self._lock:
+            if self._batcher is None or not self._batcher.is_alive():
+                self._batcher = threading.Thread(target=self._batch_loop, daemon=True,
+                                                 name="embedding-batcher")
+                self._batcher.start()
+
+    def _batch_loop(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+            # 发请求交给线程池，批处理线程继续收集下一批
+            self._executor.submit(self._run_batch, batch)
+
+    def _run_batch(self, batch: List[Tuple[str, Future]]) -> None:
+        # 同一批内的重复文本只请求一次
+        waiters: Dict[str, List[Future]] = {}
+        for text, future in batch:
+            waiters.setdefault(text, []).append(future)
+        texts = list(waiters.keys())
+        try:
+            vectors = self._request(texts)
+        except Exception as e:
+            for futures in waiters.values():
+                for future in futures:
+                    future.set_exception(e)
+            return
+        for text, vector in zip(texts, vectors):
+            for future in waiters[text]:
+                future.set_result(vector)
+
+    # ---- 批量接口：回填 ----
+
+    def embed_many(self, texts: List[str]) -> List[List[float]]:
+        """批量获取向量：先查缓存，未命中的去重后按批并发请求，结果与输入顺序一致"""
+        self._count("requests", len(texts))
+        results: Dict[str, List[float]] = {}
+        missing: Dict[str, None] = {}  # 有序去重
+        for text in texts:
+            if text in results or text in missing:
+                continue
+            cached = self._cache_get(text)
+            if cached is not None:
+                results[text] = cached
+            else:
+                missing[text] = None
+        missing = list(missing)
+
+        chunks = [missing[i:i + self.max_batch_size] for i in range(0, len(missing), self.max_batch_size)]
+        for chunk, vectors in zip(chunks, self._executor.map(self._request, chunks)):
+            results.update(zip(chunk, vectors))
+
+        return [results[text] for text in texts]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+        stats["avg_batch_size"] = stats["api_inputs"] / stats["api_calls"] if stats["api_calls"] else 0.0
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+        return stats
+
+    def close(self) -> None:
+        if self._batcher is not None and self._batcher.is_alive():
+            self._queue.put(None)
+        self._executor.shutdown(wait=False)
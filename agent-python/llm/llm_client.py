@@ -1,13 +1,26 @@
 import os
-import httpx
+import atexit
+import threading
+import time
 import tiktoken
 import asyncio
 import json
-from typing import Union, List, Dict, Any, Optional, AsyncGenerator, Generator
-from aiolimiter import AsyncLimiter
+import hashlib
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Union, List, Dict, Any, Optional, Tuple, AsyncGenerator, Generator
 from openai import OpenAI, AsyncOpenAI
 from dotenv import load_dotenv
 
+from .client_pool import ClientPool
+from .cache import ResponseCache, make_cache_key
+from .single_flight import SingleFlight, AsyncSingleFlight
+from .rate_limit import RateLimitManager
+from .retry import RetryExecutor, RetryPolicy, HedgePolicy
+from .embedding import EmbeddingService
+from .router import ProviderRouter
+from .telemetry import Telemetry, TelemetrySink, JsonlSink, CallRecord
+
 load_dotenv()
 
 
@@ -16,31 +29,163 @@ class AIConfig:
     DEFAULT_TEMPERATURE = 0.05
     DEFAULT_SYSTEM_MESSAGE = "You are a helpful assistant."
     DEFAULT_TIMEOUT = 200
-    MAX_CONCURRENT_REQUESTS = 10
+    MAX_CONCURRENT_REQUESTS = 10      # 每个 provider 的初始并发窗口（AIMD 自适应调整）
+    MAX_CONCURRENT_REQUESTS_CEILING = 64
+    
+    # 限流配置：rpm 为每分钟请求数，tpm 为每分钟 token 数，None 表示不限
+    PROVIDER_RATE_LIMITS: Dict[str, Dict[str, Optional[int]]] = {
+        "openrouter": {"rpm": None, "tpm": None},
+        "deepseek": {"rpm": None, "tpm": None},
+        "openai": {"rpm": None, "tpm": None},
+    }
+    # 模型级限流，叠加在 provider 限流之上，例如 {"perplexity/sonar": {"rpm": 50, "tpm": None}}
+    MODEL_RATE_LIMITS: Dict[str, Dict[str, Optional[int]]] = {}
+    ESTIMATED_COMPLETION_TOKENS = 1024  # 预估 TPM 时为输出预留的 token 数
+    
+    # 重试配置：DEFAULT_TIMEOUT 是整次调用（含重试）的截止时间
+    RETRY_MAX_ATTEMPTS = 3
+    RETRY_BASE_DELAY = 0.5
+    RETRY_MAX_DELAY = 8.0
+    ATTEMPT_TIMEOUT: Optional[float] = None  # 单次尝试超时，None 表示只受 DEFAULT_TIMEOUT 约束
+    
+    # 对冲请求（仅异步非流式调用）：超过历史 p95 未返回时再发一份
+    HEDGE_ENABLED = os.environ.get("LLM_HEDGE", "").lower() in ("1", "true", "yes")
+    HEDGE_QUANTILE = 0.95
+    HEDGE_MIN_DELAY = 2.0
+    HEDGE_FALLBACK_MODELS: Dict[str, str] = {}  # 对冲请求改发的模型，如 {"deepseek-v3": "deepseek/deepseek-chat"}
+    
+    # 路由与熔断配置
+    ROUTER_ENABLED = True
+    MODEL_EQUIVALENTS: List[List[str]] = []  # 可互相替换的模型组，如 [["deepseek-v3", "deepseek/deepseek-chat"]]
+    ROUTER_EWMA_ALPHA = 0.2
+    CIRCUIT_FAILURE_THRESHOLD = 5      # 连续失败次数
+    CIRCUIT_ERROR_RATE_THRESHOLD = 0.5 # 错误率 EWMA
+    CIRCUIT_OPEN_SECONDS = 30.0        # 熔断后多久放行探测请求
+    
+    # 调用遥测：默认关闭（LLM_TELEMETRY=1 或 enable_telemetry() 开启），关闭时每次调用只多一次 None 判断
+    TELEMETRY_ENABLED = os.environ.get("LLM_TELEMETRY", "0").lower() in ("1", "true", "yes")
+    TELEMETRY_JSONL_PATH = os.environ.get("LLM_TELEMETRY_FILE")  # 设置后每次调用追加一行 JSON
+    STREAM_INCLUDE_USAGE = True  # 流式请求末尾返回 usage（OpenAI 兼容接口的 stream_options）
+    
+    # 向量服务配置
+    EMBEDDING_PROVIDER = "dmxapi"
+    EMBEDDING_MAX_BATCH_SIZE = 64
+    EMBEDDING_MAX_WAIT_MS = 5.0       # 微批等待窗口
+    EMBEDDING_CONCURRENCY = 4
+    EMBEDDING_CACHE_ENABLED = True
+    EMBEDDING_CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "embeddings"))
+    EMBEDDING_CACHE_MAX_ENTRIES = 4096
+    EMBEDDING_CACHE_MAX_DISK_BYTES = 512 * 1024 * 1024
+    
+    # 连接池配置
+    HTTP_MAX_CONNECTIONS = 100
+    HTTP_MAX_KEEPALIVE_CONNECTIONS = 20
+    HTTP_KEEPALIVE_EXPIRY = 30.0
+    HTTP_CONNECT_TIMEOUT = 10.0
+    HTTP_ASYNC_SHARD_CONNECTIONS = 16  # 异步连接池每个分片的连接数
+    HTTP2_ENABLED = os.environ.get("LLM_HTTP2", "").lower() in ("1", "true", "yes")
+    
+    # 响应缓存配置（默认关闭，LLM_CACHE=1 开启）
+    CACHE_ENABLED = os.environ.get("LLM_CACHE", "").lower() in ("1", "true", "yes")
+    CACHE_DIR = os.environ.get("LLM_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"))
+    CACHE_TTL = 7 * 24 * 3600
+    CACHE_MAX_ENTRIES = 1024
+    CACHE_MAX_DISK_BYTES = 256 * 1024 * 1024
+    CACHE_REPLAY_CHUNK_SIZE = 16
+    
+    # 相同请求同时在途时只发一次
+    SINGLE_FLIGHT_ENABLED = True
+
+
+_client_pool: Optional[ClientPool] = None
+_client_pool_lock = threading.Lock()
+
+def get_client_pool() -> ClientPool:
+    """获取全局客户端连接池（单例模式）"""
+    global _client_pool
+    if _client_pool is None:
+        with _client_pool_lock:
+            if _client_pool is None:
+                _client_pool = ClientPool(
+                    max_connections=AIConfig.HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=AIConfig.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=AIConfig.HTTP_KEEPALIVE_EXPIRY,
+                    timeout=AIConfig.DEFAULT_TIMEOUT,
+                    connect_timeout=AIConfig.HTTP_CONNECT_TIMEOUT,
+                    http2=AIConfig.HTTP2_ENABLED,
+                    max_retries=0,  # 重试由 AIChat.retry 统一负责，避免 SDK 内部重试叠加
+                    async_shard_connections=AIConfig.HTTP_ASYNC_SHARD_CONNECTIONS,
+                )
+    return _client_pool
+
+def close_clients() -> None:
+    """关闭全局连接池（进程退出时自动调用）"""
+    if _client_pool is not None:
+        _client_pool.close()
+
+atexit.register(close_clients)
 
 
 class ClientManager:
-    """OpenAI客户端管理器"""
+    """OpenAI客户端管理器 - 客户端来自全局连接池，按 provider 和同步/异步复用"""
+    
+    # 设置后所有 provider 都指向同一个 OpenAI 兼容服务，(api_key, base_url)
+    _backend_override: Optional[Tuple[str, str]] = None
+    
+    @staticmethod
+    def set_backend(base_url: str, api_key: str = "fake") -> None:
+        """把所有 provider 指向同一个 OpenAI 兼容服务（本地替身服务、基准测试用）"""
+        ClientManager._backend_override = (api_key, base_url)
+        close_clients()
+    
+    @staticmethod
+    def clear_backend() -> None:
+        """恢复按 provider 读取环境变量配置"""
+        ClientManager._backend_override = None
+        close_clients()
     
     @staticmethod
     def get_client(model: str, is_async: bool = False) -> Union[OpenAI, AsyncOpenAI]:
         """根据模型和类型返回适当的OpenAI客户端"""
-        client_class = AsyncOpenAI if is_async else OpenAI
-        
+        provider = ClientManager.resolve_provider(model)
+        return ClientManager.get_provider_client(provider, is_async)
+    
+    @staticmethod
+    def get_provider_client(provider: str, is_async: bool = False) -> Union[OpenAI, AsyncOpenAI]:
+        """返回指定 provider 的池化客户端"""
+        settings = ClientManager._get_provider_settings(provider)
+        return get_client_pool().get(provider, settings, is_async)
+    
+    @staticmethod
+    def resolve_provider(model: str) -> str:
+        """根据模型名称确定 provider"""
         # OpenRouter 模型 (包含 '/' 的模型名称)
         if '/' in model:
-            return ClientManager._get_openrouter_client(client_class)
+            return "openrouter"
         
         # Deepseek 模型
         if model in ['deepseek-v3-0324', 'deepseek-r1', 'deepseek-v3']:
-            return ClientManager._get_deepseek_client(client_class)
+            return "deepseek"
         
         # 默认 OpenAI 模型
-        return ClientManager._get_openai_client(client_class)
+        return "openai"
     
     @staticmethod
-    def _get_openrouter_client(client_class):
-        """获取OpenRouter客户端"""
+    def _get_provider_settings(provider: str) -> Tuple[str, str]:
+        """返回 provider 的 (api_key, base_url)"""
+        if ClientManager._backend_override is not None:
+            return ClientManager._backend_override
+        if provider == "openrouter":
+            return ClientManager._get_openrouter_settings()
+        if provider == "deepseek":
+            return ClientManager._get_deepseek_settings()
+        if provider == "dmxapi":
+            return ClientManager._get_dmxapi_settings()
+        return ClientManager._get_openai_settings()
+    
+    @staticmethod
+    def _get_openrouter_settings() -> Tuple[str, str]:
+        """获取OpenRouter配置"""
         api_key = os.environ.get("OPENROUTER_API_KEY")
         if not api_key:
             print("OPENROUTER_API_KEY is not set")
@@ -49,11 +194,11 @@ class ClientManager:
         if not api_key:
             raise ValueError("Missing required environment variable: OPENROUTER_API_KEY")
         
-        return client_class(api_key=api_key, base_url=base_url)
+        return api_key, base_url
     
     @staticmethod
-    def _get_deepseek_client(client_class):
-        """获取Deepseek客户端"""
+    def _get_deepseek_settings() -> Tuple[str, str]:
+        """获取Deepseek配置"""
         api_key = os.environ.get("DEEPSEEK_API_KEY")
         if not api_key:
             print("DEEPSEEK_API_KEY is not set")
@@ -65,11 +210,24 @@ class ClientManager:
                 "DEEPSEEK_API_KEY and DEEPSEEK_API_BASE must be set"
             )
         
-        return client_class(api_key=api_key, base_url=base_url)
+        return api_key, base_url
     
     @staticmethod
-    def _get_openai_client(client_class):
-        """获取OpenAI客户端"""
+    def _get_dmxapi_settings() -> Tuple[str, str]:
+        """获取DMXAPI配置（向量服务）"""
+        api_key = os.environ.get("DMXAPI_API_KEY")
+        if not api_key:
+            print("DMXAPI_API_KEY is not set")
+        base_url = os.environ.get("DMXAPI_API_BASE", "https://www.dmxapi.com/v1/")
+        
+        if not api_key:
+            raise ValueError("Missing required environment variable: DMXAPI_API_KEY")
+        
+        return api_key, base_url
+    
+    @staticmethod
+    def _get_openai_settings() -> Tuple[str, str]:
+        """获取OpenAI配置"""
         api_key = os.environ.get("OPENAI_API_KEY")
         if not api_key:
             print("OPENAI_API_KEY is not set")
@@ -78,10 +236,7 @@ class ClientManager:
         if not api_key:
             raise ValueError("Missing required environment variable: OPENAI_API_KEY")
         
-        return client_class(
-            api_key=api_key,
-            base_url=base_url or "https://api.openai.com/v1"
-        )
+        return api_key, base_url or "https://api.openai.com/v1"
 
 
 class MessageProcessor:
@@ -118,31 +273,212 @@ class MessageProcessor:
         return response_message.content
 
 
+@lru_cache(maxsize=None)
+def _get_encoding(encoding_name: str) -> tiktoken.Encoding:
+    """加载并缓存 tiktoken 编码器，进程内每种编码只加载一次"""
+    return tiktoken.get_encoding(encoding_name)
+
+
 class TokenManager:
-    """Token管理工具"""
+    """Token管理工具
+    
+    编码器只加载一次；已计数过的文本按内容哈希缓存 token 数（LRU），
+    同一段历史在每一轮被重复计数时不会重新分词。
+    """
+    COUNT_CACHE_SIZE = 20000
+    BATCH_THREADS = 8
+    
+    _count_cache: "OrderedDict[Tuple[str, bytes], int]" = OrderedDict()
+    _cache_lock = threading.Lock()
+    _hits = 0
+    _misses = 0
+    
+    @staticmethod
+    def _cache_key(text: str, encoding_name: str) -> Tuple[str, bytes]:
+        return encoding_name, hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+    
+    @classmethod
+    def _cache_get(cls, key: Tuple[str, bytes]) -> Optional[int]:
+        with cls._cache_lock:
+            count = cls._count_cache.get(key)
+            if count is None:
+                cls._misses += 1
+                return None
+            cls._count_cache.move_to_end(key)
+            cls._hits += 1
+            return count
+    
+    @classmethod
+    def _cache_put(cls, key: Tuple[str, bytes], count: int) -> None:
+        with cls._cache_lock:
+            cls._count_cache[key] = count
+            cls._count_cache.move_to_end(key)
+            while len(cls._count_cache) > cls.COUNT_CACHE_SIZE:
+                cls._count_cache.popitem(last=False)
     
     @staticmethod
     def count_tokens(text: str, encoding_name: str = "cl100k_base") -> int:
         """计算文本字符串中的token数量"""
-        encoding = tiktoken.get_encoding(encoding_name)
-        return len(encoding.encode(text))
+        key = TokenManager._cache_key(text, encoding_name)
+        count = TokenManager._cache_get(key)
+        if count is None:
+            count = len(_get_encoding(encoding_name).encode(text))
+            TokenManager._cache_put(key, count)
+        return count
     
     @staticmethod
-    def truncate_by_tokens(data_list: List[str], max_tokens: int) -> List[str]:
-        """根据token大小截断数据列表"""
+    def count_tokens_batch(texts: List[str], encoding_name: str = "cl100k_base",
+                           num_threads: Optional[int] = None) -> List[int]:
+        """批量计算token数量：缓存命中的直接返回，其余用 encode_batch 多线程一次分词"""
+        keys = [TokenManager._cache_key(text, encoding_name) for text in texts]
+        counts: List[Optional[int]] = [TokenManager._cache_get(key) for key in keys]
+        
+        # 未命中的文本去重后批量分词
+        missing: Dict[Tuple[str, bytes], str] = {}
+        for key, text, count in zip(keys, texts, counts):
+            if count is None:
+                missing.setdefault(key, text)
+        
+        if missing:
+            encoded = _get_encoding(encoding_name).encode_batch(
+                list(missing.values()),
+                num_threads=num_threads or TokenManager.BATCH_THREADS
+            )
+            fresh = {}
+            for key, tokens in zip(missing.keys(), encoded):
+                fresh[key] = len(tokens)
+                TokenManager._cache_put(key, len(tokens))
+            counts = [fresh[key] if count is None else count for key, count in zip(keys, counts)]
+        
+        return counts
+    
+    @staticmethod
+    def truncate_by_tokens(data_list: List[str], max_tokens: int,
+                           token_counts: Optional[List[int]] = None) -> List[str]:
+        """根据token大小截断数据列表
+        
+        Args:
+            data_list: 待截断的文本列表
+            max_tokens: token上限
+            token_counts: 调用方已知的每条文本token数（如上一轮的结果），传入时不再重新计数
+        """
+        if token_counts is None:
+            token_counts = TokenManager.count_tokens_batch(data_list)
+        
         total_tokens = 0
-        for i, data in enumerate(data_list):
-            total_tokens += TokenManager.count_tokens(data)
+        for i, count in enumerate(token_counts):
+            total_tokens += count
             if total_tokens > max_tokens:
                 return data_list[:i]
         return data_list
+    
+    @staticmethod
+    def truncate_text(text: str, max_tokens: int, encoding_name: str = "cl100k_base",
+                      marker: str = "…（已截断）") -> str:
+        """把单段文本截断到 max_tokens 以内（含截断标记），未超出时原样返回"""
+        if TokenManager.count_tokens(text, encoding_name) <= max_tokens:
+            return text
+        if max_tokens <= 0:
+            return ""
+        encoding = _get_encoding(encoding_name)
+        keep = max(0, max_tokens - len(encoding.encode(marker)))
+        return encoding.decode(encoding.encode(text)[:keep]) + marker
+    
+    @classmethod
+    def cache_info(cls) -> Dict[str, int]:
+        """token计数缓存的命中统计"""
+        with cls._cache_lock:
+            return {
+                "hits": cls._hits,
+                "misses": cls._misses,
+                "size": len(cls._count_cache),
+                "max_size": cls.COUNT_CACHE_SIZE,
+            }
 
 
 class AIChat:
     """AI聊天主类"""
     
-    def __init__(self):
-        self.semaphore = asyncio.Semaphore(AIConfig.MAX_CONCURRENT_REQUESTS)
+    def __init__(self, cache: Optional[ResponseCache] = None, telemetry: Optional[Telemetry] = None):
+        self.rate_limits = RateLimitManager(
+            provider_limits=AIConfig.PROVIDER_RATE_LIMITS,
+            model_limits=AIConfig.MODEL_RATE_LIMITS,
+            initial_concurrency=AIConfig.MAX_CONCURRENT_REQUESTS,
+            max_concurrency=AIConfig.MAX_CONCURRENT_REQUESTS_CEILING,
+        )
+        self.cache = cache
+        self.single_flight = SingleFlight()
+        self.retry = RetryExecutor(
+            RetryPolicy(
+                max_attempts=AIConfig.RETRY_MAX_ATTEMPTS,
+                base_delay=AIConfig.RETRY_BASE_DELAY,
+                max_delay=AIConfig.RETRY_MAX_DELAY,
+                deadline=AIConfig.DEFAULT_TIMEOUT,
+                attempt_timeout=AIConfig.ATTEMPT_TIMEOUT,
+            ),
+            HedgePolicy(
+                enabled=AIConfig.HEDGE_ENABLED,
+                quantile=AIConfig.HEDGE_QUANTILE,
+                min_delay=AIConfig.HEDGE_MIN_DELAY,
+                fallback_models=AIConfig.HEDGE_FALLBACK_MODELS,
+            ),
+        )
+        self.async_single_flight = AsyncSingleFlight()
+        self.router = ProviderRouter(
+            ClientManager.resolve_provider,
+            equivalents=AIConfig.MODEL_EQUIVALENTS,
+            alpha=AIConfig.ROUTER_EWMA_ALPHA,
+            failure_threshold=AIConfig.CIRCUIT_FAILURE_THRESHOLD,
+            error_rate_threshold=AIConfig.CIRCUIT_ERROR_RATE_THRESHOLD,
+            open_seconds=AIConfig.CIRCUIT_OPEN_SECONDS,
+        )
+        self.telemetry = telemetry
+    
+    def _trace(self, model: str, stream: bool = False) -> Optional[CallRecord]:
+        """开始一条调用记录，遥测关闭时返回 None"""
+        if self.telemetry is None:
+            return None
+        return self.telemetry.start(model, stream)
+    
+    def _finish_trace(self, trace: Optional[CallRecord], error: Optional[BaseException] = None) -> None:
+        if trace is None:
+            return
+        if error is None and not trace.cache_hit and trace.provider is None:
+            # 成功却没有经过 _observe：合并到了进行中的相同请求上，端点和用量记在领头调用的记录里，
+            # 这里只标记为 coalesced，避免重复计入 token
+            trace.coalesced = True
+            trace.provider = ClientManager.resolve_provider(trace.model)
+        self.telemetry.record(trace.finish(error))
+    
+    @staticmethod
+    def _observe(trace: Optional[CallRecord], target_model: str, provider: str,
+                 slot: Any, usage: Any = None) -> None:
+        """把实际路由到的端点、排队时间和用量写入调用记录"""
+        if trace is None:
+            return
+        trace.model = target_model
+        trace.provider = provider
+        trace.queue_wait = slot.wait_time
+        trace.set_usage(usage)
+    
+    def _route(self, model: str, tried: Optional[set] = None) -> str:
+        """选择本次尝试实际调用的模型；tried 为本次调用中已失败的模型"""
+        if not AIConfig.ROUTER_ENABLED:
+            return model
+        return self.router.choose(model, avoid=tried or ())
+    
+    def _record_route(self, model: str, latency: Optional[float], error: Optional[BaseException] = None,
+                      tried: Optional[set] = None) -> None:
+        if not AIConfig.ROUTER_ENABLED:
+            return
+        self.router.record(model, latency, error)
+        if error is not None and tried is not None:
+            tried.add(model)
+    
+    def _release_route(self, model: str) -> None:
+        """选择端点之后请求没有发出（建立客户端出错、排队等待限流时被取消）：不计入健康度，只归还路由名额"""
+        if AIConfig.ROUTER_ENABLED:
+            self.router.release(model)
     
     def _build_kwargs(self, messages: List[Dict], model: str, 
                      response_format: str, tools: Optional[List], 
@@ -156,6 +492,8 @@ class AIChat:
         
         if stream:
             kwargs["stream"] = True
+            if AIConfig.STREAM_INCLUDE_USAGE:
+                kwargs["stream_options"] = {"include_usage": True}
         
         if response_format == 'json':
             kwargs["response_format"] = {"type": "json_object"}
@@ -166,120 +504,507 @@ class AIChat:
         
         return kwargs
     
+    @staticmethod
+    def _request_key(kwargs: Dict[str, Any]) -> str:
+        """请求的内容哈希，用于缓存和请求合并。流式与非流式共用同一个键"""
+        return make_cache_key({
+            "messages": kwargs["messages"],
+            "model": kwargs["model"],
+            "temperature": kwargs["temperature"],
+            "response_format": kwargs.get("response_format"),
+            "tools": kwargs.get("tools"),
+        })
+    
+    def _cache_get(self, request_key: str, use_cache: bool) -> Optional[str]:
+        if self.cache is None or not use_cache:
+            return None
+        return self.cache.get(request_key)
+    
+    def _cache_put(self, request_key: str, use_cache: bool, result: Optional[str]) -> None:
+        if self.cache is not None and use_cache:
+            self.cache.put(request_key, result)
+    
+    def _estimate_tokens(self, provider: str, kwargs: Dict[str, Any]) -> int:
+        """调用前预估本次请求的 token 数（仅在配置了 TPM 时计算）"""
+        if not self.rate_limits.needs_token_estimate(provider, kwargs["model"]):
+            return 0
+        contents = [m["content"] for m in kwargs["messages"] if isinstance(m.get("content"), str)]
+        prompt_tokens = sum(TokenManager.count_tokens_batch(contents)) + 4 * len(kwargs["messages"])
+        return prompt_tokens + AIConfig.ESTIMATED_COMPLETION_TOKENS
+    
+    @staticmethod
+    def _replay(text: str) -> List[str]:
+        """把缓存的完整响应切成流式块回放"""
+        size = AIConfig.CACHE_REPLAY_CHUNK_SIZE
+        return [text[i:i + size] for i in range(0, len(text), size)]
+    
     def chat(self, message: Union[str, List[Dict]], 
              model: str = "google/gemini-2.5-flash", 
              response_format: str = 'NOT_GIVEN', 
-             tools: Optional[List] = None) -> str:
+             tools: Optional[List] = None,
+             use_cache: bool = True) -> str:
         """同步聊天完成"""
-        client = ClientManager.get_client(model)
         messages = MessageProcessor.prepare_messages(message)
         kwargs = self._build_kwargs(messages, model, response_format, tools)
+        request_key = self._request_key(kwargs)
+        trace = self._trace(model)
+        cached = self._cache_get(request_key, use_cache)
+        if cached is not None:
+            if trace is not None:
+                trace.cache_hit = True
+                self._finish_trace(trace)
+            return cached
         
-        chat_completion = client.chat.completions.create(**kwargs)
-        return MessageProcessor.process_response(chat_completion.choices[0].message)
+        tried = set()
+        
+        def attempt(requested_model: str, timeout: float) -> str:
+            target_model = self._route(requested_model, tried)
+            recorded = False
+            try:
+                provider = ClientManager.resolve_provider(target_model)
+                client = ClientManager.get_provider_client(provider)
+                request = dict(kwargs, model=target_model)
+                with self.rate_limits.slot(provider, target_model, self._estimate_tokens(provider, request)) as slot:
+                    start = time.monotonic()
+                    try:
+                        chat_completion = client.chat.completions.create(**request, timeout=timeout)
+                    except BaseException as e:
+                        recorded = True
+                        self._record_route(target_model, None, e, tried)
+                        raise
+                    recorded = True
+                    self._record_route(target_model, time.monotonic() - start)
+                    if chat_completion.usage is not None:
+                        slot.actual_tokens = chat_completion.usage.total_tokens
+            finally:
+                if not recorded:
+                    self._release_route(target_model)
+            self._observe(trace, target_model, provider, slot, chat_completion.usage)
+            return MessageProcessor.process_response(chat_completion.choices[0].message)
+        
+        def complete() -> str:
+            result = self.retry.call(attempt, model)
+            self._cache_put(request_key, use_cache, result)
+            return result
+        
+        try:
+            if not AIConfig.SINGLE_FLIGHT_ENABLED:
+                result = complete()
+            else:
+                result = self.single_flight.do(request_key, complete)
+        except BaseException as e:
+            self._finish_trace(trace, e)
+            raise
+        self._finish_trace(trace)
+        return result
     
     async def chat_async(self, message: Union[str, List[Dict]], 
                         model: str = "google/gemini-2.5-flash", 
                         response_format: str = 'NOT_GIVEN', 
-                        tools: Optional[List] = None) -> str:
+                        tools: Optional[List] = None,
+                        use_cache: bool = True) -> str:
         """异步聊天完成"""
-        client = ClientManager.get_client(model, is_async=True)
         messages = MessageProcessor.prepare_messages(message)
         kwargs = self._build_kwargs(messages, model, response_format, tools)
+        request_key = self._request_key(kwargs)
+        trace = self._trace(model)
+        cached = self._cache_get(request_key, use_cache)
+        if cached is not None:
+            if trace is not None:
+                trace.cache_hit = True
+                self._finish_trace(trace)
+            return cached
         
-        try:
-            async with self.semaphore:
-                chat_completion = await asyncio.wait_for(
-                    client.chat.completions.create(**kwargs),
-                    timeout=AIConfig.DEFAULT_TIMEOUT
-                )
+        tried = set()
+        
+        async def attempt(requested_model: str, timeout: float) -> str:
+            target_model = self._route(requested_model, tried)
+            recorded = False
+            try:
+                provider = ClientManager.resolve_provider(target_model)
+                client = ClientManager.get_provider_client(provider, is_async=True)
+                request = dict(kwargs, model=target_model)
+                async with self.rate_limits.aslot(provider, target_model,
+                                                  self._estimate_tokens(provider, request)) as slot:
+                    start = time.monotonic()
+                    try:
+                        chat_completion = await asyncio.wait_for(
+                            client.chat.completions.create(**request, timeout=timeout),
+                            timeout=timeout
+                        )
+                    except BaseException as e:
+                        # 对冲输掉被取消时不计入失败（只归还探测名额）
+                        recorded = True
+                        self._record_route(target_model, None, e, tried)
+                        raise
+                    recorded = True
+                    self._record_route(target_model, time.monotonic() - start)
+                    if chat_completion.usage is not None:
+                        slot.actual_tokens = chat_completion.usage.total_tokens
+            finally:
+                if not recorded:
+                    # 排队等待限流时被取消（如对冲输掉）或建立客户端出错
+                    self._release_route(target_model)
+            self._observe(trace, target_model, provider, slot, chat_completion.usage)
             return MessageProcessor.process_response(chat_completion.choices[0].message)
-        except asyncio.TimeoutError:
-            raise TimeoutError(f"API request timed out after {AIConfig.DEFAULT_TIMEOUT} seconds")
+        
+        async def complete() -> str:
+            try:
+                result = await self.retry.acall(attempt, model)
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"API request timed out after {AIConfig.DEFAULT_TIMEOUT} seconds")
+            self._cache_put(request_key, use_cache, result)
+            return result
+        
+        try:
+            if not AIConfig.SINGLE_FLIGHT_ENABLED:
+                result = await complete()
+            else:
+                result = await self.async_single_flight.do(request_key, complete)
+        except BaseException as e:
+            self._finish_trace(trace, e)
+            raise
+        self._finish_trace(trace)
+        return result
     
     def chat_stream(self, message: Union[str, List[Dict]], 
                    model: str = "google/gemini-2.5-flash", 
                    response_format: str = 'NOT_GIVEN',
-                   tools: Optional[List] = None) -> Generator[str, None, None]:
+                   tools: Optional[List] = None,
+                   use_cache: bool = True) -> Generator[str, None, None]:
         """流式聊天完成"""
-        client = ClientManager.get_client(model)
         messages = MessageProcessor.prepare_messages(message)
         kwargs = self._build_kwargs(messages, model, response_format, tools, stream=True)
+        request_key = self._request_key(kwargs)
+        trace = self._trace(model, stream=True)
+        try:
+            yield from self._chat_stream(kwargs, model, request_key, use_cache, trace)
+        except GeneratorExit:
+            # 调用方提前结束不算失败
+            self._finish_trace(trace)
+            raise
+        except BaseException as e:
+            self._finish_trace(trace, e)
+            raise
+        self._finish_trace(trace)
+    
+    def _chat_stream(self, kwargs: Dict[str, Any], model: str, request_key: str,
+                     use_cache: bool, trace: Optional[CallRecord]) -> Generator[str, None, None]:
+        cached = self._cache_get(request_key, use_cache)
+        if cached is not None:
+            if trace is not None:
+                trace.cache_hit = True
+                trace.mark_first_token()
+            yield from self._replay(cached)
+            return
         
+        # 流式请求在开始时路由一次，整个流（含建立时的重试）都走同一端点
+        target_model = self._route(model)
+        recorded = False
         try:
-            stream = client.chat.completions.create(**kwargs)
-            for chunk in stream:
-                if chunk.choices[0].delta.content is not None:
-                    yield chunk.choices[0].delta.content
+            request = dict(kwargs, model=target_model)
+            provider = ClientManager.resolve_provider(target_model)
+            client = ClientManager.get_provider_client(provider)
+            parts = []
+            # 并发名额在整个流式响应期间保持占用
+            with self.rate_limits.slot(provider, target_model, self._estimate_tokens(provider, request)) as slot:
+                # 只在建立流之前重试，已经输出的内容无法撤回
+                try:
+                    # 建立流的耗时不代表完整响应的延迟，不计入对冲触发用的延迟统计
+                    stream = self.retry.call(
+                        lambda _, timeout: client.chat.completions.create(**request, timeout=timeout), target_model,
+                        track_latency=False
+                    )
+                except BaseException as e:
+                    recorded = True
+                    self._record_route(target_model, None, e)
+                    raise
+                recorded = True
+                self._record_route(target_model, None)
+                self._observe(trace, target_model, provider, slot)
+                try:
+                    for chunk in stream:
+                        if getattr(chunk, "usage", None) is not None:
+                            slot.actual_tokens = chunk.usage.total_tokens
+                            if trace is not None:
+                                trace.set_usage(chunk.usage)
+                        if chunk.choices and chunk.choices[0].delta.content is not None:
+                            if trace is not None:
+                                trace.mark_first_token()
+                            parts.append(chunk.choices[0].delta.content)
+                            yield chunk.choices[0].delta.content
+                finally:
+                    # 只关闭本次响应，连接归还连接池
+                    stream.close()
         finally:
-            if hasattr(client, 'close'):
-                client.close()
+            if not recorded:
+                self._release_route(target_model)
+
+        # 只缓存完整读完的流，调用方提前中断时不写入
+        self._cache_put(request_key, use_cache, "".join(parts))
     
     async def chat_stream_async(self, message: Union[str, List[Dict]], 
                                model: str = "google/gemini-2.5-flash", 
                                response_format: str = 'NOT_GIVEN',
-                               tools: Optional[List] = None) -> AsyncGenerator[str, None]:
+                               tools: Optional[List] = None,
+                               use_cache: bool = True) -> AsyncGenerator[str, None]:
         """异步流式聊天完成"""
-        client = ClientManager.get_client(model, is_async=True)
         messages = MessageProcessor.prepare_messages(message)
         kwargs = self._build_kwargs(messages, model, response_format, tools, stream=True)
+        request_key = self._request_key(kwargs)
+        trace = self._trace(model, stream=True)
+        cached = self._cache_get(request_key, use_cache)
+        if cached is not None:
+            if trace is not None:
+                trace.cache_hit = True
+                trace.mark_first_token()
+            for chunk in self._replay(cached):
+                yield chunk
+            self._finish_trace(trace)
+            return
         
+        async def upstream() -> AsyncGenerator[str, None]:
+            # 流式请求在开始时路由一次，整个流（含建立时的重试）都走同一端点
+            target_model = self._route(model)
+            recorded = False
+            try:
+                request = dict(kwargs, model=target_model)
+                provider = ClientManager.resolve_provider(target_model)
+                client = ClientManager.get_provider_client(provider, is_async=True)
+                parts = []
+                # 并发名额在整个流式响应期间保持占用
+                async with self.rate_limits.aslot(provider, target_model,
+                                                  self._estimate_tokens(provider, request)) as slot:
+                    # 只在建立流之前重试，已经输出的内容无法撤回
+                    try:
+                        stream = await self.retry.acall(
+                            lambda _, timeout: client.chat.completions.create(**request, timeout=timeout),
+                            target_model, hedge=False
+                        )
+                    except BaseException as e:
+                        recorded = True
+                        self._record_route(target_model, None, e)
+                        raise
+                    recorded = True
+                    self._record_route(target_model, None)
+                    self._observe(trace, target_model, provider, slot)
+                    try:
+                        async for chunk in stream:
+                            if getattr(chunk, "usage", None) is not None:
+                                slot.actual_tokens = chunk.usage.total_tokens
+                                if trace is not None:
+                                    trace.set_usage(chunk.usage)
+                            if chunk.choices and chunk.choices[0].delta.content is not None:
+                                parts.append(chunk.choices[0].delta.content)
+                                yield chunk.choices[0].delta.content
+                    finally:
+                        # 只关闭本次响应，连接归还连接池
+                        await stream.close()
+            finally:
+                if not recorded:
+                    self._release_route(target_model)
+
+            # 只缓存完整读完的流，调用方提前中断时不写入
+            self._cache_put(request_key, use_cache, "".join(parts))
+        
+        if AIConfig.SINGLE_FLIGHT_ENABLED:
+            # 相同的流式请求进行中时，后来者挂到同一个上游流上
+            chunks = self.async_single_flight.stream(request_key, upstream)
+        else:
+            chunks = upstream()
+        error = None
         try:
-            stream = await client.chat.completions.create(**kwargs)
-            async for chunk in stream:
-                if chunk.choices[0].delta.content is not None:
-                    yield chunk.choices[0].delta.content
+            async for chunk in chunks:
+                if trace is not None:
+                    trace.mark_first_token()
+                yield chunk
+        except GeneratorExit:
+            raise
+        except BaseException as e:
+            error = e
+            raise
         finally:
-            if hasattr(client, 'close'):
-                await client.close()
+            # 调用方提前结束时立即释放订阅/上游连接
+            await chunks.aclose()
+            self._finish_trace(trace, error)
+    
+    def single_flight_stats(self) -> Dict[str, Any]:
+        """请求合并统计"""
+        return {
+            "sync": self.single_flight.stats(),
+            "async": self.async_single_flight.stats(),
+        }
+
+
+def _create_default_cache() -> Optional[ResponseCache]:
+    """根据配置创建默认响应缓存，未开启时返回 None"""
+    if not AIConfig.CACHE_ENABLED:
+        return None
+    return ResponseCache(
+        max_entries=AIConfig.CACHE_MAX_ENTRIES,
+        ttl=AIConfig.CACHE_TTL,
+        directory=AIConfig.CACHE_DIR,
+        max_disk_bytes=AIConfig.CACHE_MAX_DISK_BYTES,
+    )
+
+
+def _create_default_telemetry() -> Optional[Telemetry]:
+    """根据配置创建默认遥测，未开启时返回 None"""
+    if not AIConfig.TELEMETRY_ENABLED:
+        return None
+    sinks = [JsonlSink(AIConfig.TELEMETRY_JSONL_PATH)] if AIConfig.TELEMETRY_JSONL_PATH else []
+    return Telemetry(sinks)
 
 
 # 全局实例和便捷函数
-_ai_chat = AIChat()
+_ai_chat = AIChat(cache=_create_default_cache(), telemetry=_create_default_telemetry())
+
+def enable_response_cache(cache: Optional[ResponseCache] = None) -> ResponseCache:
+    """为全局 llm_call* 开启响应缓存，不传参数时按 AIConfig 创建"""
+    if cache is None:
+        cache = ResponseCache(
+            max_entries=AIConfig.CACHE_MAX_ENTRIES,
+            ttl=AIConfig.CACHE_TTL,
+            directory=AIConfig.CACHE_DIR,
+            max_disk_bytes=AIConfig.CACHE_MAX_DISK_BYTES,
+        )
+    _ai_chat.cache = cache
+    return cache
+
+def disable_response_cache() -> None:
+    """关闭全局响应缓存"""
+    _ai_chat.cache = None
+
+def get_cache_stats() -> Dict[str, Any]:
+    """全局响应缓存的命中统计"""
+    if _ai_chat.cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **_ai_chat.cache.stats()}
+
+def get_rate_limit_stats() -> Dict[str, Any]:
+    """全局限流与并发窗口状态"""
+    return _ai_chat.rate_limits.stats()
+
+def get_retry_stats() -> Dict[str, Any]:
+    """全局重试与对冲统计"""
+    return _ai_chat.retry.stats()
+
+def enable_telemetry(sinks: Optional[List[TelemetrySink]] = None) -> Telemetry:
+    """为全局 llm_call* 开启遥测，已开启时追加 sink"""
+    if _ai_chat.telemetry is None:
+        _ai_chat.telemetry = Telemetry(sinks)
+    else:
+        for sink in sinks or []:
+            _ai_chat.telemetry.add_sink(sink)
+    return _ai_chat.telemetry
+
+def disable_telemetry() -> None:
+    """关闭全局遥测"""
+    if _ai_chat.telemetry is not None:
+        _ai_chat.telemetry.close()
+    _ai_chat.telemetry = None
+
+def get_telemetry_stats(session_id: Optional[str] = None) -> Dict[str, Any]:
+    """按模型和会话聚合的调用指标；传 session_id 时只返回该会话"""
+    if _ai_chat.telemetry is None:
+        return {"enabled": False}
+    return _ai_chat.telemetry.stats(session_id)
+
+def get_router_stats() -> Dict[str, Any]:
+    """端点健康度、熔断状态和最近的路由决策"""
+    return _ai_chat.router.stats()
+
+def get_single_flight_stats() -> Dict[str, Any]:
+    """全局请求合并统计"""
+    return _ai_chat.single_flight_stats()
+
+def get_embedding_stats() -> Dict[str, Any]:
+    """各向量模型的批处理与缓存统计"""
+    return {model: service.stats() for model, service in list(_embedding_services.items())}
 
 def llm_call(message: Union[str, List[Dict]], 
             model: str = "google/gemini-2.5-flash", 
             response_format: str = 'NOT_GIVEN', 
-            tools: Optional[List] = None) -> str:
+            tools: Optional[List] = None,
+            use_cache: bool = True) -> str:
     """同步聊天完成 - 便捷函数"""
-    return _ai_chat.chat(message, model, response_format, tools)
+    return _ai_chat.chat(message, model, response_format, tools, use_cache)
 
 async def llm_call_async(message: Union[str, List[Dict]], 
                        model: str = "google/gemini-2.5-flash", 
                        response_format: str = 'NOT_GIVEN', 
-                       tools: Optional[List] = None) -> str:
+                       tools: Optional[List] = None,
+                       use_cache: bool = True) -> str:
     """异步聊天完成 - 便捷函数"""
-    return await _ai_chat.chat_async(message, model, response_format, tools)
+    return await _ai_chat.chat_async(message, model, response_format, tools, use_cache)
 
 def llm_call_stream(message: Union[str, List[Dict]], 
                   model: str = "google/gemini-2.5-flash", 
                   response_format: str = 'NOT_GIVEN',
-                  tools: Optional[List] = None) -> Generator[str, None, None]:
+                  tools: Optional[List] = None,
+                  use_cache: bool = True) -> Generator[str, None, None]:
     """流式聊天完成 - 便捷函数"""
-    return _ai_chat.chat_stream(message, model, response_format, tools)
+    return _ai_chat.chat_stream(message, model, response_format, tools, use_cache)
 
 async def llm_call_stream_async(message: Union[str, List[Dict]], 
                               model: str = "google/gemini-2.5-flash", 
                               response_format: str = 'NOT_GIVEN',
-                              tools: Optional[List] = None) -> AsyncGenerator[str, None]:
+                              tools: Optional[List] = None,
+                              use_cache: bool = True) -> AsyncGenerator[str, None]:
     """异步流式聊天完成 - 便捷函数"""
-    async for chunk in _ai_chat.chat_stream_async(message, model, response_format, tools):
+    async for chunk in _ai_chat.chat_stream_async(message, model, response_format, tools, use_cache):
         yield chunk
 
 
+_embedding_services: Dict[str, EmbeddingService] = {}
+_embedding_lock = threading.Lock()
+
+def get_embedding_service(model: str = "text-embedding-3-small") -> EmbeddingService:
+    """获取指定模型的向量服务（每个模型一个实例，共享磁盘缓存目录）"""
+    service = _embedding_services.get(model)
+    if service is None:
+        with _embedding_lock:
+            service = _embedding_services.get(model)
+            if service is None:
+                cache = ResponseCache(
+                    max_entries=AIConfig.EMBEDDING_CACHE_MAX_ENTRIES,
+                    ttl=None,
+                    directory=AIConfig.EMBEDDING_CACHE_DIR,
+                    max_disk_bytes=AIConfig.EMBEDDING_CACHE_MAX_DISK_BYTES,
+                ) if AIConfig.EMBEDDING_CACHE_ENABLED else None
+                service = EmbeddingService(
+                    client_factory=lambda: ClientManager.get_provider_client(AIConfig.EMBEDDING_PROVIDER),
+                    model=model,
+                    max_batch_size=AIConfig.EMBEDDING_MAX_BATCH_SIZE,
+                    max_wait_ms=AIConfig.EMBEDDING_MAX_WAIT_MS,
+                    concurrency=AIConfig.EMBEDDING_CONCURRENCY,
+                    cache=cache,
+                )
+                _embedding_services[model] = service
+    return service
+
 def get_embedding(text, model="text-embedding-3-small"):
-    client = OpenAI(base_url="https://www.dmxapi.com/v1/", api_key=os.environ.get("DMXAPI_API_KEY"))
-    response = client.embeddings.create(
-        model=model,
-        input=text
-    )
-    return response.data[0].embedding
+    """获取单条文本向量（自动与同时到达的请求合并成批）"""
+    return get_embedding_service(model).embed(text)
+
+def get_embeddings(texts: List[str], model: str = "text-embedding-3-small") -> List[List[float]]:
+    """批量获取文本向量（用于回填），结果与输入顺序一致"""
+    return get_embedding_service(model).embed_many(texts)
 
 # Token处理便捷函数
 def count_tokens(string: str, encoding_name: str = "cl100k_base") -> int:
     """计算文本中的token数量 - 便捷函数"""
     return TokenManager.count_tokens(string, encoding_name)
 
-def truncate_by_tokens(list_data: List[str], max_token_size: int) -> List[str]:
+def count_tokens_batch(strings: List[str], encoding_name: str = "cl100k_base") -> List[int]:
+    """批量计算文本的token数量 - 便捷函数"""
+    return TokenManager.count_tokens_batch(strings, encoding_name)
+
+def truncate_text(text: str, max_tokens: int, encoding_name: str = "cl100k_base") -> str:
+    """按token数截断单段文本 - 便捷函数"""
+    return TokenManager.truncate_text(text, max_tokens, encoding_name)
+
+def truncate_by_tokens(list_data: List[str], max_token_size: int,
+                       token_counts: Optional[List[int]] = None) -> List[str]:
     """根据token大小截断列表 - 便捷函数"""
-    return TokenManager.truncate_by_tokens(list_data, max_token_size)
\ No newline at end of file
+    return TokenManager.truncate_by_tokens(list_data, max_token_size, token_counts)
\ No newline at end of file
@@ -0,0 +1,288 @@
+"""
+限流与自适应并发 - 按 provider / 模型的 RPM、TPM 令牌桶，以及 AIMD 并发控制
+"""
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+import openai
+
+
+def is_overload_error(error: BaseException) -> bool:
+    """上游过载类错误（429 / 5xx / 超时），出现时并发窗口需要收缩"""
+    if isinstance(error, (openai.RateLimitError, openai.APITimeoutError, asyncio.TimeoutError, TimeoutError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+
+class TokenBucket:
+    """令牌桶：按分钟速率匀速补充
+
+    采用预约模式：acquire 先扣减令牌（允许透支），返回需要等待的秒数，
+    由调用方决定 time.sleep 还是 asyncio.sleep，同一个桶可以同时服务线程和协程。
+    """
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity if capacity is not None else per_minute
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill_locked(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount: float) -> float:
+        """预约 amount 个令牌，返回需要等待的秒数"""
+        with self._lock:
+            self._refill_locked()
+            self._tokens -= amount
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def reconcile(self, delta: float) -> None:
+        """按实际用量修正：delta > 0 表示实际多用，< 0 表示退还"""
+        with self._lock:
+            self._refill_locked()
+            self._tokens = min(self.capacity, self._tokens - delta)
+
+    def available(self) -> float:
+        with self._lock:
+            self._refill_locked()
+            return self._tokens
+
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD 并发控制：成功时窗口缓慢加一，遇到 429/5xx 时窗口减半，其他失败（取消、4xx、连接错误）不调整窗口
+
+    同时支持线程（acquire）和协程（acquire_async），
+    等待者在有名额释放时被唤醒后重新竞争。
+    """
+
+    def __init__(self, initial: int = 10, min_limit: int = 1, max_limit: int = 64,
+                 decrease_factor: float = 0.5, decrease_interval: float = 1.0):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.decrease_interval = decrease_interval
+        self._limit = float(initial)
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        self._waiters: List[Any] = []
+        self._lock = threading.Lock()
+        self._stats = {"successes": 0, "overloads": 0, "decreases": 0, "errors": 0}
+
+    @property
+    def limit(self) -> int:
+        return max(self.min_limit, int(self._limit))
+
+    def _try_acquire_locked(self) -> bool:
+        if self._in_flight < self.limit:
+            self._in_flight += 1
+            return True
+        return False
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                if self._try_acquire_locked():
+                    return
+                event = threading.Event()
+                self._waiters.append(event.set)
+            event.wait()
+
+    async def acquire_async(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                if self._try_acquire_locked():
+                    return
+                future = loop.create_future()
+
+                def wake(future=future):
+                    loop.call_soon_threadsafe(
+                        lambda: future.done() or future.set_result(None)
+                    )
+                self._waiters.append(wake)
+            await future
+
+    def release(self, overloaded: bool = False, succeeded: bool = True) -> None:
+        """归还名额：overloaded 时收缩窗口，succeeded 时扩大窗口，两者都不是时只归还名额"""
+        with self._lock:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if overloaded:
+                self._stats["overloads"] += 1
+                # 同一波失败只收缩一次，避免窗口瞬间跌到最小
+                if now - self._last_decrease >= self.decrease_interval:
+                    self._limit = max(float(self.min_limit), self._limit * self.decrease_factor)
+                    self._last_decrease = now
+                    self._stats["decreases"] += 1
+            elif not succeeded:
+                self._stats["errors"] += 1
+            else:
+                self._stats["successes"] += 1
+                self._limit = min(float(self.max_limit), self._limit + 1.0 / self._limit)
+            waiters, self._waiters = self._waiters, []
+        for wake in waiters:
+            wake()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "limit": self.limit,
+                "in_flight": self._in_flight,
+                "waiting": len(self._waiters),
+                **self._stats,
+            }
+
+
+class RateLimitSlot:
+    """一次上游调用占用的限流名额；调用方在拿到 usage 后填写 actual_tokens"""
+
+    def __init__(self, estimated_tokens: int):
+        self.estimated_tokens = estimated_tokens
+        self.actual_tokens: Optional[int] = None
+        self.wait_time = 0.0
+
+
+class RateLimitManager:
+    """按 provider 和模型管理令牌桶与并发窗口"""
+
+    def __init__(self, provider_limits: Optional[Dict[str, Dict[str, Optional[int]]]] = None,
+                 model_limits: Optional[Dict[str, Dict[str, Optional[int]]]] = None,
+                 initial_concurrency: int = 10, max_concurrency: int = 64):
+        self.provider_limits = provider_limits or {}
+        self.model_limits = model_limits or {}
+        self.initial_concurrency = initial_concurrency
+        self.max_concurrency = max_concurrency
+        self._buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self._concurrency: Dict[str, AdaptiveConcurrencyLimiter] = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, scope: str, kind: str, per_minute: Optional[int]) -> Optional[TokenBucket]:
+        if not per_minute:
+            return None
+        key = (scope, kind)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.setdefault(key, TokenBucket(per_minute))
+        return bucket
+
+    def _buckets_for(self, provider: str, model: str) -> List[Tuple[Optional[TokenBucket], Optional[TokenBucket]]]:
+        """返回 [(rpm桶, tpm桶), ...]，依次为 provider 级和模型级"""
+        result = []
+        for scope, limits in ((f"provider:{provider}", self.provider_limits.get(provider)),
+                              (f"model:{model}", self.model_limits.get(model))):
+            if limits:
+                result.append((self._bucket(scope, "rpm", limits.get("rpm")),
+                               self._bucket(scope, "tpm", limits.get("tpm"))))
+        return result
+
+    def needs_token_estimate(self, provider: str, model: str) -> bool:
+        """只有配置了 TPM 时才需要预估 token，避免无谓的分词"""
+        return any(tpm is not None for _, tpm in self._buckets_for(provider, model))
+
+    def concurrency(self, provider: str) -> AdaptiveConcurrencyLimiter:
+        limiter = self._concurrency.get(provider)
+        if limiter is None:
+            with self._lock:
+                limiter = self._concurrency.setdefault(provider, AdaptiveConcurrencyLimiter(
+                    initial=self.initial_concurrency, max_limit=self.max_concurrency
+                ))
+        return limiter
+
+    def _reserve(self, provider: str, model: str, tokens: int) -> float:
+        wait = 0.0
+        for rpm, tpm in self._buckets_for(provider, model):
+            if rpm is not None:
+                wait = max(wait, rpm.reserve(1))
+            if tpm is not None and tokens:
+                wait = max(wait, tpm.reserve(tokens))
+        return wait
+
+    def _reconcile(self, provider: str, model: str, slot: RateLimitSlot, failed: bool = False) -> None:
+        """按实际用量修正 TPM 预约；调用失败或被取消、没拿到 usage 时退还整个预估"""
+        if not slot.estimated_tokens:
+            return
+        if slot.actual_tokens is not None:
+            delta = slot.actual_tokens - slot.estimated_tokens
+        elif failed:
+            delta = -slot.estimated_tokens
+        else:
+            return
+        for _, tpm in self._buckets_for(provider, model):
+            if tpm is not None:
+                tpm.reconcile(delta)
+
+    @contextmanager
+    def slot(self, provider: str, model: str, estimated_tokens: int = 0):
+        """同步调用的限流上下文：等待令牌 -> 占用并发名额 -> 结束后修正用量并调整窗口
+
+        成功才扩大并发窗口，过载才收缩；失败或被取消时退还没用上的 TPM 预约。
+        """
+        slot = RateLimitSlot(estimated_tokens)
+        start = time.perf_counter()
+        wait = self._reserve(provider, model, estimated_tokens)
+        limiter = self.concurrency(provider)
+        try:
+            if wait > 0:
+                time.sleep(wait)
+            limiter.acquire()
+        except BaseException:
+            self._reconcile(provider, model, slot, failed=True)
+            raise
+        slot.wait_time = time.perf_counter() - start
+        try:
+            yield slot
+        except BaseException as e:
+            limiter.release(overloaded=is_overload_error(e), succeeded=False)
+            self._reconcile(provider, model, slot, failed=True)
+            raise
+        limiter.release()
+        self._reconcile(provider, model, slot)
+
+    @asynccontextmanager
+    async def aslot(self, provider: str, model: str, estimated_tokens: int = 0):
+        """异步调用的限流上下文"""
+        slot = RateLimitSlot(estimated_tokens)
+        start = time.perf_counter()
+        wait = self._reserve(provider, model, estimated_tokens)
+        limiter = self.concurrency(provider)
+        try:
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await limiter.acquire_async()
+        except BaseException:
+            # 排队时被取消（如对冲输掉）：退还预约的令牌
+            self._reconcile(provider, model, slot, failed=True)
+            raise
+        slot.wait_time = time.perf_counter() - start
+        try:
+            yield slot
+        except BaseException as e:
+            # 只有过载才收缩、只有成功才扩大窗口；取消、4xx、连接错误只归还名额
+            limiter.release(overloaded=is_overload_error(e), succeeded=False)
+            self._reconcile(provider, model, slot, failed=True)
+            raise
+        limiter.release()
+        self._reconcile(provider, model, slot)
+
+    def stats(self) -> Dict[str, Any]:
+        """各 provider 的并发窗口和各令牌桶余量"""
+        with self._lock:
+            concurrency = dict(self._concurrency)
+            buckets = dict(self._buckets)
+        return {
+            "concurrency": {name: limiter.stats() for name, limiter in concurrency.items()},
+            "buckets": {f"{scope}/{kind}": round(bucket.available(), 1)
+                        for (scope, kind), bucket in buckets.items()},
+        }
@@ -0,0 +1,250 @@
+"""
+重试与对冲请求 - 可重试错误分类、指数退避加抖动、单次调用截止时间，以及基于延迟分位数的对冲请求
+"""
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, TypeVar
+
+import openai
+
+T = TypeVar("T")
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+def is_retryable_error(error: BaseException) -> bool:
+    """判断错误是否值得重试：限流、超时、连接错误和服务端错误可以重试，参数/鉴权错误不重试"""
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError,
+                          asyncio.TimeoutError, TimeoutError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES or error.status_code >= 500
+    return False
+
+
+def _retry_after(error: BaseException) -> Optional[float]:
+    """读取 429/503 响应里的 Retry-After 秒数"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        value = response.headers.get("retry-after")
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+@dataclass
+class RetryPolicy:
+    """重试策略"""
+    max_attempts: int = 3
+    base_delay: float = 0.5
+    max_delay: float = 8.0
+    deadline: float = 200.0                  # 整次调用（含所有重试）的截止时间
+    attempt_timeout: Optional[float] = None  # 单次尝试的超时，None 表示只受 deadline 约束
+
+    def backoff(self, attempt: int, error: BaseException) -> float:
+        """第 attempt 次失败后的等待时间：full jitter 指数退避，服务端给出 Retry-After 时取较大值"""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+
+@dataclass
+class HedgePolicy:
+    """对冲策略：请求超过历史 p95 仍未返回时，再发一份，谁先返回用谁"""
+    enabled: bool = False
+    quantile: float = 0.95
+    min_delay: float = 2.0
+    min_samples: int = 20
+    fallback_models: Dict[str, str] = field(default_factory=dict)  # 对冲请求改发的模型，默认同模型
+
+
+class LatencyTracker:
+    """按模型记录最近的成功调用延迟"""
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._samples: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, model: str, latency: float) -> None:
+        with self._lock:
+            samples = self._samples.get(model)
+            if samples is None:
+                samples = self._samples[model] = deque(maxlen=self.window)
+            samples.append(latency)
+
+    def quantile(self, model: str, q: float, min_samples: int = 1) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples.get(model, ()))
+        if len(samples) < min_samples or not samples:
+            return None
+        index = min(len(samples) - 1, int(q * len(samples)))
+        return samples[index]
+
+
+class RetryExecutor:
+    """按策略执行上游调用
+
+    attempt 函数签名为 fn(model, timeout)，每次尝试传入本次可用的超时；
+    对冲请求时 model 可能是 fallback 模型。
+    """
+
+    def __init__(self, policy: Optional[RetryPolicy] = None, hedge: Optional[HedgePolicy] = None):
+        self.policy = policy or RetryPolicy()
+        self.hedge = hedge or HedgePolicy()
+        self.latency = LatencyTracker()
+        self._lock = threading.Lock()
+        self._stats = {
+            "calls": 0, "attempts": 0, "retries": 0, "successes": 0,
+            "fatal_errors": 0, "exhausted": 0,
+            "hedges_fired": 0, "hedge_wins": 0,
+        }
+
+    def _count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self._stats[name] += n
+
+    def _remaining(self, deadline_at: float) -> float:
+        """本次尝试可用的超时（不小于 0）"""
+        remaining = max(0.0, deadline_at - time.monotonic())
+        if self.policy.attempt_timeout is not None:
+            remaining = min(remaining, self.policy.attempt_timeout)
+        return remaining
+
+    def _attempt_timeout(self, deadline_at: float) -> float:
+        """本次尝试可用的超时；整次调用的截止时间已过时不再发起尝试，直接抛出 TimeoutError"""
+        remaining = self._remaining(deadline_at)
+        if remaining <= 0:
+            self._count("exhausted")
+            raise TimeoutError(f"LLM 调用超过截止时间（{self.policy.deadline}s）")
+        return remaining
+
+    def _should_retry(self, attempt: int, error: BaseException, deadline_at: float) -> Optional[float]:
+        """返回下次重试前的等待时间，不再重试时返回 None"""
+        if not is_retryable_error(error):
+            self._count("fatal_errors")
+            return None
+        delay = self.policy.backoff(attempt, error)
+        if attempt + 1 >= self.policy.max_attempts or time.monotonic() + delay >= deadline_at:
+            self._count("exhausted")
+            return None
+        self._count("retries")
+        return delay
+
+    def call(self, fn: Callable[[str, float], T], model: str, track_latency: bool = True) -> T:
+        """同步执行（只重试，不对冲）
+
+        track_latency=False 时不把耗时计入对冲用的延迟统计（如流式请求只包含建立连接的时间）。
+        """
+        self._count("calls")
+        deadline_at = time.monotonic() + self.policy.deadline
+        attempt = 0
+        while True:
+            timeout = self._attempt_timeout(deadline_at)
+            self._count("attempts")
+            start = time.monotonic()
+            try:
+                result = fn(model, timeout)
+            except Exception as e:
+                delay = self._should_retry(attempt, e, deadline_at)
+                if delay is None:
+                    raise
+                print(f"LLM 调用失败，{delay:.2f}s 后重试（第 {attempt + 1} 次）: {e}")
+                time.sleep(delay)
+                attempt += 1
+                continue
+            if track_latency:
+                self.latency.record(model, time.monotonic() - start)
+            self._count("successes")
+            return result
+
+    async def acall(self, fn: Callable[[str, float], Awaitable[T]], model: str, hedge: bool = True) -> T:
+        """异步执行；开启对冲且 hedge=True 时，每次尝试都可能对冲"""
+        self._count("calls")
+        deadline_at = time.monotonic() + self.policy.deadline
+        attempt = 0
+        while True:
+            timeout = self._attempt_timeout(deadline_at)
+            self._count("attempts")
+            try:
+                if hedge:
+                    result = await self._hedged(fn, model, timeout, deadline_at)
+                else:
+                    result = await fn(model, timeout)
+            except Exception as e:
+                delay = self._should_retry(attempt, e, deadline_at)
+                if delay is None:
+                    raise
+                print(f"LLM 调用失败，{delay:.2f}s 后重试（第 {attempt + 1} 次）: {e}")
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self._count("successes")
+            return result
+
+    def _hedge_delay(self, model: str) -> Optional[float]:
+        if not self.hedge.enabled:
+            return None
+        p = self.latency.quantile(model, self.hedge.quantile, self.hedge.min_samples)
+        if p is None:
+            return None
+        return max(self.hedge.min_delay, p)
+
+    async def _timed(self, fn: Callable[[str, float], Awaitable[T]], model: str, timeout: float) -> T:
+        start = time.monotonic()
+        result = await fn(model, timeout)
+        self.latency.record(model, time.monotonic() - start)
+        return result
+
+    async def _hedged(self, fn: Callable[[str, float], Awaitable[T]], model: str, timeout: float,
+                      deadline_at: float) -> T:
+        primary = asyncio.ensure_future(self._timed(fn, model, timeout))
+        delay = self._hedge_delay(model)
+        if delay is None:
+            return await primary
+
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return primary.result()
+            remaining = self._remaining(deadline_at)
+            if remaining <= 0:
+                # 截止时间已过，不再对冲，主请求会按自己的超时结束
+                return await primary
+
+            # 主请求超过 p95 仍未返回，发出对冲请求
+            hedge_model = self.hedge.fallback_models.get(model, model)
+            secondary = asyncio.ensure_future(self._timed(fn, hedge_model, remaining))
+            pending.add(secondary)
+            self._count("hedges_fired")
+
+            first_error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is secondary:
+                            self._count("hedge_wins")
+                        return task.result()
+                    if first_error is None or task is primary:
+                        first_error = task.exception()
+            raise first_error
+        finally:
+            # 取消输掉的请求
+            for task in pending:
+                task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+        stats["hedge_win_rate"] = stats["hedge_wins"] / stats["hedges_fired"] if stats["hedges_fired"] else 0.0
+        return stats
@@ -0,0 +1,268 @@
+"""
+多 provider 路由 - 按端点跟踪延迟/错误率的 EWMA，在等价模型间选择最健康的端点，并用熔断器隔离故障 provider
+"""
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Tuple
+
+from .retry import is_retryable_error
+
+
+class CircuitOpenError(RuntimeError):
+    """请求的模型及其等价模型所在 provider 全部熔断"""
+
+
+class CircuitBreaker:
+    """熔断器：closed -> open -> half_open -> closed
+
+    - closed: 正常放行；连续失败或错误率过高时打开
+    - open: 直接拒绝，open_seconds 后进入 half_open
+    - half_open: 只放行一个探测请求，成功则关闭，失败则重新打开
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, error_rate_threshold: float = 0.5,
+                 min_samples: int = 10, open_seconds: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.error_rate_threshold = error_rate_threshold
+        self.min_samples = min_samples
+        self.open_seconds = open_seconds
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.trips = 0
+
+    def available(self, now: float) -> bool:
+        """是否可以放行（不改变状态）"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return now - self.opened_at >= self.open_seconds
+        return not self.probe_in_flight
+
+    def on_dispatch(self, now: float) -> None:
+        """请求被路由到这里时调用；open 到期后转为 half_open 并占用探测名额"""
+        if self.state == self.OPEN and now - self.opened_at >= self.open_seconds:
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            self.probe_in_flight = True
+
+    def release_probe(self) -> None:
+        """探测请求没有得到可判断的结果（参数/鉴权错误、被取消、请求没有发出）时归还探测名额，保持当前状态"""
+        self.probe_in_flight = False
+
+    def on_success(self) -> None:
+        self.consecutive_failures = 0
+        self.probe_in_flight = False
+        self.state = self.CLOSED
+
+    def on_failure(self, now: float, error_rate: float, samples: int) -> None:
+        self.consecutive_failures += 1
+        self.probe_in_flight = False
+        if self.state == self.HALF_OPEN:
+            self._open(now)
+        elif self.state == self.CLOSED and (
+            self.consecutive_failures >= self.failure_threshold
+            or (samples >= self.min_samples and error_rate >= self.error_rate_threshold)
+        ):
+            self._open(now)
+
+    def _open(self, now: float) -> None:
+        self.state = self.OPEN
+        self.opened_at = now
+        self.trips += 1
+
+
+class EndpointHealth:
+    """单个端点（provider + 模型）的健康度"""
+
+    def __init__(self, alpha: float):
+        self.alpha = alpha
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.samples = 0
+        self.successes = 0
+        self.failures = 0
+        self.in_flight = 0
+
+    def record(self, latency: Optional[float], failed: bool) -> None:
+        self.samples += 1
+        if failed:
+            self.failures += 1
+        else:
+            self.successes += 1
+        self.error_rate += self.alpha * ((1.0 if failed else 0.0) - self.error_rate)
+        if latency is not None and not failed:
+            self.latency = latency if self.latency is None else self.latency + self.alpha * (latency - self.latency)
+
+
+class ProviderRouter:
+    """在等价模型之间选择端点
+
+    equivalents 为若干组可互相替换的模型名，例如
+    [["deepseek-v3", "deepseek/deepseek-chat"]]；组内模型可能属于不同 provider。
+    评分 = 延迟 EWMA * (1 + error_penalty * 错误率 EWMA)，越小越好；
+    请求的原模型有 preference 倍的优势，避免为微小差异来回切换。
+    """
+
+    def __init__(self, resolve_provider: Callable[[str], str],
+                 equivalents: Optional[Iterable[Iterable[str]]] = None,
+                 alpha: float = 0.2, error_penalty: float = 4.0, preference: float = 1.2,
+                 failure_threshold: int = 5, error_rate_threshold: float = 0.5,
+                 open_seconds: float = 30.0, decision_log_size: int = 200):
+        self.resolve_provider = resolve_provider
+        self.alpha = alpha
+        self.error_penalty = error_penalty
+        self.preference = preference
+        self.breaker_config = {
+            "failure_threshold": failure_threshold,
+            "error_rate_threshold": error_rate_threshold,
+            "open_seconds": open_seconds,
+        }
+        self._groups: Dict[str, List[str]] = {}
+        for group in equivalents or ():
+            group = list(group)
+            for model in group:
+                self._groups[model] = group
+        self._health: Dict[Tuple[str, str], EndpointHealth] = {}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._decisions: Deque[Dict[str, Any]] = deque(maxlen=decision_log_size)
+        self._lock = threading.Lock()
+
+    def candidates(self, model: str) -> List[str]:
+        """请求模型在前，其余等价模型在后"""
+        group = self._groups.get(model)
+        if not group:
+            return [model]
+        return [model] + [m for m in group if m != model]
+
+    def _endpoint(self, model: str) -> Tuple[str, str]:
+        return self.resolve_provider(model), model
+
+    def _health_locked(self, endpoint: Tuple[str, str]) -> EndpointHealth:
+        health = self._health.get(endpoint)
+        if health is None:
+            health = self._health[endpoint] = EndpointHealth(self.alpha)
+        return health
+
+    def _breaker_locked(self, provider: str) -> CircuitBreaker:
+        breaker = self._breakers.get(provider)
+        if breaker is None:
+            breaker = self._breakers[provider] = CircuitBreaker(**self.breaker_config)
+        return breaker
+
+    def _score(self, health: EndpointHealth, requested: bool) -> float:
+        # 新端点得 0 分，保证能被探测到；只失败过、从未成功的端点排在最后
+        if health.latency is None:
+            latency = float("inf") if health.failures else 0.0
+        else:
+            latency = health.latency
+        score = latency * (1.0 + self.error_penalty * health.error_rate)
+        return score / self.preference if requested else score
+
+    def choose(self, model: str, avoid: Iterable[str] = ()) -> str:
+        """为一次尝试选择实际调用的模型
+
+        avoid 为本次调用中已经失败过的模型，有其他可用端点时避开。
+        所有候选都熔断时抛出 CircuitOpenError，不再等待超时。
+        """
+        avoid = set(avoid)
+        now = time.monotonic()
+        with self._lock:
+            scored = []
+            skipped = []
+            for candidate in self.candidates(model):
+                endpoint = self._endpoint(candidate)
+                breaker = self._breaker_locked(endpoint[0])
+                if not breaker.available(now):
+                    skipped.append(f"{candidate}:{breaker.state}")
+                    continue
+                health = self._health_locked(endpoint)
+                scored.append((candidate in avoid, self._score(health, candidate == model), candidate, endpoint))
+
+            if not scored:
+                self._decisions.append({
+                    "time": time.time(), "requested": model, "chosen": None,
+                    "reason": "all_circuits_open", "skipped": skipped,
+                })
+                raise CircuitOpenError(f"所有可用端点均已熔断: {', '.join(skipped)}")
+
+            # 稳定排序：先避开本次失败过的，再按分数；同分时保持候选顺序（原模型优先）
+            scored.sort(key=lambda item: (item[0], item[1]))
+            _, score, chosen, endpoint = scored[0]
+            self._breaker_locked(endpoint[0]).on_dispatch(now)
+            self._health_locked(endpoint).in_flight += 1
+
+            if chosen == model:
+                reason = "requested"
+            elif model in avoid:
+                reason = "retry_failover"
+            elif skipped and any(s.startswith(f"{model}:") for s in skipped):
+                reason = "circuit_open"
+            else:
+                reason = "healthier"
+            self._decisions.append({
+                "time": time.time(), "requested": model, "chosen": chosen,
+                "provider": endpoint[0], "reason": reason, "score": round(score, 4),
+                "skipped": skipped,
+            })
+        return chosen
+
+    def record(self, model: str, latency: Optional[float], error: Optional[BaseException] = None) -> None:
+        """记录一次尝试的结果；latency 为 None 时只更新错误率（如流式请求）
+
+        只有可重试类错误（超时、限流、5xx、连接错误）计入端点健康度，参数/鉴权错误不影响路由。
+        """
+        failed = error is not None and is_retryable_error(error)
+        endpoint = self._endpoint(model)
+        now = time.monotonic()
+        with self._lock:
+            health = self._health_locked(endpoint)
+            health.in_flight = max(0, health.in_flight - 1)
+            breaker = self._breaker_locked(endpoint[0])
+            if error is not None and not failed:
+                breaker.release_probe()
+                return
+            health.record(latency, failed)
+            if failed:
+                breaker.on_failure(now, health.error_rate, health.samples)
+            else:
+                breaker.on_success()
+
+    def release(self, model: str) -> None:
+        """choose() 之后请求没有发出（建立客户端出错、排队等待限流时被取消等）：只归还并发计数和探测名额"""
+        endpoint = self._endpoint(model)
+        with self._lock:
+            health = self._health_locked(endpoint)
+            health.in_flight = max(0, health.in_flight - 1)
+            self._breaker_locked(endpoint[0]).release_probe()
+
+    def stats(self) -> Dict[str, Any]:
+        """各端点健康度、各 provider 熔断状态和最近的路由决策"""
+        with self._lock:
+            return {
+                "endpoints": {
+                    f"{provider}/{model}": {
+                        "latency_ewma": round(h.latency, 4) if h.latency is not None else None,
+                        "error_rate_ewma": round(h.error_rate, 4),
+                        "successes": h.successes,
+                        "failures": h.failures,
+                        "in_flight": h.in_flight,
+                    }
+                    for (provider, model), h in self._health.items()
+                },
+                "breakers": {
+                    provider: {
+                        "state": b.state,
+                        "consecutive_failures": b.consecutive_failures,
+                        "trips": b.trips,
+                    }
+                    for provider, b in self._breakers.items()
+                },
+                "decisions": list(self._decisions),
+            }
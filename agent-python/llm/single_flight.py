@@ -0,0 +1,178 @@
+"""
+请求合并（single-flight）- 同一时刻的相同请求只向上游发送一次，其余调用共享结果
+"""
+import asyncio
+import threading
+from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+
+class _FlightStats:
+    """合并统计（线程安全）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "coalesced": 0}
+
+    def count(self, coalesced: bool) -> None:
+        with self._lock:
+            self._stats["calls"] += 1
+            if coalesced:
+                self._stats["coalesced"] += 1
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats)
+
+
+class _Call:
+    """同步调用的共享结果"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """线程版 single-flight：多个线程同时发起相同请求时，只有第一个真正执行"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self._stats = _FlightStats()
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+        self._stats.count(coalesced=not leader)
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+    def stats(self) -> Dict[str, int]:
+        return self._stats.snapshot()
+
+
+class _Broadcast:
+    """一个进行中的上游流，后加入的订阅者先回放已收到的块再跟随新块"""
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.changed = asyncio.Event()
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def notify(self) -> None:
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+
+class AsyncSingleFlight:
+    """asyncio 版 single-flight，支持普通请求和流式请求
+
+    上游请求在独立任务里运行：发起者被取消不会影响其他等待者；
+    流式请求在所有订阅者都离开后才取消上游。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tasks: Dict[Tuple[int, str], asyncio.Task] = {}
+        self._streams: Dict[Tuple[int, str], _Broadcast] = {}
+        self._stats = _FlightStats()
+        self._stream_stats = _FlightStats()
+
+    async def do(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        loop = asyncio.get_running_loop()
+        flight_key = (id(loop), key)
+
+        with self._lock:
+            task = self._tasks.get(flight_key)
+            leader = task is None
+            if leader:
+                task = loop.create_task(factory())
+                self._tasks[flight_key] = task
+                task.add_done_callback(lambda t: self._finish_task(flight_key, t))
+        self._stats.count(coalesced=not leader)
+
+        return await asyncio.shield(task)
+
+    def _finish_task(self, flight_key: Tuple[int, str], task: asyncio.Task) -> None:
+        with self._lock:
+            if self._tasks.get(flight_key) is task:
+                del self._tasks[flight_key]
+        # 所有等待者都已取消时，避免 "exception was never retrieved" 警告
+        if not task.cancelled():
+            task.exception()
+
+    async def stream(self, key: str,
+                     factory: Callable[[], AsyncGenerator[str, None]]) -> AsyncGenerator[str, None]:
+        loop = asyncio.get_running_loop()
+        flight_key = (id(loop), key)
+
+        with self._lock:
+            broadcast = self._streams.get(flight_key)
+            leader = broadcast is None
+            if leader:
+                broadcast = _Broadcast()
+                self._streams[flight_key] = broadcast
+                broadcast.task = loop.create_task(self._produce(flight_key, broadcast, factory))
+            broadcast.subscribers += 1
+        self._stream_stats.count(coalesced=not leader)
+
+        index = 0
+        try:
+            while True:
+                while index < len(broadcast.chunks):
+                    yield broadcast.chunks[index]
+                    index += 1
+                if broadcast.done:
+                    if broadcast.error is not None:
+                        raise broadcast.error
+                    return
+                await broadcast.changed.wait()
+        finally:
+            broadcast.subscribers -= 1
+            if broadcast.subscribers == 0 and not broadcast.done:
+                broadcast.task.cancel()
+
+    async def _produce(self, flight_key: Tuple[int, str], broadcast: _Broadcast,
+                       factory: Callable[[], AsyncGenerator[str, None]]) -> None:
+        upstream = factory()
+        try:
+            async for chunk in upstream:
+                broadcast.chunks.append(chunk)
+                broadcast.notify()
+        except asyncio.CancelledError:
+            broadcast.error = asyncio.CancelledError()
+        except Exception as e:
+            broadcast.error = e
+        finally:
+            await upstream.aclose()
+            with self._lock:
+                if self._streams.get(flight_key) is broadcast:
+                    del self._streams[flight_key]
+            broadcast.done = True
+            broadcast.notify()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {"requests": self._stats.snapshot(), "streams": self._stream_stats.snapshot()}
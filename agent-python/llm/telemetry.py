@@ -0,0 +1,322 @@
+"""
+调用遥测 - 记录每次 LLM 调用的排队、首 token、总延迟和 token 用量，按会话/模型聚合，并输出到可插拔的 sink
+"""
+import bisect
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Any, Deque, Dict, List, Optional, Sequence
+
+# 秒级延迟分桶
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 64.0)
+# 输出速度分桶（tokens/s）
+TPS_BUCKETS = (5.0, 10.0, 20.0, 40.0, 80.0, 160.0, 320.0)
+
+_session_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("llm_session_id", default=None)
+
+
+def get_session_id() -> Optional[str]:
+    return _session_id.get()
+
+
+def set_session_id(session_id: Optional[str]) -> contextvars.Token:
+    """设置当前上下文（线程/协程）的会话 ID，之后的调用记录都归到该会话"""
+    return _session_id.set(session_id)
+
+
+@contextmanager
+def session(session_id: str):
+    """在 with 块内把调用记录归到 session_id"""
+    token = _session_id.set(session_id)
+    try:
+        yield
+    finally:
+        _session_id.reset(token)
+
+
+@dataclass
+class CallRecord:
+    """一次调用的遥测数据，时间单位为秒"""
+    model: str
+    stream: bool = False
+    provider: Optional[str] = None
+    session_id: Optional[str] = None
+    timestamp: float = field(default_factory=time.time)
+    cache_hit: bool = False
+    coalesced: bool = False  # 合并到进行中的相同请求上，用量记在领头调用上
+    queue_wait: Optional[float] = None
+    ttft: Optional[float] = None
+    latency: Optional[float] = None
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    cached_tokens: Optional[int] = None
+    output_tps: Optional[float] = None
+    error: Optional[str] = None
+    started: float = field(default_factory=time.perf_counter, repr=False)
+
+    def mark_first_token(self) -> None:
+        if self.ttft is None:
+            self.ttft = time.perf_counter() - self.started
+
+    def set_usage(self, usage: Any) -> None:
+        """从 OpenAI usage 对象读取 token 用量"""
+        if usage is None:
+            return
+        self.prompt_tokens = getattr(usage, "prompt_tokens", None)
+        self.completion_tokens = getattr(usage, "completion_tokens", None)
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = getattr(details, "cached_tokens", None) if details is not None else None
+        if cached is not None:
+            self.cached_tokens = cached
+
+    def finish(self, error: Optional[BaseException] = None) -> "CallRecord":
+        self.latency = time.perf_counter() - self.started
+        if error is not None:
+            self.error = type(error).__name__
+        if self.completion_tokens and not self.cache_hit:
+            # 流式调用按首 token 之后的生成时间计算输出速度
+            generation = self.latency - (self.ttft or 0.0)
+            if generation > 0:
+                self.output_tps = self.completion_tokens / generation
+        return self
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = asdict(self)
+        data.pop("started")
+        return data
+
+
+class Histogram:
+    """固定分桶直方图（累计计数与 Prometheus 一致）"""
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> Optional[float]:
+        """按分桶上界估算分位数"""
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= target:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "avg": round(self.sum / self.count, 4) if self.count else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+        }
+
+
+class _Aggregate:
+    """一组调用（某个模型或某个会话）的聚合指标"""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.ttft = Histogram(LATENCY_BUCKETS)
+        self.queue_wait = Histogram(LATENCY_BUCKETS)
+        self.output_tps = Histogram(TPS_BUCKETS)
+
+    def add(self, record: CallRecord) -> None:
+        self.calls += 1
+        if record.error:
+            self.errors += 1
+        if record.cache_hit:
+            self.cache_hits += 1
+        if record.coalesced:
+            self.coalesced += 1
+        self.prompt_tokens += record.prompt_tokens or 0
+        self.completion_tokens += record.completion_tokens or 0
+        self.cached_tokens += record.cached_tokens or 0
+        if record.latency is not None:
+            self.latency.observe(record.latency)
+        if record.ttft is not None:
+            self.ttft.observe(record.ttft)
+        if record.queue_wait is not None:
+            self.queue_wait.observe(record.queue_wait)
+        if record.output_tps is not None:
+            self.output_tps.observe(record.output_tps)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "cache_hits": self.cache_hits,
+            "coalesced": self.coalesced,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "cached_token_ratio": round(self.cached_tokens / self.prompt_tokens, 4) if self.prompt_tokens else 0.0,
+            "latency": self.latency.summary(),
+            "ttft": self.ttft.summary(),
+            "queue_wait": self.queue_wait.summary(),
+            "output_tps": self.output_tps.summary(),
+        }
+
+
+class TelemetrySink:
+    """sink 接口：每条调用记录完成后调用 emit"""
+
+    def emit(self, record: CallRecord) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class InMemorySink(TelemetrySink):
+    """保留最近 N 条记录，便于调试和测试"""
+
+    def __init__(self, maxlen: int = 1000):
+        self.records: Deque[CallRecord] = deque(maxlen=maxlen)
+
+    def emit(self, record: CallRecord) -> None:
+        self.records.append(record)
+
+
+class JsonlSink(TelemetrySink):
+    """每条记录追加一行 JSON"""
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def emit(self, record: CallRecord) -> None:
+        line = json.dumps(record.to_dict(), ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+class PrometheusSink(TelemetrySink):
+    """按模型聚合，render() 输出 Prometheus 文本格式，可挂到任意 /metrics 接口"""
+
+    def __init__(self, prefix: str = "llm"):
+        self.prefix = prefix
+        self._by_model: Dict[tuple, _Aggregate] = {}
+        self._lock = threading.Lock()
+
+    def emit(self, record: CallRecord) -> None:
+        key = (record.provider or "", record.model)
+        with self._lock:
+            agg = self._by_model.get(key)
+            if agg is None:
+                agg = self._by_model[key] = _Aggregate()
+            agg.add(record)
+
+    def render(self) -> str:
+        p = self.prefix
+        lines: List[str] = []
+        with self._lock:
+            items = sorted(self._by_model.items())
+            for name, help_text in (("calls_total", "LLM 调用次数"), ("errors_total", "失败次数"),
+                                    ("cache_hits_total", "响应缓存命中次数"),
+                                    ("coalesced_total", "合并到进行中相同请求上的次数"),
+                                    ("prompt_tokens_total", "输入 token 数"),
+                                    ("completion_tokens_total", "输出 token 数"),
+                                    ("cached_tokens_total", "命中提供方前缀缓存的输入 token 数")):
+                attr = name[:-len("_total")]
+                lines.append(f"# HELP {p}_{name} {help_text}")
+                lines.append(f"# TYPE {p}_{name} counter")
+                for (provider, model), agg in items:
+                    lines.append(f'{p}_{name}{{provider="{provider}",model="{model}"}} {getattr(agg, attr)}')
+            for name, attr in (("latency_seconds", "latency"), ("ttft_seconds", "ttft"),
+                               ("queue_wait_seconds", "queue_wait"), ("output_tokens_per_second", "output_tps")):
+                lines.append(f"# TYPE {p}_{name} histogram")
+                for (provider, model), agg in items:
+                    hist: Histogram = getattr(agg, attr)
+                    labels = f'provider="{provider}",model="{model}"'
+                    cumulative = 0
+                    for bound, count in zip(hist.buckets, hist.counts):
+                        cumulative += count
+                        lines.append(f'{p}_{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                    lines.append(f'{p}_{name}_bucket{{{labels},le="+Inf"}} {hist.count}')
+                    lines.append(f'{p}_{name}_sum{{{labels}}} {hist.sum}')
+                    lines.append(f'{p}_{name}_count{{{labels}}} {hist.count}')
+        return "\n".join(lines) + "\n"
+
+
+class Telemetry:
+    """调用遥测：按模型和会话聚合，并转发给各 sink"""
+
+    def __init__(self, sinks: Optional[List[TelemetrySink]] = None, max_sessions: int = 1000):
+        self.sinks: List[TelemetrySink] = list(sinks or [])
+        self.max_sessions = max_sessions
+        self._total = _Aggregate()
+        self._by_model: Dict[str, _Aggregate] = {}
+        self._by_session: Dict[str, _Aggregate] = {}
+        self._lock = threading.Lock()
+
+    def start(self, model: str, stream: bool = False) -> CallRecord:
+        return CallRecord(model=model, stream=stream, session_id=_session_id.get())
+
+    def record(self, record: CallRecord) -> None:
+        with self._lock:
+            self._total.add(record)
+            agg = self._by_model.get(record.model)
+            if agg is None:
+                agg = self._by_model[record.model] = _Aggregate()
+            agg.add(record)
+            if record.session_id is not None:
+                agg = self._by_session.get(record.session_id)
+                if agg is None:
+                    if len(self._by_session) >= self.max_sessions:
+                        # 丢弃最早的会话
+                        self._by_session.pop(next(iter(self._by_session)))
+                    agg = self._by_session[record.session_id] = _Aggregate()
+                agg.add(record)
+        for sink in self.sinks:
+            try:
+                sink.emit(record)
+            except Exception as e:
+                print(f"遥测输出失败: {e}")
+
+    def add_sink(self, sink: TelemetrySink) -> None:
+        self.sinks.append(sink)
+
+    def stats(self, session_id: Optional[str] = None) -> Dict[str, Any]:
+        with self._lock:
+            if session_id is not None:
+                agg = self._by_session.get(session_id)
+                return agg.summary() if agg is not None else {}
+            return {
+                "total": self._total.summary(),
+                "models": {model: agg.summary() for model, agg in self._by_model.items()},
+                "sessions": {sid: agg.summary() for sid, agg in self._by_session.items()},
+            }
+
+    def close(self) -> None:
+        for sink in self.sinks:
+            sink.close()
@@ -0,0 +1,63 @@
+"""
+测试路由熔断器的探测名额：half_open 的探测请求无论以什么结果结束，都要归还名额
+"""
+import asyncio
+import os
+import sys
+
+# 添加路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm.router import CircuitBreaker, ProviderRouter
+
+
+def _open_router() -> ProviderRouter:
+    """单个 provider、熔断后立即可探测的路由器，返回时已处于 open 状态"""
+    router = ProviderRouter(lambda model: "p", failure_threshold=1, open_seconds=0.0)
+    router.choose("m")
+    router.record("m", None, TimeoutError())
+    assert router.stats()["breakers"]["p"]["state"] == CircuitBreaker.OPEN
+    return router
+
+
+def _probe(router: ProviderRouter) -> None:
+    assert router.choose("m") == "m"
+    breaker = router._breakers["p"]
+    assert breaker.state == CircuitBreaker.HALF_OPEN and breaker.probe_in_flight
+
+
+def test_cancelled_probe_releases_slot():
+    """探测请求被取消（如对冲输掉）后 provider 仍可被选中，之后成功则关闭熔断"""
+    router = _open_router()
+    _probe(router)
+    router.record("m", None, asyncio.CancelledError())
+    assert not router._breakers["p"].probe_in_flight
+    assert router.choose("m") == "m"
+    router.record("m", 0.1)
+    assert router.stats()["breakers"]["p"]["state"] == CircuitBreaker.CLOSED
+    assert router.stats()["endpoints"]["p/m"]["in_flight"] == 0
+
+
+def test_non_retryable_probe_releases_slot():
+    """探测请求遇到参数/鉴权类错误：不计入健康度，但归还探测名额"""
+    router = _open_router()
+    _probe(router)
+    router.record("m", None, ValueError("bad request"))
+    assert router._breakers["p"].state == CircuitBreaker.HALF_OPEN
+    assert router.choose("m") == "m"
+
+
+def test_unsent_probe_releases_slot():
+    """choose() 之后请求没有发出（建立客户端出错）：release() 归还并发计数和探测名额"""
+    router = _open_router()
+    _probe(router)
+    router.release("m")
+    assert router.stats()["endpoints"]["p/m"]["in_flight"] == 0
+    assert router.choose("m") == "m"
+
+
+if __name__ == "__main__":
+    for test in (test_cancelled_probe_releases_slot, test_non_retryable_probe_releases_slot,
+                 test_unsent_probe_releases_slot):
+        test()
+        print(f"✅ {test.__name__}")
@@ -11,11 +11,29 @@ PersonaFlow Memory System - 仿生记忆模块
 """
 
 import asyncio
+import contextlib
+import contextvars
 import threading
-from typing import List, Any
+from typing import List, Any, Optional
 from .interface import MemorySystem
 from .config import MemoryConfig
 
+# 当前请求所属的用户（多会话服务时，工具在执行线程里据此读取对应用户的记忆）
+_current_user_id: contextvars.ContextVar[str] = contextvars.ContextVar("memory_user_id", default="default")
+
+def current_user_id() -> str:
+    """当前上下文的用户标识，未设置时为 default"""
+    return _current_user_id.get()
+
+@contextlib.contextmanager
+def user_scope(user_id: str):
+    """在此范围内 current_user_id() 返回 user_id"""
+    token = _current_user_id.set(user_id)
+    try:
+        yield
+    finally:
+        _current_user_id.reset(token)
+
 # 创建默认记忆系统实例
 _default_memory_system = None
 _background_loop = None
@@ -47,30 +65,32 @@ def _ensure_background_loop():
         while _background_loop is None:
             time.sleep(0.01)
 
-async def _async_update_memory(states: List[Any], user_id: str = "default", force_process: bool = False):
+async def _async_update_memory(states: List[Any], user_id: str = "default", force_process: bool = False,
+                               source_key: Optional[str] = None):
     """异步更新记忆"""
     try:
         print(f"后台协程: 开始处理 {len(states)} 个事件的记忆更新...")
         memory_system = get_memory_system()
-        memory_system.update_memory(states, user_id, force_process)
+        memory_system.update_memory(states, user_id, force_process, source_key)
         print("后台协程: 记忆更新完成")
     except Exception as e:
         print(f"后台协程: 记忆更新失败: {e}")
 
-def schedule_memory_update(states: List[Any], user_id: str = "default", force_process: bool = False):
-    """调度异步记忆更新"""
+def schedule_memory_update(states: List[Any], user_id: str = "default", force_process: bool = False,
+                           source_key: Optional[str] = None):
+    """调度异步记忆更新（source_key 为幂等键，同一批states只摘要一次）"""
     _ensure_background_loop()
     
     # 在后台事件循环中调度协程
     future = asyncio.run_coroutine_threadsafe(
-        _async_update_memory(states, user_id, force_process),
+        _async_update_memory(states, user_id, force_process, source_key),
         _background_loop
     )
     
     # 可以选择是否等待结果（这里不等待，实现真正的异步）
     return future
 
-def update_memory(states, user_id="default", force_process=False):
+def update_memory(states, user_id="default", force_process=False, source_key=None):
     """
     写入接口：处理新的states，更新记忆
     
@@ -78,9 +98,10 @@ def update_memory(states, user_id="default", force_process=False):
         states: 对话状态列表
         user_id: 用户标识
         force_process: 是否强制处理（忽略token阈值）
+        source_key: 幂等键，重复提交同一批states不会重复摘要
     """
     memory_system = get_memory_system()
-    return memory_system.update_memory(states, user_id, force_process)
+    return memory_system.update_memory(states, user_id, force_process, source_key)
 
 def get_relevant_memories(query, user_id="default"):
     """
@@ -96,6 +117,16 @@ def get_relevant_memories(query, user_id="default"):
     memory_system = get_memory_system()
     return memory_system.get_relevant_memories(query, user_id)
 
+def search_memories(query, user_id="default", top_k=3, min_score=0.0):
+    """
+    带分数的检索：返回相关度不低于 min_score 的前 top_k 条记忆
+    
+    Returns:
+        List[Dict]: {"content", "score", "source"}，按分数从高到低排列
+    """
+    memory_system = get_memory_system()
+    return memory_system.search_memories(query, user_id, top_k, min_score)
+
 def get_base_memory(user_id="default"):
     """
     获取基础记忆
@@ -103,6 +134,20 @@ def get_base_memory(user_id="default"):
     memory_system = get_memory_system()
     return memory_system.get_base_memory(user_id)
 
+def get_memory_version(user_id="default"):
+    """
+    获取用户记忆的版本号（记忆有任何写入都会变化，用于判断检索结果缓存是否失效）
+    """
+    memory_system = get_memory_system()
+    return memory_system.get_memory_version(user_id)
+
+def backfill_embeddings(user_id="default"):
+    """
+    为已有短期记忆批量补齐向量
+    """
+    memory_system = get_memory_system()
+    return memory_system.backfill_embeddings(user_id)
+
 def shutdown_background_loop():
     """关闭后台事件循环（用于清理资源）"""
     global _background_loop, _background_thread
@@ -117,7 +162,10 @@ __all__ = [
     'update_memory',           # 写入接口
     'schedule_memory_update',  # 异步调度接口
     'get_relevant_memories',   # 读取接口
+    'search_memories',         # 带分数的读取接口
     'get_base_memory',         # 获取基础记忆
+    'get_memory_version',      # 记忆版本号
+    'backfill_embeddings',     # 向量回填
     'MemoryConfig',           # 配置类（用于自定义配置）
     'shutdown_background_loop', # 清理接口
 ]
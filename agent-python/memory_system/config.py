@@ -2,6 +2,7 @@
 记忆系统配置
 """
 from dataclasses import dataclass
+from typing import Optional
 
 
 @dataclass
@@ -17,6 +18,7 @@ class MemoryConfig:
     
     # 容量限制
     SHORT_TERM_HOT_CACHE_SIZE: int = 5    # 短期记忆热缓存最多5条
+    PROCESSED_STATES_MAX_COUNT: int = 1000  # 记录最近处理过的states哈希，避免重复摘要
     
     
     # 检索参数
@@ -28,6 +30,9 @@ class MemoryConfig:
     KEYWORD_WEIGHT: float = 0.5           # 关键词检索权重
     VECTOR_WEIGHT: float = 0.5            # 向量检索权重
     
+    # 存储目录，为空时使用 storage 包所在目录
+    STORAGE_DIR: Optional[str] = None
+    
 
 
 # 默认配置实例
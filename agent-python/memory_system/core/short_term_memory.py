@@ -18,11 +18,20 @@ class ShortTermMemoryManager:
         self.store = store
         self.llm_adapter = llm_adapter
     
-    def process_states(self, states: List[Any], user_id: str, force_process: bool = False) -> Optional[MemoryItem]:
-        """处理states，生成短期记忆"""
+    def process_states(self, states: List[Any], user_id: str, force_process: bool = False,
+                       source_key: Optional[str] = None) -> Optional[MemoryItem]:
+        """处理states，生成短期记忆
+        
+        source_key 为这批states的幂等键（默认按内容哈希），同一批states只摘要一次
+        """
         if not states:
             return None
         
+        states_hash = source_key or self.store.hash_states(states)
+        if self.store.is_states_processed(user_id, states_hash):
+            print(f"states已处理过，跳过: {states_hash}")
+            return None
+        
         # 估算token数量
         token_count = self.llm_adapter.estimate_token_count(states)
         
@@ -42,7 +51,7 @@ class ShortTermMemoryManager:
         
         print(f"summary_content: {summary_content}")
         
-        # 创建短期记忆
+        # 创建短期记忆（写入时不请求向量，由 backfill_embeddings 批量回填）
         short_memory = MemoryItem(
             content=summary_content,
             timestamp=datetime.now(),
@@ -52,6 +61,7 @@ class ShortTermMemoryManager:
         
         # 保存到存储
         if self.store.save_short_term_memory(short_memory):
+            self.store.mark_states_processed(user_id, states_hash)
             print(f"短期记忆已保存: {short_memory.id}")
             print(f"摘要: {summary_content[:100]}...")
             return short_memory
@@ -1,7 +1,11 @@
 """
 记忆系统的干净外部接口
 """
-from typing import List, Any
+import math
+import re
+from collections import Counter
+from functools import lru_cache
+from typing import List, Any, Dict, Optional
 from datetime import datetime
 
 from .config import MemoryConfig, DEFAULT_CONFIG
@@ -12,6 +16,49 @@ from .core.long_term_memory import LongTermMemoryManager
 from .core.retrieval import MemoryRetriever
 from .Item import MemoryItem
 
+# 与 TfidfVectorizer 默认的 token_pattern 一致
+_TFIDF_TOKEN_PATTERN = re.compile(r"(?u)\b\w\w+\b")
+# 与 _calculate_keyword_score 中的 max_features 一致，特征更多时交给 sklearn 计算
+_TFIDF_MAX_FEATURES = 1000
+
+
+@lru_cache(maxsize=4096)
+def _preprocess_text(text: str) -> str:
+    """分词预处理：英文单词 + 中文分词（过滤单字），空格连接。记忆内容反复参与检索，结果缓存"""
+    import jieba
+    english_words = re.findall(r'[a-zA-Z]+', text.lower())
+    chinese_text = re.sub(r'[a-zA-Z0-9\s]+', '', text)
+    chinese_words = [word for word in jieba.cut(chinese_text) if len(word) > 1 and word.strip()]
+    return ' '.join(english_words + chinese_words)
+
+
+def _ngram_counts(processed: str) -> Counter:
+    """1-2gram 词频（与 TfidfVectorizer(ngram_range=(1, 2)) 的切分一致）"""
+    tokens = _TFIDF_TOKEN_PATTERN.findall(processed.lower())
+    counts = Counter(tokens)
+    counts.update(f"{a} {b}" for a, b in zip(tokens, tokens[1:]))
+    return counts
+
+
+def _pair_tfidf_cosine(query: Counter, content: Counter) -> Optional[float]:
+    """在 [query, content] 两篇文档上拟合 TF-IDF（平滑 idf、l2 归一化）后的余弦相似度
+
+    与逐对拟合 TfidfVectorizer 的结果相同，但不必每对都构造向量器；
+    词表为空或超过 max_features 时返回 None，由调用方走原来的计算方式。
+    """
+    vocabulary = query.keys() | content.keys()
+    if not vocabulary or len(vocabulary) > _TFIDF_MAX_FEATURES:
+        return None
+    # 两篇文档：都出现的词 idf = ln(3/3) + 1，只在一篇中出现的 idf = ln(3/2) + 1
+    idf_single = math.log(1.5) + 1.0
+    query_weights = {t: c * (1.0 if t in content else idf_single) for t, c in query.items()}
+    content_weights = {t: c * (1.0 if t in query else idf_single) for t, c in content.items()}
+    dot = sum(w * content_weights[t] for t, w in query_weights.items() if t in content_weights)
+    if dot == 0.0:
+        return 0.0
+    norm = math.sqrt(sum(w * w for w in query_weights.values())) * math.sqrt(sum(w * w for w in content_weights.values()))
+    return dot / norm
+
 
 class MemorySystem:
     """记忆系统主接口"""
@@ -37,46 +84,85 @@ class MemorySystem:
             return ""
         
         try:
-            candidates = []
-            
-            # 1. 从短期记忆中检索
-            short_memories = self.short_term_mgr.get_recent_memories(user_id, limit=20)
-            
-            for memory in short_memories:
-                score = self._calculate_keyword_score(user_input, memory.content)
-                if score > 0:
-                    candidates.append((score, memory.content, "短期记忆"))
-            
-            # 2. 从长期记忆的Dynamic部分检索
-            dynamic_model = self.long_term_mgr.get_dynamic_model(user_id)
-            
-            if dynamic_model.strip():
-                # 按照两个换行符分割Dynamic部分
-                dynamic_sections = [section.strip() for section in dynamic_model.split('\n\n') if section.strip()]
-                
-                for section in dynamic_sections:
-                    score = self._calculate_keyword_score(user_input, section)
-                    if score > 0:
-                        candidates.append((score, section, "长期记忆Dynamic"))
-            
-            # 3. 按分数排序，取前3个
-            if not candidates:
+            top_3 = self.search_memories(user_input, user_id, top_k=3)
+            if not top_3:
                 return ""
             
-            candidates.sort(key=lambda x: x[0], reverse=True)
-            top_3 = candidates[:3]
-            
-            # 4. 格式化返回结果
-            memory_strings = []
-            for score, content, source in top_3:
-                memory_strings.append(content)
-            
-            return str(memory_strings)
+            # 格式化返回结果
+            return str([memory["content"] for memory in top_3])
             
         except Exception as e:
             print(f"记忆检索失败: {e}")
             return ""
     
+    def search_memories(self, query: str, user_id: str = "default", top_k: int = 3,
+                        min_score: float = 0.0) -> List[Dict[str, Any]]:
+        """
+        带分数的检索：从短期记忆和长期记忆Dynamic部分检索，
+        返回分数大于 0 且不低于 min_score 的前 top_k 条，按分数从高到低排列
+        
+        Returns:
+            List[Dict]: 每条为 {"content": 内容, "score": 相关度, "source": "短期记忆" / "长期记忆Dynamic"}
+        """
+        if not query.strip():
+            return []
+        
+        # 1. 短期记忆
+        sources = [(memory.content, "短期记忆") for memory in self.short_term_mgr.get_recent_memories(user_id, limit=20)]
+        
+        # 2. 长期记忆的Dynamic部分，按照两个换行符分割
+        dynamic_model = self.long_term_mgr.get_dynamic_model(user_id)
+        if dynamic_model.strip():
+            sources.extend((section.strip(), "长期记忆Dynamic")
+                           for section in dynamic_model.split('\n\n') if section.strip())
+        
+        # 3. 评分、过滤、排序
+        scores = self._keyword_scores(query, [content for content, _ in sources])
+        candidates = [
+            {"content": content, "score": float(score), "source": source}
+            for (content, source), score in zip(sources, scores)
+            if score > 0 and score >= min_score
+        ]
+        candidates.sort(key=lambda c: c["score"], reverse=True)
+        return candidates[:top_k]
+    
+    def _keyword_scores(self, query: str, contents: List[str]) -> List[float]:
+        """批量计算关键词匹配评分，结果与逐条调用 _calculate_keyword_score 相同
+        
+        查询只分词一次，记忆内容的分词结果有缓存，TF-IDF 余弦直接计算，不再为每条记忆构造向量器。
+        """
+        try:
+            import jieba  # noqa: F401
+            import sklearn  # noqa: F401
+        except ImportError:
+            return [self._simple_keyword_score(query, content) for content in contents]
+        
+        try:
+            processed_query = _preprocess_text(query)
+        except Exception:
+            return [self._calculate_keyword_score(query, content) for content in contents]
+        query_counts = _ngram_counts(processed_query) if processed_query.strip() else None
+        
+        scores = []
+        for content in contents:
+            score = None
+            if query_counts is not None:
+                try:
+                    processed_content = _preprocess_text(content)
+                    if not processed_content.strip():
+                        score = 0.0
+                    else:
+                        score = _pair_tfidf_cosine(query_counts, _ngram_counts(processed_content))
+                except Exception:
+                    score = None
+            else:
+                score = 0.0
+            if score is None:
+                # 词表为空或特征过多等少见情况，沿用原来的计算方式
+                score = self._calculate_keyword_score(query, content)
+            scores.append(max(0.0, score))
+        return scores
+    
     def _calculate_keyword_score(self, query: str, content: str) -> float:
         """计算关键词匹配评分 - 使用TF-IDF"""
         try:
@@ -183,7 +269,8 @@ class MemorySystem:
         
         return score + phrase_bonus
     
-    def update_memory(self, states: List[Any], user_id: str = "default", force_process: bool = False):
+    def update_memory(self, states: List[Any], user_id: str = "default", force_process: bool = False,
+                      source_key: Optional[str] = None):
         """
         写入接口：处理新的states，更新记忆
         启动短期记忆存储与长期记忆晋升判断
@@ -192,13 +279,14 @@ class MemorySystem:
             states: 对话状态列表
             user_id: 用户标识
             force_process: 是否强制处理（忽略token阈值）
+            source_key: 这批states的幂等键，重复提交同一批states不会重复摘要
         """
         if not states:
             return
         
         try:
             # 1. 处理states，生成短期记忆摘要
-            short_memory = self.short_term_mgr.process_states(states, user_id, force_process)
+            short_memory = self.short_term_mgr.process_states(states, user_id, force_process, source_key)
             
             if short_memory:
                 # 2. 检查是否需要认知重构
@@ -253,8 +341,30 @@ class MemorySystem:
         return "\n\n".join(combined_parts) 
 
 
+    def backfill_embeddings(self, user_id: str = "default") -> int:
+        """为缺少向量的短期记忆批量补齐向量，返回补齐条数"""
+        missing = [m for m in self.store.get_short_term_memories(user_id) if not m.embedding]
+        if not missing:
+            return 0
+        
+        vectors = self.llm_adapter.get_text_embeddings([m.content for m in missing])
+        if len(vectors) != len(missing):
+            return 0
+        
+        updated = self.store.update_short_term_embeddings(
+            user_id, {m.id: v for m, v in zip(missing, vectors)}
+        )
+        print(f"用户 {user_id} 回填向量: {updated} 条")
+        return updated
+
     def get_base_memory(self, user_id: str = "default") -> str:
         """
         获取基础记忆
         """
-        return self.store.get_base_memory(user_id)
\ No newline at end of file
+        return self.store.get_base_memory(user_id)
+    
+    def get_memory_version(self, user_id: str = "default") -> int:
+        """
+        用户记忆的版本号，记忆有任何写入都会变化
+        """
+        return self.store.version(user_id)
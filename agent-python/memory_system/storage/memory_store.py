@@ -4,7 +4,8 @@
 import os
 import json
 import hashlib
-from typing import List, Optional, Any
+import threading
+from typing import Dict, List, Optional, Any
 from datetime import datetime
 
 from ..Item import MemoryItem
@@ -16,9 +17,20 @@ class MemoryStore:
     
     def __init__(self, config: MemoryConfig):
         self.config = config
-        # 直接使用当前文件所在目录作为存储目录
-        self.storage_dir = os.path.dirname(os.path.abspath(__file__))
+        # 默认使用当前文件所在目录作为存储目录
+        self.storage_dir = config.STORAGE_DIR or os.path.dirname(os.path.abspath(__file__))
         os.makedirs(self.storage_dir, exist_ok=True)
+        # 每个用户的记忆版本号，任何写入都会递增（供检索结果缓存判断是否失效）
+        self._versions: Dict[str, int] = {}
+        self._versions_lock = threading.Lock()
+    
+    def version(self, user_id: str) -> int:
+        """用户记忆的当前版本号（进程内单调递增）"""
+        return self._versions.get(user_id, 0)
+    
+    def _bump_version(self, user_id: str) -> None:
+        with self._versions_lock:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
     
     def save_short_term_memory(self, memory: MemoryItem) -> bool:
         """保存短期记忆到JSON文件"""
@@ -38,11 +50,14 @@ class MemoryStore:
                 "timestamp": memory.timestamp.isoformat(),
                 "hp": memory.hp
             }
+            if memory.embedding:
+                memory_dict["embedding"] = memory.embedding
             memories.append(memory_dict)
             
             # 保存回文件
             with open(file_path, 'w', encoding='utf-8') as f:
                 json.dump(memories, f, ensure_ascii=False, indent=2)
+            self._bump_version(memory.user_id)
             
             return True
             
@@ -68,6 +83,7 @@ class MemoryStore:
                     content=data["content"],
                     timestamp=datetime.fromisoformat(data["timestamp"]),
                     hp=data["hp"],
+                    embedding=data.get("embedding", []),
                     user_id=user_id
                 )
                 memories.append(memory)
@@ -96,6 +112,7 @@ class MemoryStore:
             
             with open(file_path, 'w', encoding='utf-8') as f:
                 json.dump(memories, f, ensure_ascii=False, indent=2)
+            self._bump_version(user_id)
             
             return True
             
@@ -103,6 +120,34 @@ class MemoryStore:
             print(f"删除短期记忆失败: {e}")
             return False
     
+    def update_short_term_embeddings(self, user_id: str, embeddings: Dict[str, List[float]]) -> int:
+        """按记忆ID写入向量，返回更新条数"""
+        try:
+            file_path = os.path.join(self.storage_dir, f"short_term_{user_id}.json")
+            
+            if not os.path.exists(file_path) or not embeddings:
+                return 0
+            
+            with open(file_path, 'r', encoding='utf-8') as f:
+                memories = json.load(f)
+            
+            updated = 0
+            for m in memories:
+                vector = embeddings.get(m["id"])
+                if vector:
+                    m["embedding"] = vector
+                    updated += 1
+            
+            with open(file_path, 'w', encoding='utf-8') as f:
+                json.dump(memories, f, ensure_ascii=False, indent=2)
+            self._bump_version(user_id)
+            
+            return updated
+            
+        except Exception as e:
+            print(f"更新短期记忆向量失败: {e}")
+            return 0
+    
     def save_long_term_memory(self, user_id: str, cognitive_model: str) -> bool:
         """保存长期记忆认知模型"""
         try:
@@ -110,6 +155,7 @@ class MemoryStore:
             
             with open(file_path, 'w', encoding='utf-8') as f:
                 f.write(cognitive_model)
+            self._bump_version(user_id)
             
             return True
             
@@ -186,6 +232,37 @@ class MemoryStore:
         memories.sort(key=lambda x: x.timestamp)
         return memories[0]
     
+    def is_states_processed(self, user_id: str, states_hash: str) -> bool:
+        """这批states是否已生成过短期记忆"""
+        return states_hash in self._load_processed(user_id)
+    
+    def mark_states_processed(self, user_id: str, states_hash: str) -> None:
+        """记录已处理的states哈希（只保留最近的 PROCESSED_STATES_MAX_COUNT 条）"""
+        try:
+            processed = self._load_processed(user_id)
+            if states_hash in processed:
+                return
+            processed.append(states_hash)
+            processed = processed[-self.config.PROCESSED_STATES_MAX_COUNT:]
+            with open(self._processed_path(user_id), 'w', encoding='utf-8') as f:
+                json.dump(processed, f)
+        except Exception as e:
+            print(f"记录已处理states失败: {e}")
+    
+    def _processed_path(self, user_id: str) -> str:
+        return os.path.join(self.storage_dir, f"processed_states_{user_id}.json")
+    
+    def _load_processed(self, user_id: str) -> List[str]:
+        try:
+            file_path = self._processed_path(user_id)
+            if not os.path.exists(file_path):
+                return []
+            with open(file_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"读取已处理states失败: {e}")
+            return []
+    
     @staticmethod
     def hash_states(states: List[Any]) -> str:
         """生成states的哈希值"""
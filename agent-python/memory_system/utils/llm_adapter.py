@@ -6,15 +6,21 @@ import os
 from typing import List, Any
 from datetime import datetime
 
-from llm.llm_client import get_embedding, llm_call
+from llm.llm_client import get_embedding, get_embeddings, llm_call
 
 
 class LLMAdapter:
     """LLM适配器"""
     
     def __init__(self, llm_client=None):
+        # 可注入 AIChat 实例（如指向本地替身服务），为空时使用全局 llm_call
         self.llm_client = llm_client
     
+    def _llm_call(self, message, model: str) -> str:
+        if self.llm_client is not None:
+            return self.llm_client.chat(message, model=model)
+        return llm_call(message, model=model)
+    
     def get_text_embedding(self, text: str) -> List[float]:
         """获取文本的向量表示"""
         try:
@@ -23,12 +29,22 @@ class LLMAdapter:
             print(f"获取向量失败: {e}")
             return []
     
+    def get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """批量获取文本向量，失败时返回空列表"""
+        if not texts:
+            return []
+        try:
+            return get_embeddings(texts)
+        except Exception as e:
+            print(f"批量获取向量失败: {e}")
+            return []
+    
     def summarize_states(self, states: List[Any]) -> str:
         """将states压缩成摘要"""
         try:
             prompt = self._build_summarize_prompt(states)
             print(f"发送摘要请求到LLM...")
-            response = llm_call(prompt, model="google/gemini-2.5-flash")
+            response = self._llm_call(prompt, model="google/gemini-2.5-flash")
             print(f"LLM摘要响应: {response}")
             return response
             
@@ -48,7 +64,7 @@ class LLMAdapter:
             ]
             
             print(f"发送认知重构请求到LLM...")
-            response = llm_call(messages, model="google/gemini-2.5-flash")
+            response = self._llm_call(messages, model="google/gemini-2.5-flash")
             print(f"LLM认知重构响应长度: {len(response)} 字符")
             return response
             
@@ -0,0 +1,358 @@
+"""
+服务模式 - 本地 HTTP / WebSocket 接口，由 SessionManager 承载多个会话（只用标准库 asyncio）
+
+接口：
+    POST   /v1/sessions                       {"user_id"?, "session_id"?} -> {"session_id", "user_id"}
+    GET    /v1/sessions/{id}                  会话信息
+    DELETE /v1/sessions/{id}                  删除会话及其磁盘数据
+    POST   /v1/sessions/{id}/messages         {"message", "user_id"?} -> {"session_id", "reply", "latency"}
+    GET    /v1/sessions/{id}/ws               WebSocket：客户端发送 {"message"}，服务端逐 token 推送
+                                              {"type": "token", "text"}，结束时推送 {"type": "done", "reply", "latency"}
+    GET    /v1/stats                          会话数、准入、p50/p99 延迟
+
+不提供 user_id（WebSocket 上为 X-User-Id 头）时按 "default" 用户处理，访问其他用户的会话返回 403。
+超出准入上限时返回 429 和 Retry-After（WebSocket 上推送 {"type": "busy", "retry_after"}）。
+
+用法：
+    python server.py --port 8080 --storage-dir ./sessions
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import struct
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+from core.session import (ServerBusyError, SessionConfig, SessionExistsError, SessionManager,
+                          SessionNotFoundError)
+
+MAX_HEADER_BYTES = 64 * 1024
+MAX_BODY_BYTES = 1024 * 1024
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+_STATUS_TEXT = {200: "OK", 201: "Created", 204: "No Content", 400: "Bad Request", 403: "Forbidden",
+                404: "Not Found", 405: "Method Not Allowed", 409: "Conflict", 413: "Payload Too Large",
+                429: "Too Many Requests", 500: "Internal Server Error"}
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str, headers: Optional[Dict[str, str]] = None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+
+class Request:
+    def __init__(self, method: str, path: str, headers: Dict[str, str], body: bytes):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+
+    def json(self) -> Dict[str, Any]:
+        if not self.body:
+            return {}
+        try:
+            data = json.loads(self.body)
+        except ValueError:
+            raise HttpError(400, "请求体不是合法的 JSON")
+        if not isinstance(data, dict):
+            raise HttpError(400, "请求体必须是 JSON 对象")
+        return data
+
+    @property
+    def keep_alive(self) -> bool:
+        return self.headers.get("connection", "").lower() != "close"
+
+
+async def read_request(reader: asyncio.StreamReader) -> Optional[Request]:
+    """读取一个 HTTP/1.1 请求，连接关闭时返回 None"""
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError:
+        return None
+    except asyncio.LimitOverrunError:
+        raise HttpError(413, "请求头过大")
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, target, _ = lines[0].split(" ", 2)
+    except ValueError:
+        raise HttpError(400, "请求行格式错误")
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get("content-length", "0") or 0)
+    except ValueError:
+        raise HttpError(400, "Content-Length 格式错误")
+    if length < 0:
+        raise HttpError(400, "Content-Length 格式错误")
+    if length > MAX_BODY_BYTES:
+        raise HttpError(413, "请求体过大")
+    body = await reader.readexactly(length) if length else b""
+    return Request(method.upper(), urlsplit(target).path, headers, body)
+
+
+def write_response(writer: asyncio.StreamWriter, status: int, payload: Any = None,
+                   headers: Optional[Dict[str, str]] = None, keep_alive: bool = True) -> None:
+    body = b"" if payload is None else json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    lines = [f"HTTP/1.1 {status} {_STATUS_TEXT.get(status, '')}",
+             f"Content-Length: {len(body)}",
+             f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+    if body:
+        lines.append("Content-Type: application/json; charset=utf-8")
+    for name, value in (headers or {}).items():
+        lines.append(f"{name}: {value}")
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+
+
+# ---------- WebSocket（RFC 6455，只实现服务端需要的部分） ----------
+
+def ws_accept_key(key: str) -> str:
+    return base64.b64encode(hashlib.sha1((key + WS_GUID).encode("ascii")).digest()).decode("ascii")
+
+
+def ws_frame(opcode: int, payload: bytes) -> bytes:
+    """服务端发出的帧不加掩码"""
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 1 << 16:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+
+async def ws_read_message(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> Optional[str]:
+    """读取一条完整的文本消息（合并分片、自动回复 ping），对端关闭时返回 None"""
+    fragments = []
+    while True:
+        try:
+            first, second = await reader.readexactly(2)
+        except asyncio.IncompleteReadError:
+            return None
+        fin, opcode = first & 0x80, first & 0x0F
+        length = second & 0x7F
+        if length == 126:
+            length = struct.unpack("!H", await reader.readexactly(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", await reader.readexactly(8))[0]
+        if length > MAX_BODY_BYTES:
+            writer.write(ws_frame(0x8, struct.pack("!H", 1009)))
+            return None
+        mask = await reader.readexactly(4) if second & 0x80 else None
+        payload = await reader.readexactly(length)
+        if mask is not None:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        if opcode == 0x8:  # close
+            writer.write(ws_frame(0x8, payload[:2]))
+            return None
+        if opcode == 0x9:  # ping
+            writer.write(ws_frame(0xA, payload))
+            continue
+        if opcode == 0xA:  # pong
+            continue
+        fragments.append(payload)
+        if fin:
+            return b"".join(fragments).decode("utf-8", errors="replace")
+
+
+class AgentServer:
+    """把 HTTP / WebSocket 请求转给 SessionManager"""
+
+    def __init__(self, manager: SessionManager, host: str = "127.0.0.1", port: int = 8080):
+        self.manager = manager
+        self.host = host
+        self.port = port
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        await self.manager.start()
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port,
+                                                  limit=MAX_HEADER_BYTES, backlog=1024)
+        self.port = self._server.sockets[0].getsockname()[1]
+        print(f"Agent 服务已启动: http://{self.host}:{self.port}")
+
+    async def serve_forever(self) -> None:
+        await self.start()
+        try:
+            async with self._server:
+                await self._server.serve_forever()
+        finally:
+            await self.manager.close()
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        await self.manager.close()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                    if request is None:
+                        break
+                    if request.headers.get("upgrade", "").lower() == "websocket":
+                        await self._handle_websocket(request, reader, writer)
+                        break
+                    status, payload, headers = await self._dispatch(request)
+                except HttpError as e:
+                    status, payload, headers = e.status, {"error": str(e)}, e.headers
+                    request = None
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    raise
+                except Exception as e:
+                    # 未预期的错误（如日志、Agent 创建失败）：返回 500 并关闭连接，不让异常逃出连接任务
+                    print(f"处理请求出错: {e!r}")
+                    status, payload, headers = 500, {"error": "服务器内部错误"}, {}
+                    request = None
+                keep_alive = request is not None and request.keep_alive
+                write_response(writer, status, payload, headers, keep_alive)
+                await writer.drain()  # 客户端读得慢时在这里等待，不在内存里堆积响应
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    @staticmethod
+    def _route(path: str) -> Tuple[Optional[str], Optional[str]]:
+        """返回 (session_id, 子资源)；不匹配会话路由时 session_id 为 None"""
+        parts = [p for p in path.split("/") if p]
+        if len(parts) < 3 or parts[:2] != ["v1", "sessions"]:
+            return None, None
+        return parts[2], "/".join(parts[3:]) or None
+
+    async def _dispatch(self, request: Request) -> Tuple[int, Any, Dict[str, str]]:
+        try:
+            if request.path == "/v1/stats" and request.method == "GET":
+                return 200, self.manager.get_stats(), {}
+            if request.path == "/v1/sessions" and request.method == "POST":
+                body = request.json()
+                session = await self.manager.create(str(body.get("user_id") or "default"), body.get("session_id"))
+                return 201, {"session_id": session.session_id, "user_id": session.user_id}, {}
+            session_id, sub = self._route(request.path)
+            if session_id is None:
+                raise HttpError(404, f"未知路径: {request.path}")
+            if sub is None and request.method == "GET":
+                return 200, await self.manager.info(session_id), {}
+            if sub is None and request.method == "DELETE":
+                await self.manager.delete(session_id)
+                return 204, None, {}
+            if sub == "messages" and request.method == "POST":
+                body = request.json()
+                message = body.get("message")
+                if not isinstance(message, str) or not message.strip():
+                    raise HttpError(400, "缺少 message")
+                return 200, await self.manager.send(session_id, message, body.get("user_id")), {}
+            raise HttpError(405, f"不支持 {request.method} {request.path}")
+        except ServerBusyError as e:
+            raise HttpError(429, str(e), {"Retry-After": str(max(1, round(e.retry_after)))})
+        except SessionNotFoundError as e:
+            raise HttpError(404, f"会话不存在: {e.args[0]}")
+        except PermissionError as e:
+            raise HttpError(403, str(e))
+        except SessionExistsError as e:
+            raise HttpError(409, str(e))
+        except ValueError as e:
+            raise HttpError(400, str(e))
+
+    async def _handle_websocket(self, request: Request, reader: asyncio.StreamReader,
+                                writer: asyncio.StreamWriter) -> None:
+        session_id, sub = self._route(request.path)
+        key = request.headers.get("sec-websocket-key")
+        if session_id is None or sub != "ws" or not key:
+            raise HttpError(400, "WebSocket 路径应为 /v1/sessions/{id}/ws")
+        user_id = request.headers.get("x-user-id")
+        writer.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      f"Sec-WebSocket-Accept: {ws_accept_key(key)}\r\n\r\n").encode("latin-1"))
+        await writer.drain()
+
+        async def send(payload: Dict[str, Any]) -> None:
+            writer.write(ws_frame(0x1, json.dumps(payload, ensure_ascii=False).encode("utf-8")))
+            await writer.drain()
+
+        while True:
+            text = await ws_read_message(reader, writer)
+            if text is None:
+                break
+            try:
+                message = json.loads(text).get("message")
+            except (ValueError, AttributeError):
+                message = None
+            if not isinstance(message, str) or not message.strip():
+                await send({"type": "error", "error": "缺少 message"})
+                continue
+
+            # token 先进队列，由单独的任务按客户端的接收速度写出（drain 提供背压）
+            tokens: asyncio.Queue = asyncio.Queue()
+
+            async def pump() -> None:
+                while True:
+                    token = await tokens.get()
+                    if token is None:
+                        return
+                    await send({"type": "token", "text": token})
+
+            pumping = asyncio.create_task(pump())
+            try:
+                result = await self.manager.send(session_id, message, user_id, on_token=tokens.put_nowait)
+            except ServerBusyError as e:
+                result = {"type": "busy", "error": str(e), "retry_after": e.retry_after}
+            except (SessionNotFoundError, PermissionError, ValueError) as e:
+                result = {"type": "error", "error": str(e)}
+            except (ConnectionError, asyncio.IncompleteReadError):
+                raise
+            except Exception as e:
+                print(f"处理 WebSocket 消息出错: {e!r}")
+                result = {"type": "error", "error": "服务器内部错误"}
+            else:
+                result = {"type": "done", **result}
+            finally:
+                tokens.put_nowait(None)
+                await pumping
+            await send(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Agent 服务模式（HTTP / WebSocket）")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--storage-dir", default=SessionConfig.storage_dir, help="会话日志和快照目录")
+    parser.add_argument("--max-resident", type=int, default=SessionConfig.max_resident_sessions)
+    parser.add_argument("--idle-timeout", type=float, default=SessionConfig.idle_timeout)
+    parser.add_argument("--max-active", type=int, default=SessionConfig.max_active_turns)
+    parser.add_argument("--max-waiting", type=int, default=SessionConfig.max_waiting_turns)
+    parser.add_argument("--max-context-length", type=int, default=SessionConfig.max_context_length)
+    parser.add_argument("--no-fsync", action="store_true")
+    args = parser.parse_args()
+
+    config = SessionConfig(storage_dir=os.path.abspath(args.storage_dir),
+                           max_resident_sessions=args.max_resident,
+                           idle_timeout=args.idle_timeout,
+                           max_active_turns=args.max_active,
+                           max_waiting_turns=args.max_waiting,
+                           max_context_length=args.max_context_length,
+                           fsync=not args.no_fsync)
+    server = AgentServer(SessionManager(config), args.host, args.port)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        print("\n服务已停止")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,9 @@ Tools 模块 - 提供简单统一的工具调用接口
 """
 
 from .registry import ToolRegistry
+from .cache import get_tool_cache, get_tool_cache_stats
 from .tool_list import get_all_tools
+from .stream_parser import StreamingFunctionCallParser
 
 # 全局工具注册表
 _registry = None
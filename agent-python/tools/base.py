@@ -2,6 +2,7 @@
 工具基类定义
 """
 
+import asyncio
 from abc import ABC, abstractmethod
 from typing import Dict, Any, List, Optional
 from dataclasses import dataclass
@@ -17,7 +18,22 @@ class ParameterSchema:
     default: Optional[Any] = None
 
 class BaseTool(ABC):
-    """工具基类"""
+    """工具基类
+    
+    实现 execute（同步，在共享线程池中执行）或 aexecute（异步，在事件循环上执行）之一即可。
+    
+    执行策略（子类按需覆盖类属性）：
+    - parallel_safe: 能否与同一批的其他调用并发执行；为 False 时等前面的调用全部完成后单独执行
+    - timeout: 单次调用的超时秒数，None 表示不限
+    - max_concurrency: 全进程同时执行该工具的上限，None 表示不限
+    - cacheable: 结果只取决于参数和 cache_version() 时设为 True，成功的结果在 cache_ttl 秒内复用（所有会话共享）
+    """
+    
+    parallel_safe: bool = True
+    timeout: Optional[float] = 60.0
+    max_concurrency: Optional[int] = None
+    cacheable: bool = False
+    cache_ttl: Optional[float] = 300.0
     
     @abstractmethod
     def get_name(self) -> str:
@@ -34,7 +50,6 @@ class BaseTool(ABC):
         """获取参数定义"""
         pass
     
-    @abstractmethod
     def execute(self, parameters: Dict[str, Any]) -> Dict[str, Any]:
         """执行工具
         
@@ -44,7 +59,26 @@ class BaseTool(ABC):
         Returns:
             执行结果字典
         """
-        pass
+        if self.is_async:
+            # 只实现了 aexecute 的工具在同步调用时用独立的事件循环执行
+            return asyncio.run(self.aexecute(parameters))
+        raise NotImplementedError(f"工具 {self.get_name()} 需要实现 execute 或 aexecute")
+    
+    async def aexecute(self, parameters: Dict[str, Any]) -> Dict[str, Any]:
+        """异步执行工具（可选），参数和返回值与 execute 相同"""
+        raise NotImplementedError
+    
+    @property
+    def is_async(self) -> bool:
+        """是否实现了 aexecute"""
+        return type(self).aexecute is not BaseTool.aexecute
+    
+    def cache_version(self, parameters: Dict[str, Any]) -> Any:
+        """缓存键中参数以外的部分：结果依赖的数据版本、当前用户等（须可 JSON 序列化）
+        
+        数据变化时返回新值，旧结果自然失效。
+        """
+        return None
     
     def get_function_schema(self) -> Dict[str, Any]:
         """生成 JSONSchema 格式的工具定义"""
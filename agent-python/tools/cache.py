@@ -0,0 +1,129 @@
+"""
+工具结果缓存 - 幂等工具的进程内 TTL 缓存，所有会话共享
+
+键由工具名、归一化后的参数和工具给出的版本标记（BaseTool.cache_version）组成；
+每个工具有自己的 TTL（BaseTool.cache_ttl），总条目数超限时淘汰最久未访问的条目。
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from llm.cache import make_cache_key
+
+# 全局缓存的条目上限
+TOOL_CACHE_MAX_ENTRIES = 4096
+
+
+def normalize_parameters(parameters: Dict[str, Any]) -> Dict[str, Any]:
+    """参数归一化：字符串去掉首尾空白并合并连续空白，丢弃空值（与省略该参数等价）"""
+    normalized = {}
+    for name, value in parameters.items():
+        if isinstance(value, str):
+            value = " ".join(value.split())
+        if value is None or value == "":
+            continue
+        normalized[name] = value
+    return normalized
+
+
+class ToolResultCache:
+    """按工具统计命中率的 TTL + LRU 缓存（线程安全）"""
+
+    def __init__(self, max_entries: int = TOOL_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        # key -> (工具名, 过期时间, 结果)
+        self._data: "OrderedDict[str, Tuple[str, Optional[float], Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    @staticmethod
+    def make_key(tool_name: str, parameters: Dict[str, Any], version: Any = None) -> str:
+        return make_cache_key({"tool": tool_name, "parameters": normalize_parameters(parameters),
+                               "version": version})
+
+    def _count(self, tool_name: str, name: str) -> None:
+        stats = self._stats.get(tool_name)
+        if stats is None:
+            stats = self._stats[tool_name] = {"hits": 0, "misses": 0, "stores": 0, "expired": 0, "evictions": 0}
+        stats[name] += 1
+
+    def get(self, tool_name: str, key: str) -> Optional[Any]:
+        """命中时返回结果的副本，未命中或已过期返回 None"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[1] is not None and time.monotonic() >= entry[1]:
+                del self._data[key]
+                self._count(tool_name, "expired")
+                entry = None
+            if entry is None:
+                self._count(tool_name, "misses")
+                return None
+            self._data.move_to_end(key)
+            self._count(tool_name, "hits")
+            value = entry[2]
+        # 调用方可能修改结果，不能把缓存里的对象直接交出去
+        return copy.deepcopy(value)
+
+    def put(self, tool_name: str, key: str, value: Any, ttl: Optional[float]) -> None:
+        """ttl 为 None 时不过期（仍受条目上限约束）"""
+        if value is None or (ttl is not None and ttl <= 0):
+            return
+        expires = time.monotonic() + ttl if ttl is not None else None
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._data[key] = (tool_name, expires, value)
+            self._data.move_to_end(key)
+            self._count(tool_name, "stores")
+            while len(self._data) > self.max_entries:
+                _, (evicted_tool, _, _) = self._data.popitem(last=False)
+                self._count(evicted_tool, "evictions")
+
+    def invalidate(self, tool_name: Optional[str] = None) -> int:
+        """删除某个工具（默认全部）的缓存条目，返回删除条数"""
+        with self._lock:
+            keys = [key for key, entry in self._data.items() if tool_name is None or entry[0] == tool_name]
+            for key in keys:
+                del self._data[key]
+            return len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._stats.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """按工具的命中统计"""
+        with self._lock:
+            entries: Dict[str, int] = {}
+            for tool_name, _, _ in self._data.values():
+                entries[tool_name] = entries.get(tool_name, 0) + 1
+            per_tool = {name: dict(stats) for name, stats in self._stats.items()}
+            total = len(self._data)
+        for name, stats in per_tool.items():
+            lookups = stats["hits"] + stats["misses"]
+            stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+            stats["entries"] = entries.get(name, 0)
+        return {"entries": total, "max_entries": self.max_entries, "tools": per_tool}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+_tool_cache: Optional[ToolResultCache] = None
+_tool_cache_lock = threading.Lock()
+
+
+def get_tool_cache() -> ToolResultCache:
+    """获取全局工具结果缓存（单例，所有注册表、所有会话共享）"""
+    global _tool_cache
+    if _tool_cache is None:
+        with _tool_cache_lock:
+            if _tool_cache is None:
+                _tool_cache = ToolResultCache()
+    return _tool_cache
+
+
+def get_tool_cache_stats() -> Dict[str, Any]:
+    return get_tool_cache().stats()
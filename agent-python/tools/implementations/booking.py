@@ -9,6 +9,9 @@ from ..base import BaseTool, ParameterSchema
 class BookRoomTool(BaseTool):
     """预订会议室工具"""
     
+    # 预订有副作用，且同一轮里的多次预订可能互相冲突，按调用顺序逐个执行
+    parallel_safe = False
+    
     def get_name(self) -> str:
         return "book_room"
     
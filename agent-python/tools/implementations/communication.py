@@ -8,6 +8,9 @@ from ..base import BaseTool, ParameterSchema
 class TellUserTool(BaseTool):
     """向用户发送消息工具"""
     
+    # 发给用户的消息要保持模型给出的顺序
+    parallel_safe = False
+    
     def get_name(self) -> str:
         return "tell_user"
     
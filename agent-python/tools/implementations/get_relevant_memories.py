@@ -5,11 +5,15 @@
 from typing import Dict, Any, List
 import uuid
 from ..base import BaseTool, ParameterSchema
-from memory_system import get_relevant_memories
+from memory_system import current_user_id, get_memory_version, get_relevant_memories
 
 class GetRelevantMemoriesTool(BaseTool):
     """从记忆模块中获取相关记忆"""
 
+    # 检索结果只取决于查询和当前用户的记忆内容，记忆有写入时版本号变化，缓存随之失效
+    cacheable = True
+    cache_ttl = 300.0
+
     def get_name(self) -> str:
         return "get_relevant_memories"
     
@@ -26,6 +30,10 @@ class GetRelevantMemoriesTool(BaseTool):
             ),
         ]
     
+    def cache_version(self, parameters: Dict[str, Any]) -> Any:
+        user_id = current_user_id()
+        return [user_id, get_memory_version(user_id)]
+    
     def execute(self, parameters: Dict[str, Any]) -> Dict[str, Any]:
         """执行获取相关记忆"""
         user_input = parameters.get("user_input", "").strip()
@@ -37,8 +45,8 @@ class GetRelevantMemoriesTool(BaseTool):
             }
         
         try:
-            # 获取相关记忆
-            relevant_memories = get_relevant_memories(user_input)
+            # 获取相关记忆（当前会话的用户）
+            relevant_memories = get_relevant_memories(user_input, user_id=current_user_id())
             
             # 检查是否有记忆内容
             if not relevant_memories or relevant_memories == "[]":
@@ -5,11 +5,16 @@
 from typing import Dict, Any, List
 import uuid
 from ..base import BaseTool, ParameterSchema
-from llm.llm_client import llm_call
+from llm.llm_client import llm_call, llm_call_async
 
 class WebSearchTool(BaseTool):
     """从网络中搜索相关信息"""
 
+    # 网络搜索是一次完整的 LLM 调用，耗时较长；同一查询短时间内的结果可以复用
+    timeout = 120.0
+    cacheable = True
+    cache_ttl = 600.0
+
     def get_name(self) -> str:
         return "web_search"
     
@@ -31,22 +36,48 @@ class WebSearchTool(BaseTool):
         search_input = parameters.get("search_input", "").strip()
         
         if not search_input:
-            return {
-                "success": False,
-                "error": "缺少必要参数：search_input"
-            }
+            return self._missing_input()
         
         try:
             result = llm_call(search_input,model="perplexity/sonar") # 使用perplexity/sonar模型进行网络搜索
-            return {
-                "success": True,
-                "message": result,
-                "query": search_input
-            }
+            return self._search_result(search_input, result)
+            
+        except Exception as e:
+            return self._search_error(search_input, e)
+    
+    async def aexecute(self, parameters: Dict[str, Any]) -> Dict[str, Any]:
+        """执行网络搜索（异步，直接在事件循环上等待 LLM）"""
+        search_input = parameters.get("search_input", "").strip()
+        
+        if not search_input:
+            return self._missing_input()
+        
+        try:
+            result = await llm_call_async(search_input, model="perplexity/sonar")
+            return self._search_result(search_input, result)
             
         except Exception as e:
-            return {
-                "success": False,
-                "error": f"网络搜索失败: {str(e)}",
-                "query": search_input
-            }
+            return self._search_error(search_input, e)
+    
+    @staticmethod
+    def _missing_input() -> Dict[str, Any]:
+        return {
+            "success": False,
+            "error": "缺少必要参数：search_input"
+        }
+    
+    @staticmethod
+    def _search_result(search_input: str, result: str) -> Dict[str, Any]:
+        return {
+            "success": True,
+            "message": result,
+            "query": search_input
+        }
+    
+    @staticmethod
+    def _search_error(search_input: str, e: Exception) -> Dict[str, Any]:
+        return {
+            "success": False,
+            "error": f"网络搜索失败: {str(e)}",
+            "query": search_input
+        }
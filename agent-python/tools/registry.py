@@ -2,9 +2,35 @@
 工具注册表 - 管理所有工具实例
 """
 
+import asyncio
+import contextvars
 import json
-from typing import Dict, List, Any
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Dict, List, Any, Optional, Tuple
 from .base import BaseTool
+from .cache import get_tool_cache
+from llm.rate_limit import AdaptiveConcurrencyLimiter
+
+# 同步工具共用的线程池（所有注册表、所有会话共享）
+TOOL_EXECUTOR_WORKERS = 32
+_tool_executor: Optional[ThreadPoolExecutor] = None
+_tool_executor_lock = threading.Lock()
+
+# 按工具名的并发上限（BaseTool.max_concurrency），同时服务线程和协程
+_limiters: Dict[str, AdaptiveConcurrencyLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_tool_executor() -> ThreadPoolExecutor:
+    """获取同步工具共用的线程池（单例）"""
+    global _tool_executor
+    if _tool_executor is None:
+        with _tool_executor_lock:
+            if _tool_executor is None:
+                _tool_executor = ThreadPoolExecutor(max_workers=TOOL_EXECUTOR_WORKERS, thread_name_prefix="tool")
+    return _tool_executor
 
 class ToolRegistry:
     """工具注册表"""
@@ -52,38 +78,185 @@ class ToolRegistry:
         
         calls = []
         for tool_name, params_content in invoke_matches:
-            # 解析参数
-            param_matches = re.findall(r'<parameter name="([^"]+)">(.*?)</parameter>', params_content, re.DOTALL)
-            parameters = {name: value.strip() for name, value in param_matches}
-            
             calls.append({
                 "tool_name": tool_name,
-                "parameters": parameters
+                "parameters": self.parse_invoke_parameters(params_content)
             })
         
         return calls
     
-    def execute_function_calls(self, calls: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        """执行工具调用列表"""
-        results = []
+    @staticmethod
+    def parse_invoke_parameters(params_content: str) -> Dict[str, Any]:
+        """解析 <invoke> 块内的 <parameter> 列表"""
+        import re
         
+        param_matches = re.findall(r'<parameter name="([^"]+)">(.*?)</parameter>', params_content, re.DOTALL)
+        return {name: value.strip() for name, value in param_matches}
+    
+    def execute_function_calls(self, calls: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """执行工具调用列表：可并行的调用在共享线程池中并发执行，结果按调用顺序返回"""
+        results: List[Dict[str, Any]] = []
+        for stage in self._stages(calls):
+            # 先查缓存，命中的调用不再提交
+            lookups = [self._cache_lookup(call, tool) for call, tool in stage]
+            misses = [(i, call, tool, key) for i, ((call, tool), (key, hit)) in enumerate(zip(stage, lookups))
+                      if hit is None]
+            stage_results = [hit for _, hit in lookups]
+            if len(misses) == 1 and misses[0][2] is not None and misses[0][2].timeout is None:
+                # 单个不限时的调用直接在当前线程执行，省掉一次线程切换
+                i, call, tool, key = misses[0]
+                stage_results[i] = self._execute_one(call, tool, key)
+                misses = []
+            executor = get_tool_executor()
+            pending = []
+            for i, call, tool, key in misses:
+                # 在调用方的上下文中执行（如 memory_system.user_scope 设置的当前用户）
+                context = contextvars.copy_context()
+                deadline = time.monotonic() + tool.timeout if tool is not None and tool.timeout is not None else None
+                pending.append((i, call, tool, deadline, executor.submit(context.run, self._execute_one, call, tool, key)))
+            for i, call, tool, deadline, future in pending:
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                try:
+                    stage_results[i] = future.result(timeout=timeout)
+                except FutureTimeoutError:
+                    # 线程无法被中断：超时的调用在后台继续执行，结果丢弃
+                    stage_results[i] = self._timeout_result(call, tool)
+            results.extend(stage_results)
+        return results
+    
+    async def aexecute_function_calls(self, calls: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """异步执行工具调用列表：异步工具在事件循环上执行，同步工具在共享线程池中执行，结果按调用顺序返回"""
+        results: List[Dict[str, Any]] = []
+        for stage in self._stages(calls):
+            if len(stage) == 1:
+                results.append(await self._aexecute_one(*stage[0]))
+            else:
+                results.extend(await asyncio.gather(*(self._aexecute_one(call, tool) for call, tool in stage)))
+        return results
+    
+    def execute_call(self, call: Dict[str, Any]) -> Dict[str, Any]:
+        """在当前线程执行单个调用（查缓存、受并发上限约束，但不限时），供已经在后台线程里的调用方使用"""
+        tool = self.tools.get(call["tool_name"])
+        cache_key, cached = self._cache_lookup(call, tool)
+        if cached is not None:
+            return cached
+        return self._execute_one(call, tool, cache_key)
+    
+    def is_parallel_safe(self, call: Dict[str, Any]) -> bool:
+        """该调用能否与其他调用并发执行（未知工具视为可以，执行时报错）"""
+        tool = self.tools.get(call["tool_name"])
+        return tool is None or tool.parallel_safe
+    
+    def _stages(self, calls: List[Dict[str, Any]]) -> List[List[Tuple[Dict[str, Any], Optional[BaseTool]]]]:
+        """按 parallel_safe 切分：连续的可并行调用为一组，不可并行的调用单独一组，组之间按顺序执行"""
+        stages: List[List[Tuple[Dict[str, Any], Optional[BaseTool]]]] = []
         for call in calls:
-            tool_name = call["tool_name"]
-            parameters = call["parameters"]
+            tool = self.tools.get(call["tool_name"])
+            if tool is not None and not tool.parallel_safe:
+                stages.append([(call, tool)])
+                stages.append([])
+            else:
+                if not stages:
+                    stages.append([])
+                stages[-1].append((call, tool))
+        return [stage for stage in stages if stage]
+    
+    def _limiter(self, tool: BaseTool) -> Optional[AdaptiveConcurrencyLimiter]:
+        if tool.max_concurrency is None:
+            return None
+        name = tool.get_name()
+        limiter = _limiters.get(name)
+        if limiter is None:
+            with _limiters_lock:
+                limiter = _limiters.setdefault(name, AdaptiveConcurrencyLimiter(
+                    initial=tool.max_concurrency, min_limit=tool.max_concurrency, max_limit=tool.max_concurrency))
+        return limiter
+    
+    def _cache_lookup(self, call: Dict[str, Any],
+                      tool: Optional[BaseTool]) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+        """返回 (缓存键, 命中的结果)；工具不可缓存时缓存键为 None"""
+        if tool is None or not tool.cacheable:
+            return None, None
+        try:
+            key = get_tool_cache().make_key(tool.get_name(), call["parameters"], tool.cache_version(call["parameters"]))
+        except Exception as e:
+            print(f"工具 {tool.get_name()} 缓存键计算失败: {e}")
+            return None, None
+        cached = get_tool_cache().get(tool.get_name(), key)
+        return key, (self._ok_result(call, cached) if cached is not None else None)
+    
+    @staticmethod
+    def _cache_store(tool: BaseTool, key: Optional[str], result: Any) -> None:
+        """只缓存成功的结果（失败可能是暂时的）"""
+        if key is not None and isinstance(result, dict) and result.get("success", True):
+            get_tool_cache().put(tool.get_name(), key, result, tool.cache_ttl)
+    
+    def _execute_one(self, call: Dict[str, Any], tool: Optional[BaseTool],
+                     cache_key: Optional[str] = None) -> Dict[str, Any]:
+        """在当前线程执行单个调用，cache_key 不为 None 时缓存成功的结果"""
+        if tool is None:
+            return self._error_result(call, f"工具 '{call['tool_name']}' 未找到")
+        limiter = self._limiter(tool)
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            result = tool.execute(call["parameters"])
+            self._cache_store(tool, cache_key, result)
+            return self._ok_result(call, result)
+        except Exception as e:
+            return self._error_result(call, str(e))
+        finally:
+            if limiter is not None:
+                limiter.release()
+    
+    async def _aexecute_one(self, call: Dict[str, Any], tool: Optional[BaseTool]) -> Dict[str, Any]:
+        if tool is None:
+            return self._error_result(call, f"工具 '{call['tool_name']}' 未找到")
+        cache_key, cached = self._cache_lookup(call, tool)
+        if cached is not None:
+            return cached
+        limiter = self._limiter(tool)
+        
+        async def run() -> Dict[str, Any]:
+            if limiter is not None:
+                await limiter.acquire_async()
+            if tool.is_async:
+                try:
+                    return await tool.aexecute(call["parameters"])
+                finally:
+                    if limiter is not None:
+                        limiter.release()
+            context = contextvars.copy_context()
+            future = asyncio.get_running_loop().run_in_executor(
+                get_tool_executor(), context.run, tool.execute, call["parameters"])
+            
+            def done(f: asyncio.Future) -> None:
+                # 超时后线程仍在执行：等它真正结束再释放名额，并取走无人等待的异常
+                if not f.cancelled():
+                    f.exception()
+                if limiter is not None:
+                    limiter.release()
             
-            try:
-                tool = self.get_tool(tool_name)
-                result = tool.execute(parameters)
-                results.append({
-                    "tool_name": tool_name,
-                    "success": True,
-                    "result": result
-                })
-            except Exception as e:
-                results.append({
-                    "tool_name": tool_name,
-                    "success": False,
-                    "error": str(e)
-                })
+            future.add_done_callback(done)
+            return await asyncio.shield(future)
         
-        return results 
\ No newline at end of file
+        try:
+            result = await asyncio.wait_for(run(), tool.timeout)
+        except asyncio.TimeoutError:
+            return self._timeout_result(call, tool)
+        except Exception as e:
+            return self._error_result(call, str(e))
+        self._cache_store(tool, cache_key, result)
+        return self._ok_result(call, result)
+    
+    @staticmethod
+    def _ok_result(call: Dict[str, Any], result: Any) -> Dict[str, Any]:
+        return {"tool_name": call["tool_name"], "success": True, "result": result}
+    
+    @staticmethod
+    def _error_result(call: Dict[str, Any], error: str) -> Dict[str, Any]:
+        return {"tool_name": call["tool_name"], "success": False, "error": error}
+    
+    @classmethod
+    def _timeout_result(cls, call: Dict[str, Any], tool: BaseTool) -> Dict[str, Any]:
+        return cls._error_result(call, f"工具执行超时（{tool.timeout:g}s）")
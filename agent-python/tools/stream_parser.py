@@ -0,0 +1,80 @@
+"""
+流式工具调用解析器 - 边接收 LLM 输出边解析 <function_calls> 块
+"""
+
+import re
+from typing import Dict, Any, List, Tuple
+from .registry import ToolRegistry
+
+FUNCTION_CALLS_OPEN = "<function_calls>"
+FUNCTION_CALLS_CLOSE = "</function_calls>"
+INVOKE_PATTERN = re.compile(r'<invoke name="([^"]+)">(.*?)</invoke>', re.DOTALL)
+
+
+class StreamingFunctionCallParser:
+    """增量解析器
+
+    - <function_calls> 之前的文本是给用户看的回复，可以立即输出
+    - 每个 </invoke> 到达时产出一个完整的调用，调用方可以马上执行
+    - 看到 </function_calls> 后 closed 为 True，调用方可以停止生成
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.in_block = False
+        self.closed = False
+        self._text_pos = 0
+        self._invoke_pos = 0
+
+    def feed(self, chunk: str) -> Tuple[str, List[Dict[str, Any]]]:
+        """输入一段新内容，返回 (可以输出给用户的文本, 新解析出的完整调用)"""
+        self.buffer += chunk
+        text = ""
+        calls: List[Dict[str, Any]] = []
+
+        if not self.in_block:
+            start = self.buffer.find(FUNCTION_CALLS_OPEN, self._text_pos)
+            if start == -1:
+                # 末尾可能是半个开始标签，先扣住不输出
+                safe_end = len(self.buffer) - self._partial_tag_length()
+                text = self.buffer[self._text_pos:safe_end]
+                self._text_pos = safe_end
+                return text, calls
+
+            text = self.buffer[self._text_pos:start]
+            self._text_pos = start
+            self.in_block = True
+            self._invoke_pos = start + len(FUNCTION_CALLS_OPEN)
+
+        if not self.closed:
+            for match in INVOKE_PATTERN.finditer(self.buffer, self._invoke_pos):
+                # 只接受块结束之前的 invoke
+                close = self.buffer.find(FUNCTION_CALLS_CLOSE, self._invoke_pos)
+                if close != -1 and match.start() > close:
+                    break
+                tool_name, params_content = match.groups()
+                calls.append({
+                    "tool_name": tool_name,
+                    "parameters": ToolRegistry.parse_invoke_parameters(params_content)
+                })
+                self._invoke_pos = match.end()
+
+            if self.buffer.find(FUNCTION_CALLS_CLOSE, self._invoke_pos) != -1:
+                self.closed = True
+
+        return text, calls
+
+    def flush(self) -> str:
+        """流结束时输出扣住的剩余文本"""
+        if self.in_block:
+            return ""
+        text = self.buffer[self._text_pos:]
+        self._text_pos = len(self.buffer)
+        return text
+
+    def _partial_tag_length(self) -> int:
+        """buffer 末尾与开始标签前缀重合的长度"""
+        for length in range(min(len(FUNCTION_CALLS_OPEN) - 1, len(self.buffer) - self._text_pos), 0, -1):
+            if FUNCTION_CALLS_OPEN.startswith(self.buffer[-length:]):
+                return length
+        return 0